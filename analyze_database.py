@@ -6,35 +6,66 @@ GROUPS変数の被写体の数と組み合わせごとに画像数をカウン
 """
 
 import sqlite3
+import os
+import time
 from collections import defaultdict, Counter
-from math import inf
+from concurrent.futures import ProcessPoolExecutor
+from urllib.request import pathname2url
 import json
+import numpy as np
 from database import ImageDatabase
+from tags import GROUPS
 
-# app.pyのGROUPS変数を再定義
-GROUPS = {
-    "girls": {
-        "1girl": (1, 1),
-        "2girls": (2, 2),
-        "3girls": (3, 3),
-        "4girls": (4, 4),
-        "5girls": (5, 5),
-        "6girls": (6, 6),
-        "multiple_girls": (2, inf),
-    },
-    "boys": {
-        "1boy": (1, 1),
-        "2boys": (2, 2),
-        "3boys": (3, 3),
-        "4boys": (4, 4),
-        "5boys": (5, 5),
-        "6boys": (6, 6),
-        "multiple_boys": (2, inf),
-    },
-    "solo": {
-        "solo": (1, 1),           # 総キャラ数 = 1 のシグナル
-    },
-}
+
+def _count_group_masks(db_path, tag_bits, id_range):
+    """
+    画像IDの範囲内の画像について、GROUPSタグのビットマスクごとの画像数を返す（ProcessPoolExecutor のワーカーでも実行）
+    tag_bits: タグID → ビット番号（None の場合は登録時に計算済みの images.group_mask をそのまま数える）
+    戻り値: (マスクの配列, 画像数の配列)。GROUPSタグのない画像はマスク0として数える
+    """
+    start_id, end_id = id_range
+    conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro", uri=True)
+    try:
+        cursor = conn.cursor()
+        if tag_bits is None:
+            cursor.execute('''
+                SELECT group_mask, COUNT(*) FROM images
+                WHERE id BETWEEN ? AND ?
+                GROUP BY group_mask
+            ''', (start_id, end_id))
+            rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+            return rows[:, 0], rows[:, 1]
+        
+        cursor.execute('SELECT COUNT(*) FROM images WHERE id BETWEEN ? AND ?', (start_id, end_id))
+        image_count = cursor.fetchone()[0]
+        
+        rows = np.empty((0, 2), dtype=np.int64)
+        if tag_bits:
+            # (tag_id, image_id) インデックスでタグごとに範囲を読むだけで済む
+            placeholders = ','.join(['?' for _ in tag_bits])
+            cursor.execute(f'''
+                SELECT image_id, tag_id FROM image_tags
+                WHERE tag_id IN ({placeholders}) AND image_id BETWEEN ? AND ?
+            ''', list(tag_bits) + [start_id, end_id])
+            fetched = cursor.fetchall()
+            if fetched:
+                rows = np.array(fetched, dtype=np.int64)
+    finally:
+        conn.close()
+    
+    bit_tag_ids = np.array(sorted(tag_bits), dtype=np.int64)
+    bit_values = np.array([1 << tag_bits[tag_id] for tag_id in bit_tag_ids], dtype=np.int64)
+    # (画像, タグ) は一意なので、ビットの合計がビットごとの OR になる
+    image_ids, inverse = np.unique(rows[:, 0], return_inverse=True)
+    bits = bit_values[np.searchsorted(bit_tag_ids, rows[:, 1])] if len(rows) else np.empty(0, dtype=np.int64)
+    image_masks = np.bincount(inverse, weights=bits, minlength=len(image_ids)).astype(np.int64)
+    
+    masks, counts = np.unique(image_masks, return_counts=True)
+    untagged = image_count - len(image_ids)
+    if untagged:
+        masks = np.r_[0, masks]
+        counts = np.r_[untagged, counts]
+    return masks, counts.astype(np.int64)
 
 class DatabaseAnalyzer:
     def __init__(self, db_path="image_search.db"):
@@ -48,68 +79,82 @@ class DatabaseAnalyzer:
             all_tags.update(tag_dict.keys())
         return all_tags
     
-    def analyze_tag_combinations(self):
-        """被写体の数と組み合わせごとに画像数をカウント"""
+    def analyze_tag_combinations(self, parallel=False, workers=None):
+        """
+        被写体の数と組み合わせごとに画像数をカウント
+        画像ごとのGROUPSタグを1つのビットマスクにまとめ、マスクごとの画像数から各統計を求める
+        parallel: 画像IDの範囲ごとに別プロセスで集計する（workers: プロセス数、既定はCPU数）
+        """
         print("データベース解析を開始します...")
         
         conn = self.db.get_connection()
         cursor = conn.cursor()
         
-        # 全画像数を取得
-        cursor.execute('SELECT COUNT(*) FROM images')
-        total_images = cursor.fetchone()[0]
+        # 全画像数を取得（集計テーブルから）
+        total_images = self.db.get_counters().get('images', 0)
         print(f"総画像数: {total_images:,}件")
         
         # GROUPS変数に含まれるタグの使用状況を取得
         group_tags = self.get_all_group_tags()
-        tag_placeholders = ','.join(['?' for _ in group_tags])
-        
-        cursor.execute(f'''
-            SELECT t.tag_name, COUNT(it.image_id) as usage_count
-            FROM tags t
-            LEFT JOIN image_tags it ON t.id = it.tag_id
-            WHERE t.tag_name IN ({tag_placeholders})
-            GROUP BY t.tag_name
-            ORDER BY usage_count DESC
-        ''', list(group_tags))
-        
-        tag_usage = dict(cursor.fetchall())
+        
+        tag_counts = self.db.get_tag_counts(list(group_tags))
+        tag_usage = dict(sorted(tag_counts.items(), key=lambda x: x[1], reverse=True))
         print(f"\nGROUPS変数に含まれるタグの使用状況:")
         for tag, count in tag_usage.items():
             print(f"  {tag}: {count:,}件")
         
-        # 各画像がどのGROUPSタグを持っているかを取得
-        cursor.execute(f'''
-            SELECT i.id, GROUP_CONCAT(t.tag_name) as tags
-            FROM images i
-            LEFT JOIN image_tags it ON i.id = it.image_id
-            LEFT JOIN tags t ON it.tag_id = t.id AND t.tag_name IN ({tag_placeholders})
-            GROUP BY i.id
-        ''', list(group_tags))
-        
-        image_tags = cursor.fetchall()
-        conn.close()
-        
-        # 組み合わせ別の統計を作成
+        # タグごとにビットを割り当てる（タグ名順、images.group_mask の tags.GROUP_TAG_BITS と同じ）
+        bit_tags = sorted(group_tags)
+        if self.db.group_mask_ready:
+            # 登録時に計算済みのマスクを画像テーブルで数えるだけで済む
+            tag_bits = None
+        else:
+            tag_ids = {tag: tag_id for tag, (tag_id, _) in self.db.get_tag_info(bit_tags).items()}
+            tag_bits = {tag_ids[tag]: bit for bit, tag in enumerate(bit_tags) if tag in tag_ids}
+        
+        cursor.execute('SELECT MIN(id), MAX(id) FROM images')
+        min_id, max_id = cursor.fetchone()
+        ranges = []
+        if min_id is not None:
+            workers = workers or os.cpu_count() or 1
+            parts = workers * 4 if parallel else 1
+            step = (max_id - min_id) // parts + 1
+            ranges = [(start, min(start + step - 1, max_id)) for start in range(min_id, max_id + 1, step)]
+        
+        print(f"\n画像のタグ組み合わせを解析中... ({len(ranges)}範囲{', 並列' if parallel else ''}"
+              f"{', group_mask' if tag_bits is None else ''})")
+        analyze_start = time.time()
+        if parallel and len(ranges) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parts = list(executor.map(_count_group_masks, [self.db_path] * len(ranges),
+                                          [tag_bits] * len(ranges), ranges))
+        else:
+            parts = [_count_group_masks(self.db_path, tag_bits, id_range) for id_range in ranges]
+        
+        # 範囲ごとのマスク別画像数を合算
+        if parts:
+            masks, inverse = np.unique(np.concatenate([masks for masks, _ in parts]), return_inverse=True)
+            mask_counts = np.bincount(inverse, weights=np.concatenate([counts for _, counts in parts]),
+                                      minlength=len(masks)).astype(np.int64)
+        else:
+            masks = mask_counts = np.empty(0, dtype=np.int64)
+        print(f"マスク集計完了: {len(masks)}パターン ({time.time() - analyze_start:.4f}秒)")
+        
+        # 組み合わせ別の統計を作成（マスクの種類数だけ回る）
         combination_stats = defaultdict(int)
         tag_combination_counter = Counter()
         
         # 各グループ別の統計
         group_stats = {group_name: defaultdict(int) for group_name in GROUPS.keys()}
         
-        print(f"\n画像のタグ組み合わせを解析中... ({len(image_tags):,}件)")
-        
-        for image_id, tags_str in image_tags:
-            if tags_str:
-                image_tags_set = set(tags_str.split(','))
-            else:
-                image_tags_set = set()
+        for mask, count in sorted(zip(masks.tolist(), mask_counts.tolist()), key=lambda x: (-x[1], x[0])):
+            image_tags_set = {tag for bit, tag in enumerate(bit_tags) if mask >> bit & 1}
             
             # 各グループでのタグ存在をチェック
-            group_presence = {}
-            for group_name, tag_dict in GROUPS.items():
-                present_tags = image_tags_set.intersection(set(tag_dict.keys()))
-                group_presence[group_name] = present_tags
+            group_presence = {
+                group_name: image_tags_set.intersection(tag_dict.keys())
+                for group_name, tag_dict in GROUPS.items()
+            }
             
             # 組み合わせパターンを記録
             combination_key = []
@@ -121,20 +166,20 @@ class DatabaseAnalyzer:
                     combination_key.append(f"{group_name}:none")
             
             combination_str = " | ".join(combination_key)
-            combination_stats[combination_str] += 1
+            combination_stats[combination_str] += count
             
             # 個別タグの組み合わせもカウント
             if image_tags_set:
                 sorted_tags = tuple(sorted(image_tags_set))
-                tag_combination_counter[sorted_tags] += 1
+                tag_combination_counter[sorted_tags] += count
             
             # 各グループ別の統計
             for group_name, present_tags in group_presence.items():
                 if present_tags:
                     for tag in present_tags:
-                        group_stats[group_name][tag] += 1
+                        group_stats[group_name][tag] += count
                 else:
-                    group_stats[group_name]["none"] += 1
+                    group_stats[group_name]["none"] += count
         
         return {
             'total_images': total_images,
@@ -144,6 +189,22 @@ class DatabaseAnalyzer:
             'group_stats': {k: dict(v) for k, v in group_stats.items()}
         }
     
+    def analyze_group_tag_pairs(self):
+        """GROUPSタグ同士の共起画像数を共起行列から取得（ペア単位の件数推定、共起行列がなければ空）"""
+        info = self.db.get_cooccurrence_info()
+        if not info:
+            print("\nタグ共起行列がないためペア統計を省略します（python database.py build-cooccurrence で作成）")
+            return {}
+        
+        generation = self.db.get_generation()
+        if info['generation'] != generation:
+            print(f"\n⚠️  タグ共起行列は世代{info['generation']}の時点のものです（現在: 世代{generation}）")
+        pair_counts = self.db.get_pair_counts(list(self.get_all_group_tags()))
+        return {
+            f"{tag_a} + {tag_b}": count
+            for (tag_a, tag_b), count in sorted(pair_counts.items(), key=lambda x: x[1], reverse=True)
+        }
+    
     def print_analysis_results(self, results):
         """解析結果を見やすく表示"""
         print("\n" + "="*80)
@@ -188,6 +249,12 @@ class DatabaseAnalyzer:
             percentage = (count / results['total_images']) * 100
             tags_str = " + ".join(tags)
             print(f"  {i:2d}. {count:8,}件 ({percentage:5.1f}%) - {tags_str}")
+        
+        if results.get('group_tag_pairs'):
+            print(f"\n🔗 GROUPSタグのペア（共起行列から、上位20位）:")
+            for i, (pair, count) in enumerate(list(results['group_tag_pairs'].items())[:20], 1):
+                percentage = (count / results['total_images']) * 100
+                print(f"  {i:2d}. {count:8,}件 ({percentage:5.1f}%) - {pair}")
     
     def suggest_database_partitioning(self, results):
         """データベース分割の提案"""
@@ -303,12 +370,21 @@ class DatabaseAnalyzer:
 
 def main():
     """メイン実行関数"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="GROUPS変数の被写体数・組み合わせ別統計を作成")
+    parser.add_argument("--db", default="image_search.db", help="データベースファイルのパス")
+    parser.add_argument("--parallel", action="store_true", help="画像IDの範囲ごとに別プロセスで集計する")
+    parser.add_argument("--workers", type=int, default=None, help="並列集計のプロセス数（既定はCPU数）")
+    args = parser.parse_args()
+    
     print("🔍 画像データベース解析ツール")
     print("GROUPS変数の被写体数・組み合わせ別統計を作成します\n")
     
     try:
-        analyzer = DatabaseAnalyzer()
-        results = analyzer.analyze_tag_combinations()
+        analyzer = DatabaseAnalyzer(args.db)
+        results = analyzer.analyze_tag_combinations(parallel=args.parallel, workers=args.workers)
+        results['group_tag_pairs'] = analyzer.analyze_group_tag_pairs()
         
         analyzer.print_analysis_results(results)
         analyzer.suggest_database_partitioning(results)
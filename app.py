@@ -1,42 +1,84 @@
 # app.py (修正版)
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify
+from werkzeug.http import http_date, is_resource_modified
 import os
 import time
-from database import ImageDatabase
+import json
+import base64
+import binascii
+from datetime import datetime, timezone
+from itertools import islice
+from database import ImageDatabase, SEARCH_MODES, SEARCH_RANKS, parse_tag_spec
+from autocomplete import TagAutocomplete
+from search_cache import SearchResultCache
+from file_status_cache import FileStatusCache
+from file_serving import FileServer, parse_roots
+from thumbnails import ThumbnailCache, DEFAULT_THUMBNAIL_SIZE, thumbnail_etag, validate_thumbnail_size
+from sharded_database import ShardedImageDatabase
 import traceback
-
-from math import inf
+from tags import GROUPS
 
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
+# 検索エンジン: "sql" または "bitmap"（インメモリのポスティングリスト）
+app.config['SEARCH_ENGINE'] = os.environ.get('SEARCH_ENGINE', 'sql')
+# インメモリエンジン用のインデックススナップショット（python database.py export-snapshot で作成）
+app.config['INDEX_SNAPSHOT_DIR'] = os.environ.get('INDEX_SNAPSHOT_DIR') or None
+# 分割データベースのマニフェスト（database_splitter.py が作成する shards.json、指定時はシャードを並列検索）
+app.config['SHARD_MANIFEST'] = os.environ.get('SHARD_MANIFEST') or None
+# 検索結果キャッシュ（保持クエリ数・有効期間[秒]）
+app.config['SEARCH_CACHE_SIZE'] = int(os.environ.get('SEARCH_CACHE_SIZE', 1024))
+app.config['SEARCH_CACHE_TTL'] = float(os.environ.get('SEARCH_CACHE_TTL', 300))
+# 画像ファイルの存在確認キャッシュ（存在する/しないファイルの有効期間[秒]・まとめて確認するスレッド数）
+app.config['FILE_STATUS_TTL'] = float(os.environ.get('FILE_STATUS_TTL', 300))
+app.config['FILE_STATUS_NEGATIVE_TTL'] = float(os.environ.get('FILE_STATUS_NEGATIVE_TTL', 30))
+app.config['FILE_CHECK_WORKERS'] = int(os.environ.get('FILE_CHECK_WORKERS', 16))
+# サムネイルのディスクキャッシュ（保存先・形式 "webp"/"jpeg"・ブラウザのキャッシュ期間[秒]）
+app.config['THUMBNAIL_DIR'] = os.environ.get('THUMBNAIL_DIR', 'thumbnail_cache')
+app.config['THUMBNAIL_FORMAT'] = os.environ.get('THUMBNAIL_FORMAT', 'webp')
+app.config['THUMBNAIL_MAX_AGE'] = int(os.environ.get('THUMBNAIL_MAX_AGE', 3600))
+# 画像の配信方法（"send_file" / "x-sendfile" / "x-accel"、file_serving.py 参照）
+app.config['IMAGE_SERVE_MODE'] = os.environ.get('IMAGE_SERVE_MODE', 'send_file')
+# 配信を許可する画像ディレクトリ（"ディレクトリ=nginxのinternal location" をカンマ区切り、location は x-accel のみ）
+app.config['IMAGE_ROOTS'] = os.environ.get('IMAGE_ROOTS', '')
+# x-accel でサムネイルのディレクトリに対応する nginx の internal location
+app.config['THUMBNAIL_ACCEL_LOCATION'] = os.environ.get('THUMBNAIL_ACCEL_LOCATION', '/protected_thumbnails')
+# /api/images/tags で1回に指定できる画像数
+app.config['MAX_TAG_BATCH'] = int(os.environ.get('MAX_TAG_BATCH', 500))
+# NDJSON ストリーミング時にファイル確認・タグ取得をまとめて行い、まとめて送る行数
+app.config['STREAM_CHUNK'] = int(os.environ.get('STREAM_CHUNK', 500))
+
+# /api/search の limit の上限（NDJSON のエクスポートで数万件を取得できる大きさにする）
+app.config['MAX_SEARCH_LIMIT'] = int(os.environ.get('MAX_SEARCH_LIMIT', 100000))
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# データベース初期化（Web層の参照は読み取り専用接続で行う）
+if app.config['SHARD_MANIFEST']:
+    db = ShardedImageDatabase.from_manifest(app.config['SHARD_MANIFEST'], search_engine=app.config['SEARCH_ENGINE'])
+else:
+    db = ImageDatabase(search_engine=app.config['SEARCH_ENGINE'], profile="serving", read_only=True,
+                       snapshot_dir=app.config['INDEX_SNAPSHOT_DIR'])
+
+# タグ自動補完インデックス（起動時に構築し、登録に合わせて差分更新）
+autocomplete = TagAutocomplete(db)
+autocomplete.build()
 
-# データベース初期化
-db = ImageDatabase()
-
-GROUPS = {
-    "girls": {
-        "1girl": (1, 1),
-        "2girls": (2, 2),
-        "3girls": (3, 3),
-        "4girls": (4, 4),
-        "5girls": (5, 5),
-        "6girls": (6, 6),
-        "multiple_girls": (2, inf),
-    },
-    "boys": {
-        "1boy": (1, 1),
-        "2boys": (2, 2),
-        "3boys": (3, 3),
-        "4boys": (4, 4),
-        "5boys": (5, 5),
-        "6boys": (6, 6),
-        "multiple_boys": (2, inf),
-    },
-    "solo": {
-        "solo": (1, 1),           # 総キャラ数 = 1 のシグナル
-    },
-}
+# 検索結果キャッシュ（登録・削除でデータベースの世代が進むと無効化）
+search_cache = SearchResultCache(app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL'])
+
+# 画像ファイルの存在確認キャッシュ（整合性チェック・登録時に記録した file_status も参照）
+file_status_cache = FileStatusCache(app.config['FILE_STATUS_TTL'], app.config['FILE_STATUS_NEGATIVE_TTL'],
+                                    workers=app.config['FILE_CHECK_WORKERS'], source=db)
+
+# サムネイル（初回アクセス時に作成し、画像ID・サイズ・元ファイルの更新時刻をキーに保存）
+thumbnail_cache = ThumbnailCache(app.config['THUMBNAIL_DIR'], app.config['THUMBNAIL_FORMAT'])
+
+# 画像・サムネイルの配信（ルート指定時はその配下のみ配信し、サムネイルのディレクトリも許可する）
+file_server = FileServer(app.config['IMAGE_SERVE_MODE'], parse_roots(app.config['IMAGE_ROOTS']))
+if file_server.roots or file_server.mode == "x-accel":
+    file_server.add_root(thumbnail_cache.cache_dir, app.config['THUMBNAIL_ACCEL_LOCATION'])
 
 def _overlap(r1, r2):
     a1, b1 = r1;  a2, b2 = r2
@@ -80,6 +122,163 @@ def build_query(pos_tags: str):
     return list(pos), list(neg_final)
 
 
+def encode_cursor(match_count, image_id):
+    """(match_count, id) を不透明なページングカーソルに変換（信頼度順では match_count は合計値）"""
+    raw = json.dumps([match_count, image_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """ページングカーソルを (match_count, id) に戻す（不正な場合は ValueError）"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        match_count, image_id = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(match_count, (int, float)) or isinstance(match_count, bool) or not isinstance(image_id, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return match_count, image_id
+
+
+def parse_search_request(data):
+    """
+    検索リクエストのJSONから (positive_tags, negative_tags, limit, after, mode, rank) を作る
+    タグは "long_hair>0.8" のように信頼度のしきい値を付けられる
+    GROUPS による人数タグの展開もここで行う（不正な入力は ValueError）
+    """
+    positive_specs = [tag.strip().lower() for tag in data.get('positive_tags', []) if tag.strip()]
+    negative_specs = [tag.strip().lower() for tag in data.get('negative_tags', []) if tag.strip()]
+    
+    # 人数タグの判定はしきい値を外したタグ名で行い、展開されるのは除外タグのみ
+    _, negative_tag_build = build_query([parse_tag_spec(spec)[0] for spec in positive_specs])
+    
+    positive_tags = list(set(positive_specs))
+    negative_tags = list(set(negative_specs + negative_tag_build))
+    try:
+        limit = int(data.get('limit', 50))
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid limit: {data.get('limit')}")
+    # "any": いずれかのタグを含む（一致数順）/ "all": すべてのタグを含む
+    mode = data.get('mode', 'any')
+    # "count": 一致タグ数順 / "confidence": 一致タグの信頼度の合計順
+    rank = data.get('rank', 'count')
+    
+    if not positive_tags:
+        raise ValueError('At least one positive tag is required')
+    if mode not in SEARCH_MODES:
+        raise ValueError(f'Invalid mode: {mode}')
+    if rank not in SEARCH_RANKS:
+        raise ValueError(f'Invalid rank: {rank}')
+    if not 1 <= limit <= app.config['MAX_SEARCH_LIMIT']:
+        raise ValueError(f"limit must be between 1 and {app.config['MAX_SEARCH_LIMIT']}")
+    
+    # キーセットページング: 前ページの next_cursor を受け取り、その続きから取得
+    after = decode_cursor(data['cursor']) if data.get('cursor') else None
+    return positive_tags, negative_tags, limit, after, mode, rank
+
+
+def stream_search_results(positive_tags, negative_tags, limit, after, mode, rank, include_tags,
+                          total_start_time, query_build_time):
+    """
+    検索結果を NDJSON（1行1画像）でストリーミングするレスポンス
+    カーソルから STREAM_CHUNK 行ずつ読み出して送るため、limit が大きくてもメモリ使用量は一定（検索キャッシュは使わない）
+    最終行は件数・next_cursor・処理時間をまとめたトレーラー（"performance" を含む行）
+    """
+    chunk_size = app.config['STREAM_CHUNK']
+    # 次ページの有無を判定するため1件多く取得（実行計画の作成までここで行う）
+    plan_start = time.time()
+    rows = db.iter_search_images(positive_tags, negative_tags, limit + 1, after, mode, rank)
+    plan_time = time.time() - plan_start
+    
+    def generate():
+        stream_start = time.time()
+        db_search_time = file_check_time = tag_fetch_time = 0.0
+        first_row_time = None
+        count = 0
+        last_row = None
+        has_more = False
+        try:
+            while not has_more:
+                fetch_start = time.time()
+                chunk = list(islice(rows, chunk_size))
+                db_search_time += time.time() - fetch_start
+                if count + len(chunk) > limit:
+                    chunk = chunk[:limit - count]
+                    has_more = True
+                if not chunk:
+                    break
+                
+                file_check_start = time.time()
+                file_exists = file_status_cache.check_many([filepath for _, filepath, _, _ in chunk])
+                file_check_time += time.time() - file_check_start
+                tag_fetch_start = time.time()
+                image_tags = db.get_tags_for_images([image_id for image_id, _, _, _ in chunk]) if include_tags else None
+                tag_fetch_time += time.time() - tag_fetch_start
+                
+                lines = []
+                for image_id, filepath, filename, match_count in chunk:
+                    item = {
+                        'id': image_id,
+                        'filepath': filepath,
+                        'filename': filename,
+                        'match_count': match_count,
+                        'file_exists': file_exists[filepath]
+                    }
+                    if image_tags is not None:
+                        item['tags'] = image_tags[image_id]
+                    lines.append(json.dumps(item) + '\n')
+                if first_row_time is None:
+                    first_row_time = time.time() - total_start_time
+                count += len(chunk)
+                last_row = chunk[-1]
+                yield ''.join(lines)
+        except Exception as e:
+            # ステータスコードは送信済みのため、エラーは最終行で返す
+            print(f"Search stream error: {e}")
+            print(traceback.format_exc())
+            yield json.dumps({'error': str(e)}) + '\n'
+            return
+        finally:
+            # 途中で打ち切った場合もカーソル用の接続を閉じる
+            close = getattr(rows, 'close', None)
+            if close is not None:
+                close()
+        
+        next_cursor = encode_cursor(last_row[3], last_row[0]) if has_more and last_row else None
+        total_time = time.time() - total_start_time
+        print(f"ストリーミング検索: {count}件, 全体処理時間: {total_time:.4f}秒 "
+              f"(DB読み出し: {db_search_time:.4f}秒, ファイル確認: {file_check_time:.4f}秒)")
+        performance = {
+            'total_time': total_time,
+            'query_build_time': query_build_time,
+            'plan_time': plan_time,
+            'db_search_time': db_search_time,
+            'response_build_time': time.time() - stream_start - db_search_time,
+            'file_check_time': file_check_time,
+            'tag_fetch_time': tag_fetch_time,
+            'first_row_time': first_row_time,
+            'streamed': True,
+            'file_cache': file_status_cache.stats()
+        }
+        if isinstance(db, ShardedImageDatabase):
+            performance['shards'] = db.last_search_info()
+        yield json.dumps({
+            'total_count': count,
+            'next_cursor': next_cursor,
+            'query': {
+                'positive_tags': positive_tags,
+                'negative_tags': negative_tags,
+                'mode': mode,
+                'rank': rank
+            },
+            'performance': performance
+        }) + '\n'
+    
+    response = app.response_class(generate(), mimetype=NDJSON_MIMETYPE)
+    # 前段の nginx にバッファリングさせず、読み出した行から順に送る
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -95,38 +294,63 @@ def search_images():
 
         # クエリ構築の時間を測定
         query_build_start = time.time()
-        positive_tag_build, negative_tag_build = build_query(data.get('positive_tags', []))
-        
-        positive_tags = list(set([tag.strip().lower() for tag in data.get('positive_tags', []) if tag.strip()] + positive_tag_build))
-        negative_tags = list(set([tag.strip().lower() for tag in data.get('negative_tags', []) if tag.strip()] + negative_tag_build))
-        limit = data.get('limit', 50)
+        try:
+            positive_tags, negative_tags, limit, after, mode, rank = parse_search_request(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         query_build_time = time.time() - query_build_start
         
+        # 一覧でタグを表示するため、結果の画像のタグもまとめて返す（検索キャッシュには含めない）
+        include_tags = bool(data.get('include_tags'))
+        
         print(f"Processed tags - Positive: {positive_tags}, Negative: {negative_tags}")
         print(f"クエリ構築時間: {query_build_time:.4f}秒")
         
-        if not positive_tags:
-            return jsonify({'error': 'At least one positive tag is required'}), 400
+        # Accept: application/x-ndjson の場合は結果を1行ずつストリーミングで返す
+        if request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+            return stream_search_results(positive_tags, negative_tags, limit, after, mode, rank, include_tags,
+                                         total_start_time, query_build_time)
         
-        # データベース検索の時間を測定
+        # データベース検索の時間を測定（GROUPS展開後のタグ集合でキャッシュを引く）
         db_search_start = time.time()
-        results = db.search_images(positive_tags, negative_tags, limit)
+        cache_key = search_cache.make_key(positive_tags, negative_tags, limit, after=after, mode=mode, rank=rank)
+        generation = db.get_generation()
+        results = search_cache.get(cache_key, generation)
+        cache_hit = results is not None
+        if not cache_hit:
+            # 次ページの有無を判定するため1件多く取得
+            results = db.search_images(positive_tags, negative_tags, limit + 1, after, mode, rank)
+            search_cache.put(cache_key, generation, results)
+        
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            last_id, _, _, last_match_count = results[-1]
+            next_cursor = encode_cursor(last_match_count, last_id)
         db_search_time = time.time() - db_search_start
         print(f"データベース検索時間: {db_search_time:.4f}秒")
         
         # レスポンス構築の時間を測定
         response_build_start = time.time()
+        # ファイルの存在確認（キャッシュにないファイルはまとめて並行に確認）
+        file_check_start = time.time()
+        file_exists = file_status_cache.check_many([filepath for _, filepath, _, _ in results])
+        file_check_time = time.time() - file_check_start
+        tag_fetch_start = time.time()
+        image_tags = db.get_tags_for_images([image_id for image_id, _, _, _ in results]) if include_tags else None
+        tag_fetch_time = time.time() - tag_fetch_start
         response_data = []
         for image_id, filepath, filename, match_count in results:
-            # ファイルの存在確認
-            file_exists = os.path.exists(filepath)
-            response_data.append({
+            item = {
                 'id': image_id,
                 'filepath': filepath,
                 'filename': filename,
                 'match_count': match_count,
-                'file_exists': file_exists
-            })
+                'file_exists': file_exists[filepath]
+            }
+            if image_tags is not None:
+                item['tags'] = image_tags[image_id]
+            response_data.append(item)
         response_build_time = time.time() - response_build_start
         
         # 全体の処理時間を計算
@@ -135,21 +359,33 @@ def search_images():
         print(f"レスポンス構築時間: {response_build_time:.4f}秒")
         print(f"検索結果数: {len(response_data)}件")
         print(f"全体処理時間: {total_time:.4f}秒")
-        print(f"時間内訳 - クエリ構築: {query_build_time:.4f}秒, DB検索: {db_search_time:.4f}秒, レスポンス構築: {response_build_time:.4f}秒")
+        print(f"時間内訳 - クエリ構築: {query_build_time:.4f}秒, DB検索: {db_search_time:.4f}秒, レスポンス構築: {response_build_time:.4f}秒 (うちファイル確認: {file_check_time:.4f}秒)")
+        
+        performance = {
+            'total_time': total_time,
+            'query_build_time': query_build_time,
+            'db_search_time': db_search_time,
+            'response_build_time': response_build_time,
+            'file_check_time': file_check_time,
+            'tag_fetch_time': tag_fetch_time,
+            'cache': dict(search_cache.stats(), hit=cache_hit),
+            'file_cache': file_status_cache.stats()
+        }
+        # 分割データベースではシャードごとの検索時間と除外理由を返す
+        if isinstance(db, ShardedImageDatabase) and not cache_hit:
+            performance['shards'] = db.last_search_info()
         
         return jsonify({
             'results': response_data,
             'total_count': len(response_data),
+            'next_cursor': next_cursor,
             'query': {
                 'positive_tags': positive_tags,
-                'negative_tags': negative_tags
+                'negative_tags': negative_tags,
+                'mode': mode,
+                'rank': rank
             },
-            'performance': {
-                'total_time': total_time,
-                'query_build_time': query_build_time,
-                'db_search_time': db_search_time,
-                'response_build_time': response_build_time
-            }
+            'performance': performance
         })
         
     except Exception as e:
@@ -157,31 +393,102 @@ def search_images():
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/search/explain', methods=['POST'])
+def explain_search():
+    """検索の実行計画・推定/実際のカーディナリティ・EXPLAIN QUERY PLAN を返す"""
+    try:
+        data = request.json
+        try:
+            positive_tags, negative_tags, limit, after, mode, rank = parse_search_request(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        explain = db.explain_search(positive_tags, negative_tags, limit, after, mode, rank)
+        explain['query'] = {
+            'positive_tags': positive_tags,
+            'negative_tags': negative_tags,
+            'mode': mode,
+            'rank': rank
+        }
+        return jsonify(explain)
+        
+    except Exception as e:
+        print(f"Explain error: {e}")
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/image/<int:image_id>')
 def serve_image(image_id):
-    """画像ファイルを配信"""
+    """画像ファイルを配信（転送は IMAGE_SERVE_MODE に応じて send_file または前段のサーバーが行う）"""
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT filepath FROM images WHERE id = ?', (image_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = db.get_image(image_id)
         
         if not result:
             print(f"Image ID {image_id} not found in database")
             return "Image not found", 404
         
-        filepath = result[0]
+        filepath = result[1]
         if not os.path.exists(filepath):
             print(f"Image file not found: {filepath}")
+            file_status_cache.put(filepath, False)
             return "Image file not found", 404
         
-        return send_file(filepath)
+        return file_server.response(filepath)
         
+    except PermissionError as e:
+        print(f"Forbidden image {image_id}: {e}")
+        return "Forbidden", 403
     except Exception as e:
         print(f"Error serving image {image_id}: {e}")
         return "Error serving image", 500
 
+@app.route('/api/image/<int:image_id>/thumb')
+def serve_thumbnail(image_id):
+    """
+    サムネイルを配信（?size= は THUMBNAIL_SIZES のいずれか）
+    ETag / Last-Modified は元ファイルの更新時刻から決まるため、304 はサムネイルを開かずに返せる
+    """
+    try:
+        try:
+            size = validate_thumbnail_size(request.args.get('size', DEFAULT_THUMBNAIL_SIZE))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        result = db.get_image(image_id)
+        if not result:
+            return "Image not found", 404
+        
+        filepath = result[1]
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            print(f"Image file not found: {filepath}")
+            file_status_cache.put(filepath, False)
+            return "Image file not found", 404
+        
+        etag = thumbnail_etag(image_id, size, stat.st_mtime_ns)
+        last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+        max_age = app.config['THUMBNAIL_MAX_AGE']
+        # send_file と同じ判定で、変更がなければサムネイルを作らずに 304 を返す
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return app.response_class(status=304, headers={
+                'ETag': f'"{etag}"',
+                'Last-Modified': http_date(last_modified),
+                'Cache-Control': f"public, max-age={max_age}",
+            })
+        
+        # 通常の応答の 304・Range は配信方法（send_file / 前段のサーバー）が同じ ETag と Last-Modified で処理する
+        thumbnail_path = thumbnail_cache.get(image_id, filepath, size, stat.st_mtime_ns)
+        return file_server.response(thumbnail_path, thumbnail_cache.mimetype, etag=etag,
+                                    last_modified=last_modified, max_age=max_age)
+        
+    except PermissionError as e:
+        print(f"Forbidden thumbnail {image_id}: {e}")
+        return "Forbidden", 403
+    except Exception as e:
+        print(f"Error serving thumbnail {image_id}: {e}")
+        return "Error serving thumbnail", 500
+
 @app.route('/api/image/<int:image_id>/tags')
 def get_image_tags(image_id):
     """特定の画像のタグ情報を取得"""
@@ -192,63 +499,97 @@ def get_image_tags(image_id):
         print(f"Error getting tags for image {image_id}: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/images/tags')
+def get_images_tags():
+    """複数画像のタグ情報をまとめて取得（ids: カンマ区切りの画像ID）"""
+    try:
+        try:
+            image_ids = [int(image_id) for image_id in request.args.get('ids', '').split(',') if image_id.strip()]
+        except ValueError:
+            return jsonify({'error': 'ids must be comma-separated integers'}), 400
+        image_ids = list(dict.fromkeys(image_ids))
+        if not image_ids:
+            return jsonify({'error': 'At least one image id is required'}), 400
+        if len(image_ids) > app.config['MAX_TAG_BATCH']:
+            return jsonify({'error': f"Too many ids (max {app.config['MAX_TAG_BATCH']})"}), 400
+        
+        tags = db.get_tags_for_images(image_ids)
+        # JSON のキーは文字列になる
+        return jsonify({'tags': {str(image_id): image_tags for image_id, image_tags in tags.items()}})
+    except Exception as e:
+        print(f"Error getting tags for images: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/tags/suggestions')
 def get_tag_suggestions():
     """タグの候補を取得"""
     try:
-        query = request.args.get('q', '').lower()
+        query = request.args.get('q', '').lower().strip()
+        limit = 20
         
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT tag_name, COUNT(it.image_id) as usage_count
-            FROM tags t
-            LEFT JOIN image_tags it ON t.id = it.tag_id
-            WHERE t.tag_name LIKE ?
-            GROUP BY t.tag_name
-            ORDER BY usage_count DESC, t.tag_name
-            LIMIT 20
-        ''', (f'%{query}%',))
+        # 1段目: プレフィックス木による前方一致
+        autocomplete.refresh()
+        matches = autocomplete.prefix_matches(query, limit)
+        source = 'trie'
         
-        suggestions = [{'tag': row[0], 'count': row[1]} for row in cursor.fetchall()]
-        conn.close()
+        # 2段目: 部分一致（FTS5 trigram、使えなければインメモリ走査）で補う
+        if query and len(matches) < limit:
+            seen = {tag for tag, _ in matches}
+            if db.tag_fts_available and len(query) >= 3:
+                extra, extra_source = db.search_tags_substring(query, limit + len(matches))
+            else:
+                extra, extra_source = autocomplete.substring_matches(query, limit - len(matches)), 'scan'
+            matches += [(tag, count) for tag, count in extra if tag not in seen][:limit - len(matches)]
+            source += f'+{extra_source}'
         
-        return jsonify(suggestions)
+        suggestions = [{'tag': tag, 'count': count} for tag, count in matches]
+        
+        return jsonify({'suggestions': suggestions, 'source': source})
         
     except Exception as e:
         print(f"Error getting tag suggestions: {e}")
-        return jsonify([])
+        return jsonify({'suggestions': [], 'source': 'error'})
+
+@app.route('/api/tags/related')
+def get_related_tags():
+    """
+    指定タグ（カンマ区切り）と一緒に付いていることが多いタグを取得（検索の絞り込み候補）
+    タグ共起行列（python database.py build-cooccurrence）から引くため、未作成なら空になる
+    """
+    try:
+        start_time = time.time()
+        tags = [parse_tag_spec(tag.strip().lower())[0] for tag in request.args.get('tags', '').split(',') if tag.strip()]
+        tags = list(dict.fromkeys(tags))
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        if not tags:
+            return jsonify({'error': 'At least one tag is required'}), 400
+        
+        # 件数に対する割合は、指定タグのうち最も少ないタグの画像数を基準にする
+        tag_counts = db.get_tag_counts(tags)
+        base_count = min(tag_counts.values()) if len(tag_counts) == len(tags) else 0
+        related = [
+            {'tag': tag, 'count': count, 'ratio': count / base_count if base_count else 0.0}
+            for tag, count in db.get_related_tags(tags, limit)
+        ]
+        return jsonify({'tags': tags, 'related': related, 'time': time.time() - start_time})
+        
+    except Exception as e:
+        print(f"Error getting related tags: {e}")
+        return jsonify({'error': str(e)}), 500
 
 # デバッグ用エンドポイント
 @app.route('/api/debug/stats')
 def debug_stats():
     """データベースの統計情報"""
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # 基本統計
-        cursor.execute('SELECT COUNT(*) FROM images')
-        image_count = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM tags')
-        tag_count = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM image_tags')
-        relation_count = cursor.fetchone()[0]
+        # 基本統計（集計テーブルから取得）
+        counters = db.get_counters()
+        image_count = counters.get('images', 0)
+        tag_count = counters.get('tags', 0)
+        relation_count = counters.get('relations', 0)
         
         # よく使われるタグ
-        cursor.execute('''
-            SELECT t.tag_name, COUNT(it.image_id) as count
-            FROM tags t
-            LEFT JOIN image_tags it ON t.id = it.tag_id
-            GROUP BY t.tag_name
-            ORDER BY count DESC
-            LIMIT 20
-        ''')
-        popular_tags = cursor.fetchall()
-        
-        conn.close()
+        popular_tags = db.get_popular_tags(20)
         
         return jsonify({
             'image_count': image_count,
@@ -264,21 +605,18 @@ def debug_stats():
 def debug_images():
     """画像一覧（デバッグ用）"""
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, filename, filepath FROM images LIMIT 10')
-        images = cursor.fetchall()
-        conn.close()
+        images = db.get_images(10)
+        file_exists = file_status_cache.check_many([filepath for _, filepath, _ in images])
+        image_tags = db.get_tags_for_images([img_id for img_id, _, _ in images])
         
         result = []
-        for img_id, filename, filepath in images:
-            tags = db.get_image_tags(img_id)
+        for img_id, filepath, filename in images:
             result.append({
                 'id': img_id,
                 'filename': filename,
                 'filepath': filepath,
-                'tags': tags,
-                'file_exists': os.path.exists(filepath)
+                'tags': [tag['tag'] for tag in image_tags[img_id]],
+                'file_exists': file_exists[filepath]
             })
         
         return jsonify(result)
@@ -0,0 +1,173 @@
+# autocomplete.py
+"""
+タグ自動補完インデックス
+tags と tag_stats からプレフィックス木を構築し、各ノードに使用数上位k件を事前計算しておく
+プレフィックス検索は O(len(q))、部分一致は使用数順の全件走査による2段目として扱う
+"""
+
+import bisect
+import threading
+import time
+from typing import Dict, List, Tuple
+
+
+class _TrieNode:
+    __slots__ = ("children", "top", "tag")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        # このノードで終わるタグ名（なければ None）
+        self.tag = None
+        # (-使用数, タグ名) の昇順 = 使用数の降順、同数ならタグ名順
+        self.top: List[Tuple[int, str]] = []
+
+
+class TagAutocomplete:
+    def __init__(self, db, top_k: int = 20, refresh_interval: float = 5.0):
+        """
+        db: ImageDatabase インスタンス
+        top_k: 各プレフィックスで保持する候補数
+        refresh_interval: データベースの更新を確認する間隔（秒）
+        """
+        self.db = db
+        self.top_k = top_k
+        self.refresh_interval = refresh_interval
+        self.counts: Dict[str, int] = {}
+        self._root = _TrieNode()
+        self._ranked: List[Tuple[int, str]] = []
+        self._lock = threading.Lock()
+        # get_tag_changes に渡す前回の読み出し位置と、更新の有無を確認するための世代
+        self._token = None
+        self._generation = None
+        self._last_check = 0.0
+
+    def build(self):
+        """全タグからプレフィックス木を構築"""
+        build_start = time.time()
+        generation = self.db.get_generation()
+        rows, token, _ = self.db.get_tag_changes()
+        counts = dict(rows)
+
+        # 使用数順に挿入すると、各ノードの上位k件は先着k件になる
+        ranked = sorted((-count, tag) for tag, count in counts.items())
+        root = _TrieNode()
+        for entry in ranked:
+            node = root
+            for ch in entry[1]:
+                node = node.children.setdefault(ch, _TrieNode())
+                if len(node.top) < self.top_k:
+                    node.top.append(entry)
+            node.tag = entry[1]
+
+        with self._lock:
+            self.counts = counts
+            self._root = root
+            self._ranked = ranked
+            self._token = token
+            self._generation = generation
+            self._last_check = time.time()
+
+        print(f"タグ補完インデックス構築完了: {len(counts)}タグ ({time.time() - build_start:.4f}秒)")
+
+    def refresh(self):
+        """データベースの世代が進んでいれば、前回以降に使用数が変わったタグだけを読み出してインデックスに反映"""
+        if self._token is None:
+            self.build()
+            return
+
+        now = time.time()
+        if now - self._last_check < self.refresh_interval:
+            return
+        self._last_check = now
+
+        generation = self.db.get_generation()
+        if generation == self._generation:
+            return
+        rows, token, tag_count = self.db.get_tag_changes(self._token)
+
+        with self._lock:
+            changed = [(tag, count) for tag, count in rows if self.counts.get(tag) != count]
+            # 部分一致の走査はロックを取らないため、使用数順の一覧は写しを更新して差し替える
+            ranked = list(self._ranked)
+            for tag, count in changed:
+                old_count = self.counts.get(tag)
+                if old_count is not None:
+                    del ranked[bisect.bisect_left(ranked, (-old_count, tag))]
+                bisect.insort(ranked, (-count, tag))
+                self._update(tag, count)
+            self._ranked = ranked
+            self._token = token
+            self._generation = generation
+            removed = len(self.counts) != tag_count
+
+        if removed:
+            # 差分には削除されたタグが現れないため、タグ数が合わなければ作り直す
+            self.build()
+        elif changed:
+            print(f"タグ補完インデックスを更新: 変更{len(changed)}件 (読み出し{len(rows)}件)")
+
+    def _update(self, tag: str, count):
+        """1タグの使用数をプレフィックス上の各ノードに反映（count=None で削除）"""
+        old_count = self.counts.pop(tag, None)
+        if count is not None:
+            self.counts[tag] = count
+        old_entry = (-old_count, tag) if old_count is not None else None
+        new_entry = (-count, tag) if count is not None else None
+
+        path = []
+        node = self._root
+        for ch in tag:
+            node = node.children.setdefault(ch, _TrieNode())
+            path.append(node)
+        node.tag = tag if count is not None else None
+
+        # 子ノードの上位k件を先に確定させるため、葉側から根に向かって更新する
+        for node in reversed(path):
+            top = node.top
+            was_full = len(top) >= self.top_k
+            removed = False
+            if old_entry is not None:
+                index = bisect.bisect_left(top, old_entry)
+                if index < len(top) and top[index] == old_entry:
+                    del top[index]
+                    removed = True
+            if removed and was_full and (new_entry is None or new_entry > old_entry):
+                # 満杯のリストで順位が下がった場合、圏外の候補が繰り上がる可能性があるため再計算
+                node.top = self._collect_top(node)
+            elif new_entry is not None:
+                bisect.insort(top, new_entry)
+                del top[self.top_k:]
+
+    def _collect_top(self, node: _TrieNode) -> List[Tuple[int, str]]:
+        """このノードで終わるタグと子ノードの上位k件から、ノードの上位k件を再計算"""
+        candidates = []
+        if node.tag is not None and node.tag in self.counts:
+            candidates.append((-self.counts[node.tag], node.tag))
+        for child in node.children.values():
+            candidates.extend(child.top)
+        return sorted(candidates)[:self.top_k]
+
+    def prefix_matches(self, query: str, limit: int = 20) -> List[Tuple[str, int]]:
+        """前方一致の候補を使用数順に取得（事前計算済みの上位k件を返すだけ）"""
+        query = query.lower().strip()
+        if not query:
+            return []
+
+        with self._lock:
+            node = self._root
+            for ch in query:
+                node = node.children.get(ch)
+                if node is None:
+                    return []
+            # 各ノードは上位 top_k 件しか保持しない
+            return [(tag, -neg_count) for neg_count, tag in node.top[:min(limit, self.top_k)]]
+
+    def substring_matches(self, query: str, limit: int) -> List[Tuple[str, int]]:
+        """前方一致しない部分一致の候補を使用数順に取得（全件走査の2段目）"""
+        results = []
+        for neg_count, tag in self._ranked:
+            if query in tag and not tag.startswith(query):
+                results.append((tag, -neg_count))
+                if len(results) >= limit:
+                    break
+        return results
@@ -1,16 +1,105 @@
-import sqlite3
 import os
-from collections import Counter
+import re
+import json
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from database import ImageDatabase
 
-def check_data_integrity(db_path="image_search.db"):
-    """データベースの整合性をチェック"""
+# ファイル確認の既定スレッド数（ネットワークストレージでは待ち時間が大半のためCPU数より多くする）
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# 確認するファイルがこれ未満のディレクトリは一覧を取らず個別に stat する
+SCANDIR_MIN_FILES = 8
+
+# 記録を更新する1トランザクションあたりの件数
+STATUS_CHUNK = 10000
+
+# --since の相対指定（例: 12h, 7d）
+SINCE_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)([smhd])$')
+SINCE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_since(value: str) -> float:
+    """--since の値（"7d" などの相対指定または ISO 8601 の日時）を UNIX 時刻にする（不正な値は ValueError）"""
+    match = SINCE_PATTERN.match(value.strip())
+    if match:
+        return time.time() - float(match.group(1)) * SINCE_UNITS[match.group(2)]
+    return datetime.fromisoformat(value.strip()).timestamp()
+
+
+def _stat_directory(directory, names):
+    """
+    1つのディレクトリ内のファイルの (サイズ, 更新時刻) を返す（ThreadPoolExecutor のワーカーで実行）
+    確認するファイルが多いディレクトリは os.scandir の1回の一覧でまとめて判定する
+    戻り値: ファイル名 → (size, mtime)、存在しないファイルは None
+    """
+    found = {}
+    if len(names) >= SCANDIR_MIN_FILES:
+        wanted = set(names)
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name in wanted:
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        found[entry.name] = (stat.st_size, stat.st_mtime)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+    else:
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            found[name] = (stat.st_size, stat.st_mtime)
+    return {name: found.get(name) for name in names}
+
+
+def check_files(rows, workers=DEFAULT_WORKERS):
+    """
+    (image_id, filepath) の各ファイルをディレクトリ単位でまとめてスレッドプールで確認
+    戻り値: image_id → (size, mtime)、存在しないファイルは None
+    """
+    by_directory = defaultdict(list)
+    for image_id, filepath in rows:
+        directory, name = os.path.split(filepath)
+        by_directory[directory].append((image_id, name))
+    
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            directory: executor.submit(_stat_directory, directory, [name for _, name in entries])
+            for directory, entries in by_directory.items()
+        }
+        for directory, future in futures.items():
+            statuses = future.result()
+            for image_id, name in by_directory[directory]:
+                results[image_id] = statuses[name]
+    return results
+
+
+def check_data_integrity(db_path="image_search.db", since=None, workers=DEFAULT_WORKERS, report_path=None):
+    """
+    データベースの整合性をチェック
+    since: UNIX 時刻。これ以降に確認済みの画像はファイルを確認せず前回の記録を使う（増分チェック）
+    workers: ファイル確認のスレッド数
+    report_path: 指定すると結果を JSON で書き出す
+    戻り値: 結果の dict（report_path に書き出す内容と同じ）
+    """
     print("データベース整合性チェックを開始...")
     print("=" * 60)
     
-    conn = sqlite3.connect(db_path)
+    # 取り込み中でも WAL・busy_timeout が効くよう、ImageDatabase の接続を使う
+    db = ImageDatabase(db_path)
+    conn = db.get_connection()
     cursor = conn.cursor()
     
     issues_found = False
+    report = {'db_path': db_path, 'checked_at': time.time(), 'since': since, 'issues': {}, 'stats': {}}
     
     try:
         # 1. 基本統計情報
@@ -26,6 +115,7 @@ def check_data_integrity(db_path="image_search.db"):
         cursor.execute("SELECT COUNT(*) FROM image_tags")
         relation_count = cursor.fetchone()[0]
         print(f"画像-タグ関連数: {relation_count:,}")
+        report['stats'].update({'images': image_count, 'tags': tag_count, 'relations': relation_count})
         
         # 2. 孤立したタグの確認
         print("\n【孤立したタグの確認】")
@@ -49,27 +139,70 @@ def check_data_integrity(db_path="image_search.db"):
             """)
             examples = cursor.fetchall()
             print(f"  例: {[row[0] for row in examples]}")
+            report['issues']['orphan_tags'] = {'count': orphan_tags, 'examples': [row[0] for row in examples]}
             issues_found = True
         else:
             print("OK: 孤立したタグなし")
         
-        # 3. 存在しない画像ファイルの確認
+        # 3. 存在しない画像ファイルの確認（前回の記録が since 以降の画像は確認しない）
         print("\n【存在しない画像ファイルの確認】")
-        cursor.execute("SELECT id, filepath, filename FROM images")
+        ImageDatabase._create_file_status_table(cursor)
+        cursor.execute("""
+            SELECT i.id, i.filepath, i.filename, s.size, s.mtime, s.last_checked
+            FROM images i
+            LEFT JOIN file_status s ON s.image_id = i.id
+        """)
+        images = cursor.fetchall()
+        to_check = [(image_id, filepath) for image_id, filepath, _, _, _, last_checked in images
+                    if since is None or last_checked is None or last_checked < since]
+        
+        check_start = time.time()
+        checked = check_files(to_check, workers) if to_check else {}
+        check_time = time.time() - check_start
+        print(f"ファイル確認: {len(to_check):,}件 / スキップ（{'前回の記録を使用' if since else '-'}）: "
+              f"{len(images) - len(to_check):,}件 ({check_time:.2f}秒, {workers}スレッド)")
+        
         missing_files = []
-        for image_id, filepath, filename in cursor.fetchall():
-            if not os.path.exists(filepath):
+        changed_files = []
+        for image_id, filepath, filename, size, mtime, last_checked in images:
+            if image_id in checked:
+                current = checked[image_id]
+                # 前回は存在していたファイルのサイズ・更新時刻が変わっていれば変更として報告
+                if current is not None and size is not None and current != (size, mtime):
+                    changed_files.append((image_id, filepath, filename))
+            else:
+                current = None if size is None else (size, mtime)
+            if current is None:
                 missing_files.append((image_id, filepath, filename))
         
+        # 確認結果を記録（次回の --since で再確認を省略する）
+        checked_at = time.time()
+        status_rows = [(image_id, *(status or (None, None)), checked_at) for image_id, status in checked.items()]
+        for i in range(0, len(status_rows), STATUS_CHUNK):
+            cursor.executemany(
+                "INSERT OR REPLACE INTO file_status (image_id, size, mtime, last_checked) VALUES (?, ?, ?, ?)",
+                status_rows[i:i + STATUS_CHUNK])
+            conn.commit()
+        
+        report['stats'].update({'files_checked': len(to_check), 'files_skipped': len(images) - len(to_check),
+                                'file_check_time': check_time})
         if missing_files:
             print(f"WARNING: 存在しないファイル: {len(missing_files)}個")
             for i, (image_id, filepath, filename) in enumerate(missing_files[:5]):
                 print(f"  ID:{image_id} - {filename}")
             if len(missing_files) > 5:
                 print(f"  ... 他 {len(missing_files) - 5}個")
+            report['issues']['missing_files'] = [{'id': image_id, 'filepath': filepath}
+                                                 for image_id, filepath, _ in missing_files]
             issues_found = True
         else:
             print("OK: すべてのファイルが存在")
+        if changed_files:
+            print(f"INFO: 前回の確認から変更されたファイル: {len(changed_files)}個")
+            for image_id, filepath, filename in changed_files[:5]:
+                print(f"  ID:{image_id} - {filename}")
+            report['changed_files'] = [{'id': image_id, 'filepath': filepath}
+                                       for image_id, filepath, _ in changed_files]
         
         # 4. 画像-タグ関連の整合性確認
         print("\n【画像-タグ関連の整合性確認】")
@@ -85,6 +218,7 @@ def check_data_integrity(db_path="image_search.db"):
         invalid_image_refs = cursor.fetchone()[0]
         if invalid_image_refs > 0:
             print(f"WARNING: 存在しない画像を参照: {invalid_image_refs}個")
+            report['issues']['invalid_image_refs'] = invalid_image_refs
             issues_found = True
         else:
             print("OK: 画像参照OK")
@@ -100,6 +234,7 @@ def check_data_integrity(db_path="image_search.db"):
         invalid_tag_refs = cursor.fetchone()[0]
         if invalid_tag_refs > 0:
             print(f"WARNING: 存在しないタグを参照: {invalid_tag_refs}個")
+            report['issues']['invalid_tag_refs'] = invalid_tag_refs
             issues_found = True
         else:
             print("OK: タグ参照OK")
@@ -119,6 +254,8 @@ def check_data_integrity(db_path="image_search.db"):
             print(f"WARNING: 重複したファイルパス: {len(duplicate_paths)}個")
             for filepath, count in duplicate_paths[:5]:
                 print(f"  {filepath}: {count}回")
+            report['issues']['duplicate_paths'] = [{'filepath': filepath, 'count': count}
+                                                   for filepath, count in duplicate_paths]
             issues_found = True
         else:
             print("OK: ファイルパスの重複なし")
@@ -161,10 +298,48 @@ def check_data_integrity(db_path="image_search.db"):
         no_tag_images = cursor.fetchone()[0]
         if no_tag_images > 0:
             print(f"WARNING: タグのない画像: {no_tag_images}枚")
+            report['issues']['untagged_images'] = no_tag_images
             issues_found = True
         else:
             print("OK: すべての画像にタグあり")
         
+        # 集計テーブル（tag_stats / db_counters）の確認
+        print("\n【集計テーブルの確認】")
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'db_counters'")
+        if cursor.fetchone() is None:
+            print("WARNING: 集計テーブルがありません（python database.py rebuild-stats で作成）")
+            report['issues']['stats_tables'] = "missing"
+            issues_found = True
+        else:
+            cursor.execute("SELECT name, value FROM db_counters")
+            counters = dict(cursor.fetchall())
+            actual = {'images': image_count, 'tags': tag_count, 'relations': relation_count}
+            counter_mismatch = {name: (counters.get(name), value) for name, value in actual.items()
+                                if counters.get(name) != value}
+            cursor.execute("""
+                SELECT COUNT(*) FROM tags t
+                LEFT JOIN tag_stats s ON s.tag_id = t.id
+                WHERE COALESCE(s.image_count, -1) != (
+                    SELECT COUNT(*) FROM image_tags it
+                    WHERE it.tag_id = t.id
+                )
+            """)
+            stats_mismatch = cursor.fetchone()[0]
+            if counter_mismatch or stats_mismatch:
+                for name, (stored, value) in counter_mismatch.items():
+                    print(f"WARNING: 件数の不一致 {name}: 集計{stored} / 実数{value}")
+                if stats_mismatch:
+                    print(f"WARNING: 使用数が一致しないタグ: {stats_mismatch}個")
+                print("  python database.py rebuild-stats で再構築してください")
+                report['issues']['stats_tables'] = {
+                    'counters': {name: {'stored': stored, 'actual': value}
+                                 for name, (stored, value) in counter_mismatch.items()},
+                    'tag_stats_mismatch': stats_mismatch,
+                }
+                issues_found = True
+            else:
+                print("OK: 集計テーブルは実データと一致")
+        
         # 7. インデックスの確認
         print("\n【インデックスの確認】")
         cursor.execute("""
@@ -185,6 +360,7 @@ def check_data_integrity(db_path="image_search.db"):
             print("OK: データベース整合性OK")
         else:
             print(f"WARNING: 整合性エラー: {integrity_result}")
+            report['issues']['sqlite_integrity'] = integrity_result
             issues_found = True
         
         # 結果サマリー
@@ -198,8 +374,32 @@ def check_data_integrity(db_path="image_search.db"):
         print(f"\nエラーが発生しました: {e}")
         import traceback
         traceback.print_exc()
+        report['error'] = str(e)
     finally:
-        conn.close()
+        db.close_connections()
+    
+    report['issues_found'] = issues_found
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を {report_path} に保存しました")
+    return report
+
+def main():
+    """コマンドライン実行"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="画像検索データベースの整合性チェック")
+    parser.add_argument("--db", default="image_search.db", help="データベースファイルのパス")
+    parser.add_argument("--since", type=parse_since, default=None,
+                        help="この時刻以降に確認済みのファイルは再確認しない（例: 24h, 7d, 2024-01-31T12:00）")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="ファイル確認のスレッド数")
+    parser.add_argument("--json", dest="report_path", default=None, help="結果を書き出す JSON ファイル")
+    args = parser.parse_args()
+    
+    report = check_data_integrity(args.db, since=args.since, workers=args.workers, report_path=args.report_path)
+    # 問題があれば終了コード1（cron などから判定できるように）
+    raise SystemExit(1 if report['issues_found'] else 0)
 
 if __name__ == "__main__":
-    check_data_integrity()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,88 @@
+# conftest.py
+"""テスト用のデータベース（人数タグと一般タグを信頼度付きでランダムに付けた画像）と共通の検索ヘルパー、Web API のクライアント"""
+
+import random
+
+import pytest
+
+from database import ImageDatabase
+
+GROUP_TAG_NAMES = ["1girl", "2girls", "multiple_girls", "1boy", "2boys", "multiple_boys", "solo"]
+GENERAL_TAG_NAMES = [f"tag{i}" for i in range(16)]
+THRESHOLDS = ("", "", ">0.5", ">0.8")
+
+
+def build_database(path: str, image_count: int = 600, seed: int = 0) -> str:
+    """人数タグ1〜2個と一般タグ1〜6個を付けた画像を登録したデータベースを作成"""
+    rng = random.Random(seed)
+    items = []
+    for i in range(image_count):
+        tags = rng.sample(GROUP_TAG_NAMES, rng.randint(1, 2)) + rng.sample(GENERAL_TAG_NAMES, rng.randint(1, 6))
+        items.append((f"/img/{i % 7}/{i}.jpg", [(tag, round(rng.uniform(0.3, 1.0), 4)) for tag in tags]))
+    db = ImageDatabase(path)
+    db.add_images_with_tags_batch(items)
+    db.close_connections()
+    return path
+
+
+def random_queries(count, seed=0):
+    """ポジティブ・ネガティブ（人数タグを含む）・しきい値・検索モード・並び順を組み合わせたクエリ"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        positive = [tag + rng.choice(THRESHOLDS)
+                    for tag in rng.sample(GENERAL_TAG_NAMES + GROUP_TAG_NAMES, rng.randint(1, 3))]
+        negative = ([tag + rng.choice(THRESHOLDS) for tag in rng.sample(GENERAL_TAG_NAMES, rng.randint(0, 2))]
+                    + rng.sample(GROUP_TAG_NAMES, rng.randint(0, 3)))
+        yield positive, negative, rng.choice(("any", "all")), rng.choice(("count", "confidence"))
+
+
+def paginate(db, positive, negative, mode, rank, page_size):
+    """キーセットページングで全件を取得（前ページ最後の (match_count, id) から続ける）"""
+    rows, after = [], None
+    while True:
+        page = db.search_images(positive, negative, page_size, after, mode, rank)
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        after = (page[-1][3], page[-1][0])
+
+
+@pytest.fixture(scope="session")
+def search_db_path(tmp_path_factory):
+    return build_database(str(tmp_path_factory.mktemp("search") / "image_search.db"))
+
+
+@pytest.fixture(scope="session")
+def engines(search_db_path):
+    """同じデータを検索する各エンジン"""
+    return {engine: ImageDatabase(search_db_path, search_engine=engine) for engine in ("sql", "bitmap", "auto")}
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """画像ファイルとデータベースを置いたディレクトリを作業ディレクトリにして app を読み込む"""
+    from PIL import Image
+
+    root = tmp_path_factory.mktemp("app")
+    image_dir = root / "images"
+    image_dir.mkdir()
+    items = []
+    for i in range(12):
+        path = image_dir / f"{i}.jpg"
+        Image.new("RGB", (64 + i, 48), (i * 20, 100, 200)).save(path)
+        items.append((str(path), ["sky", "cloud"] if i % 2 else ["sky"]))
+    db = ImageDatabase(str(root / "image_search.db"))
+    db.add_images_with_tags_batch(items)
+    db.close_connections()
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(root)
+        patch.setenv("IMAGE_ROOTS", str(image_dir))
+        patch.setenv("THUMBNAIL_DIR", str(root / "thumbnail_cache"))
+        import app
+        yield app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
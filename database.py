@@ -1,30 +1,212 @@
 # database.py (修正版)
 import sqlite3
 import os
+import re
 import time
-from typing import List, Tuple
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.request import pathname2url
+from query_planner import QueryPlanner
+from tags import GROUP_TAG_BITS
+
+# IN句1回あたりのプレースホルダ数（SQLiteの変数上限対策）
+IN_CHUNK = 900
+
+# iter_search_images がカーソルから1回に読み出す行数
+STREAM_BATCH = 500
+
+# db_counters で管理する全体件数と、再集計時の対象テーブル
+COUNTER_TABLES = {
+    "images": "images",
+    "tags": "tags",
+    "relations": "image_tags",
+}
+# generation はデータが変わるトランザクションごとに1つ増える（キャッシュ・インデックスの無効化用）
+COUNTER_NAMES = tuple(COUNTER_TABLES) + ("generation",)
+
+# 検索モード: "any"（いずれかのタグを含む・一致数順）/ "all"（すべてのタグを含む）
+SEARCH_MODES = ("any", "all")
+
+# 検索結果の並び順: "count"（一致タグ数）/ "confidence"（一致タグの信頼度の合計）
+SEARCH_RANKS = ("count", "confidence")
+
+# 信頼度のしきい値付きタグ指定（例: "long_hair>0.8" は信頼度が0.8より大きい long_hair のみ一致）
+TAG_SPEC_PATTERN = re.compile(r'^(.+?)\s*>\s*((?:[01](?:\.\d+)?|\.\d+))$')
+
+
+def parse_tag_spec(spec: str) -> Tuple[str, Optional[float]]:
+    """タグ指定を (タグ名, 信頼度のしきい値) に分解（しきい値がなければ None）"""
+    spec = spec.lower().strip()
+    match = TAG_SPEC_PATTERN.match(spec)
+    if match:
+        return match.group(1).strip(), float(match.group(2))
+    return spec, None
+
+
+def parse_tag_specs(specs: List[str]) -> Dict[str, Optional[float]]:
+    """タグ指定のリストを {タグ名: しきい値} にまとめる（同じタグが複数あれば厳しい方を採用）"""
+    parsed = {}
+    for spec in specs:
+        tag, min_confidence = parse_tag_spec(spec)
+        if not tag:
+            continue
+        if tag in parsed and parsed[tag] is not None:
+            if min_confidence is None or min_confidence < parsed[tag]:
+                min_confidence = parsed[tag]
+        parsed[tag] = min_confidence
+    return parsed
+
+
+# search_images で選択できる検索エンジン（"auto" はクエリプランナーがクエリごとに選択）
+SEARCH_ENGINES = ("sql", "bitmap", "auto")
+
+# 接続ごとに設定するPRAGMA（用途別プロファイル）
+# journal_mode=WAL はデータベースファイルに保存されるため init_database で1回だけ設定する
+CONNECTION_PROFILES = {
+    # Web配信向け: 読み取り主体、ページキャッシュとmmapを大きめに取る
+    "serving": {
+        "synchronous": "NORMAL",
+        "cache_size": -65536,        # 64MB（負の値はKiB単位）
+        "mmap_size": 268435456,      # 256MB
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    # 一括登録向け: fsyncを省略し、キャッシュを最大限に取る
+    "bulk_ingest": {
+        "synchronous": "OFF",
+        "cache_size": -262144,       # 256MB
+        "mmap_size": 1073741824,     # 1GB
+        "temp_store": "MEMORY",
+        "busy_timeout": 30000,
+    },
+}
 
 class ImageDatabase:
-    def __init__(self, db_path: str = "image_search.db"):
+    def __init__(self, db_path: str = "image_search.db", search_engine: str = "sql",
+                 profile: str = "serving", read_only: bool = False, snapshot_dir: str = None):
+        """
+        search_engine: "sql"（JOIN + GROUP BY）、"bitmap"（インメモリのポスティングリスト）、
+                       "auto"（タグのカーディナリティからクエリごとに選択）
+        profile: 接続のPRAGMAプロファイル（CONNECTION_PROFILES のキー）
+        read_only: True の場合、get_connection() の既定を読み取り専用接続にする（Web配信用）
+        snapshot_dir: インメモリエンジンが memmap で開くインデックススナップショットのディレクトリ
+        """
+        if search_engine not in SEARCH_ENGINES:
+            raise ValueError(f"未対応の検索エンジン: {search_engine}")
+        if profile not in CONNECTION_PROFILES:
+            raise ValueError(f"未対応の接続プロファイル: {profile}")
         self.db_path = db_path
+        self.search_engine = search_engine
+        self.profile = profile
+        self.read_only = read_only
+        self.snapshot_dir = snapshot_dir
+        self._local = threading.local()
+        self._bitmap_engine = None
+        self.planner = QueryPlanner(self, search_engine)
+        # tag_name → id のキャッシュ（最初の一括登録時に tags テーブルから読み込む）
+        self._tag_cache = None
+        self._tag_cache_lock = threading.Lock()
+        # タグ名の部分一致用 FTS5 trigram インデックスが使えるか（init_database で判定）
+        self.tag_fts_available = False
+        # images.group_mask が全画像で計算済みか（init_database で判定）
+        self.group_mask_ready = False
         self.init_database()
         self.optimize_database()
     
-    def get_connection(self):
-        return sqlite3.connect(self.db_path)
+    def _connect(self, read_only: bool = False):
+        """新しい接続を作成してプロファイルのPRAGMAを適用"""
+        if read_only:
+            uri = f"file:{pathname2url(os.path.abspath(self.db_path))}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True)
+        else:
+            conn = sqlite3.connect(self.db_path)
+        for name, value in CONNECTION_PROFILES[self.profile].items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+    
+    def get_connection(self, read_only: bool = None):
+        """スレッドごとにプールされた接続を取得（呼び出し側で close() しないこと）"""
+        if read_only is None:
+            read_only = self.read_only
+        key = "ro_conn" if read_only else "rw_conn"
+        conn = getattr(self._local, key, None)
+        if conn is None:
+            conn = self._connect(read_only)
+            setattr(self._local, key, conn)
+        return conn
+    
+    def close_connections(self):
+        """現在のスレッドでプールしている接続を閉じる"""
+        for key in ("ro_conn", "rw_conn"):
+            conn = getattr(self._local, key, None)
+            if conn is not None:
+                conn.close()
+                setattr(self._local, key, None)
+    
+    def set_profile(self, profile: str):
+        """接続プロファイルを切り替える（以降に作成される接続から適用）"""
+        if profile not in CONNECTION_PROFILES:
+            raise ValueError(f"未対応の接続プロファイル: {profile}")
+        self.close_connections()
+        self.profile = profile
+    
+    @contextmanager
+    def transaction(self):
+        """書き込み用接続で1トランザクションを実行（例外時はロールバック）"""
+        conn = self.get_connection(read_only=False)
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
     
     def init_database(self):
         """データベースとテーブルを初期化"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
+        # WALモード: 書き込み中も読み取りがブロックされない（設定はファイルに保存される）
+        cursor.execute('PRAGMA journal_mode = WAL')
+        
+        self._create_tables(cursor)
+        self._create_indexes(cursor)
+        
+        # 集計テーブル（既存データベースの場合は作成時に再集計する）
+        if self._create_stats_tables(cursor):
+            print("集計テーブルを作成したため再集計します...")
+            self._rebuild_stats(cursor)
+        
+        # タグ名の部分一致検索用インデックス（FTS5 trigram が使えない環境では作成しない）
+        self.tag_fts_available = self._create_tag_fts(cursor)
+        
+        # タグ共起行列（python database.py build-cooccurrence で作成）
+        self._create_cooccurrence_tables(cursor)
+        
+        # 画像ファイルの確認結果（check_data_integrity.py が記録）
+        self._create_file_status_table(cursor)
+        
+        # 人数タグのビットマスク（既存データベースは python database.py backfill-group-mask で有効化）
+        self.group_mask_ready = self._create_group_mask(cursor)
+        if not self.group_mask_ready:
+            print("group_mask が未計算のため人数タグの除外は NOT EXISTS で判定します"
+                  "（python database.py backfill-group-mask で有効化）")
+        
+        conn.commit()
+        conn.close()
+    
+    @staticmethod
+    def _create_tables(cursor):
+        """images / tags / image_tags テーブルを作成（インデックスは _create_indexes で作成）"""
         # 画像テーブル
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS images (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             filepath TEXT NOT NULL UNIQUE,
             filename TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            group_mask INTEGER NOT NULL DEFAULT 0
         )
         ''')
         
@@ -48,7 +230,10 @@ class ImageDatabase:
             UNIQUE(image_id, tag_id)
         )
         ''')
-        
+    
+    @staticmethod
+    def _create_indexes(cursor):
+        """検索用インデックスを作成（一括コピーではデータ投入後に呼ぶ）"""
         # 既存のインデックスを削除（再構築のため）
         cursor.execute('DROP INDEX IF EXISTS idx_tags_tag_name')
         cursor.execute('DROP INDEX IF EXISTS idx_image_tags_image_id')
@@ -72,12 +257,439 @@ class ImageDatabase:
         ON image_tags(image_id)
         ''')
         
-        conn.commit()
-        conn.close()
+        # 信頼度のしきい値付き検索（tag_id = ? AND confidence > ?）を範囲走査にするカバーリングインデックス
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_it_tagid_confidence
+        ON image_tags(tag_id, confidence, image_id)
+        ''')
+    
+    def _create_stats_tables(self, cursor):
+        """タグ使用数・全体件数の集計テーブルと更新トリガーを作成（新規作成時は True を返す）"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'db_counters'")
+        created = cursor.fetchone() is None
+        
+        # タグごとの使用画像数（updated_generation: 最後に使用数が変わったときの世代。補完インデックスの差分更新用）
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_stats (
+            tag_id INTEGER PRIMARY KEY,
+            image_count INTEGER NOT NULL DEFAULT 0,
+            updated_generation INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        cursor.execute('PRAGMA table_info(tag_stats)')
+        if 'updated_generation' not in {row[1] for row in cursor.fetchall()}:
+            # 既存データベース: 列を追加し、tag_stats を更新するトリガーを作り直す
+            cursor.execute('ALTER TABLE tag_stats ADD COLUMN updated_generation INTEGER NOT NULL DEFAULT 0')
+            for trigger in ('trg_tags_insert', 'trg_image_tags_insert', 'trg_image_tags_delete'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        
+        # 人気タグの取得（ORDER BY image_count DESC）用
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tag_stats_count 
+        ON tag_stats(image_count)
+        ''')
+        
+        # 全体件数（images / tags / relations）
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS db_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        cursor.executemany('INSERT OR IGNORE INTO db_counters (name, value) VALUES (?, 0)',
+                           [(name,) for name in COUNTER_NAMES])
+        
+        # 登録・削除と同じトランザクション内で集計を更新するトリガー
+        cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS trg_images_insert AFTER INSERT ON images BEGIN
+            UPDATE db_counters SET value = value + 1 WHERE name = 'images';
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_images_delete AFTER DELETE ON images BEGIN
+            UPDATE db_counters SET value = value - 1 WHERE name = 'images';
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_tags_insert AFTER INSERT ON tags BEGIN
+            INSERT OR IGNORE INTO tag_stats (tag_id, image_count, updated_generation)
+            VALUES (NEW.id, 0, (SELECT value FROM db_counters WHERE name = 'generation'));
+            UPDATE db_counters SET value = value + 1 WHERE name = 'tags';
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_tags_delete AFTER DELETE ON tags BEGIN
+            DELETE FROM tag_stats WHERE tag_id = OLD.id;
+            UPDATE db_counters SET value = value - 1 WHERE name = 'tags';
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_image_tags_insert AFTER INSERT ON image_tags BEGIN
+            UPDATE tag_stats SET image_count = image_count + 1,
+                updated_generation = (SELECT value FROM db_counters WHERE name = 'generation')
+            WHERE tag_id = NEW.tag_id;
+            UPDATE db_counters SET value = value + 1 WHERE name = 'relations';
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_image_tags_delete AFTER DELETE ON image_tags BEGIN
+            UPDATE tag_stats SET image_count = image_count - 1,
+                updated_generation = (SELECT value FROM db_counters WHERE name = 'generation')
+            WHERE tag_id = OLD.tag_id;
+            UPDATE db_counters SET value = value - 1 WHERE name = 'relations';
+        END;
+        ''')
+        return created
+    
+    def _create_tag_fts(self, cursor):
+        """tags と同期する FTS5 trigram 仮想テーブルを作成（利用できれば True を返す）"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tags_fts'")
+        if cursor.fetchone() is None:
+            try:
+                cursor.execute('''
+                CREATE VIRTUAL TABLE tags_fts USING fts5(
+                    tag_name, content='tags', content_rowid='id', tokenize='trigram'
+                )
+                ''')
+            except sqlite3.OperationalError as e:
+                print(f"FTS5 trigram が利用できないため部分一致インデックスは作成しません: {e}")
+                return False
+            # 既存のタグを取り込む
+            cursor.execute("INSERT INTO tags_fts (tags_fts) VALUES ('rebuild')")
+        
+        # タグの登録・削除と同じトランザクションで同期する
+        cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS trg_tags_fts_insert AFTER INSERT ON tags BEGIN
+            INSERT INTO tags_fts (rowid, tag_name) VALUES (NEW.id, NEW.tag_name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_tags_fts_delete AFTER DELETE ON tags BEGIN
+            INSERT INTO tags_fts (tags_fts, rowid, tag_name) VALUES ('delete', OLD.id, OLD.tag_name);
+        END;
+        ''')
+        return True
+    
+    @staticmethod
+    def _create_cooccurrence_tables(cursor):
+        """タグ共起行列（両方向のペアと共起画像数）と作成時の情報のテーブルを作成"""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_cooccurrence (
+            tag_a INTEGER NOT NULL,
+            tag_b INTEGER NOT NULL,
+            pair_count INTEGER NOT NULL,
+            PRIMARY KEY (tag_a, tag_b)
+        ) WITHOUT ROWID
+        ''')
+        
+        # 1つのタグの関連タグを共起数の多い順に引く用
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cooccurrence_count
+        ON tag_cooccurrence(tag_a, pair_count)
+        ''')
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cooccurrence_info (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL
+        )
+        ''')
+    
+    @staticmethod
+    def _create_file_status_table(cursor):
+        """画像ファイルの最後の確認結果（サイズ・更新時刻、ファイルがなければ NULL）のテーブルを作成"""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_status (
+            image_id INTEGER PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            last_checked REAL NOT NULL
+        )
+        ''')
+    
+    @staticmethod
+    def _create_group_mask(cursor):
+        """
+        images.group_mask（画像に付いている GROUPS タグのビットの OR）と、image_tags の登録・削除で
+        更新するトリガーを作成。全画像で計算済みなら True を返す
+        （既存データベースへの列の追加直後やビット割り当ての変更後は backfill_group_masks() まで False）
+        """
+        cursor.execute('PRAGMA table_info(images)')
+        if 'group_mask' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE images ADD COLUMN group_mask INTEGER NOT NULL DEFAULT 0')
+        
+        # マスクごとの画像数の集計（analyze_database.py）用
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_images_group_mask
+        ON images(group_mask)
+        ''')
+        
+        # ビットの割り当て（tags.GROUP_TAG_BITS）と計算済みフラグ
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_tags (
+            tag_name TEXT PRIMARY KEY,
+            bit INTEGER NOT NULL
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS db_settings (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        ''')
+        cursor.execute('SELECT tag_name, bit FROM group_tags')
+        if dict(cursor.fetchall()) != GROUP_TAG_BITS:
+            cursor.execute('DELETE FROM group_tags')
+            cursor.executemany('INSERT INTO group_tags (tag_name, bit) VALUES (?, ?)', GROUP_TAG_BITS.items())
+            cursor.execute("DELETE FROM db_settings WHERE name = 'group_mask_ready'")
+        
+        # 画像がなければ以降はトリガーだけで常に最新になる
+        cursor.execute('SELECT 1 FROM images LIMIT 1')
+        if cursor.fetchone() is None:
+            cursor.execute("INSERT OR REPLACE INTO db_settings (name, value) VALUES ('group_mask_ready', '1')")
+        
+        # 登録・削除と同じトランザクション内でビットを立てる・落とす（GROUPS 以外のタグでは何もしない）
+        cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS trg_group_mask_insert AFTER INSERT ON image_tags
+        WHEN EXISTS (SELECT 1 FROM tags t JOIN group_tags g ON g.tag_name = t.tag_name WHERE t.id = NEW.tag_id)
+        BEGIN
+            UPDATE images SET group_mask = group_mask | (
+                SELECT g.bit FROM tags t JOIN group_tags g ON g.tag_name = t.tag_name WHERE t.id = NEW.tag_id
+            ) WHERE id = NEW.image_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_group_mask_delete AFTER DELETE ON image_tags
+        WHEN EXISTS (SELECT 1 FROM tags t JOIN group_tags g ON g.tag_name = t.tag_name WHERE t.id = OLD.tag_id)
+        BEGIN
+            UPDATE images SET group_mask = group_mask & ~(
+                SELECT g.bit FROM tags t JOIN group_tags g ON g.tag_name = t.tag_name WHERE t.id = OLD.tag_id
+            ) WHERE id = OLD.image_id;
+        END;
+        ''')
+        
+        cursor.execute("SELECT 1 FROM db_settings WHERE name = 'group_mask_ready'")
+        return cursor.fetchone() is not None
+    
+    def backfill_group_masks(self):
+        """既存の画像の group_mask を image_tags から計算し直して有効にする（既存データベースの移行用）"""
+        start = time.time()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE images SET group_mask = 0 WHERE group_mask != 0')
+            # GROUPS タグごとに (tag_id, image_id) インデックスの範囲だけを読んでビットを立てる
+            cursor.execute('SELECT t.id, g.bit FROM group_tags g JOIN tags t ON t.tag_name = g.tag_name')
+            for tag_id, bit in cursor.fetchall():
+                cursor.execute('''
+                    UPDATE images SET group_mask = group_mask | ?
+                    WHERE id IN (SELECT image_id FROM image_tags WHERE tag_id = ?)
+                ''', (bit, tag_id))
+            cursor.execute("INSERT OR REPLACE INTO db_settings (name, value) VALUES ('group_mask_ready', '1')")
+            cursor.execute('SELECT COUNT(*) FROM images WHERE group_mask != 0')
+            masked = cursor.fetchone()[0]
+        self.group_mask_ready = True
+        print(f"group_mask の再計算が完了しました: 人数タグ付き {masked}件 ({time.time() - start:.2f}秒)")
+    
+    def _rebuild_stats(self, cursor):
+        """集計テーブルを image_tags から作り直す"""
+        cursor.execute('DELETE FROM tag_stats')
+        cursor.execute('''
+            INSERT INTO tag_stats (tag_id, image_count, updated_generation)
+            SELECT t.id, COUNT(it.image_id), (SELECT value FROM db_counters WHERE name = 'generation')
+            FROM tags t
+            LEFT JOIN image_tags it ON t.id = it.tag_id
+            GROUP BY t.id
+        ''')
+        for name, table in COUNTER_TABLES.items():
+            cursor.execute(f'UPDATE db_counters SET value = (SELECT COUNT(*) FROM {table}) WHERE name = ?', (name,))
+        self._bump_generation(cursor)
+    
+    @staticmethod
+    def _bump_generation(cursor):
+        """データベースの世代を進める（呼び出し元のトランザクション内で実行）"""
+        cursor.execute("UPDATE db_counters SET value = value + 1 WHERE name = 'generation'")
+    
+    def rebuild_stats(self):
+        """集計テーブルを再構築（既存データベースの移行・不整合の修復用）"""
+        start = time.time()
+        with self.transaction() as conn:
+            self._rebuild_stats(conn.cursor())
+        print(f"集計テーブルの再構築が完了しました ({time.time() - start:.2f}秒)")
+    
+    def get_counters(self):
+        """画像数・タグ数・関連数を集計テーブルから取得"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT name, value FROM db_counters')
+        return dict(cursor.fetchall())
+    
+    def get_generation(self) -> int:
+        """データベースの世代を取得（登録・削除のたびに増える）"""
+        cursor = self.get_connection().cursor()
+        cursor.execute("SELECT value FROM db_counters WHERE name = 'generation'")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    
+    def get_tag_changes(self, since: int = None):
+        """
+        世代 since 以降に使用数が変わったタグを取得（since=None で全タグ）
+        戻り値: ([(タグ名, 使用画像数)], 次回の since に渡す世代, 全タグ数)
+        削除されたタグは含まれないため、呼び出し側は全タグ数との差で検出する
+        """
+        cursor = self.get_connection().cursor()
+        # 先に世代を読むため、読み出し中の更新は次回も再取得される（重複は問題ない）
+        generation = self.get_generation()
+        query = '''
+            SELECT t.tag_name, s.image_count
+            FROM tag_stats s
+            JOIN tags t ON t.id = s.tag_id
+        '''
+        if since is None:
+            cursor.execute(query)
+        else:
+            # トリガーは世代を進める前の値を記録するため、since の世代で変わった行も含める
+            cursor.execute(query + ' WHERE s.updated_generation >= ?', (since,))
+        rows = cursor.fetchall()
+        cursor.execute("SELECT value FROM db_counters WHERE name = 'tags'")
+        return rows, generation, cursor.fetchone()[0]
+    
+    def get_tag_info(self, tag_names: List[str]):
+        """指定したタグの (タグID, 使用画像数) を取得（存在しないタグは含まれない）"""
+        cursor = self.get_connection().cursor()
+        tag_names = list(dict.fromkeys(tag_names))
+        info = {}
+        for i in range(0, len(tag_names), IN_CHUNK):
+            chunk = tag_names[i:i + IN_CHUNK]
+            placeholders = ','.join(['?' for _ in chunk])
+            cursor.execute(f'''
+                SELECT t.tag_name, t.id, s.image_count
+                FROM tags t
+                JOIN tag_stats s ON s.tag_id = t.id
+                WHERE t.tag_name IN ({placeholders})
+            ''', chunk)
+            info.update((name, (tag_id, count)) for name, tag_id, count in cursor.fetchall())
+        return info
+    
+    def get_tag_counts(self, tag_names: List[str]):
+        """指定したタグの使用画像数を取得（存在しないタグは含まれない）"""
+        cursor = self.get_connection().cursor()
+        tag_names = list(dict.fromkeys(tag_names))
+        return self._select_ids_in(cursor, '''
+            SELECT t.tag_name, s.image_count
+            FROM tags t
+            JOIN tag_stats s ON s.tag_id = t.id
+            WHERE t.tag_name IN ({placeholders})
+        ''', tag_names)
+    
+    def search_tags_substring(self, query: str, limit: int = 20):
+        """
+        タグ名の部分一致検索（使用数順）
+        3文字以上かつ FTS5 trigram が使える場合はインデックスを使い、それ以外は LIKE で走査する
+        limit=None で一致するタグをすべて返す（シャードの結果の合算用）
+        戻り値: ((タグ, 使用数) のリスト, 使用した経路 "fts5" / "like")
+        """
+        query = query.lower().strip()
+        # SQLite の LIMIT -1 は上限なし
+        limit = -1 if limit is None else limit
+        cursor = self.get_connection().cursor()
+        if self.tag_fts_available and len(query) >= 3:
+            # フレーズとして渡すと trigram トークナイザで部分文字列一致になる
+            phrase = '"' + query.replace('"', '""') + '"'
+            cursor.execute('''
+                SELECT t.tag_name, s.image_count
+                FROM tags_fts f
+                JOIN tags t ON t.id = f.rowid
+                JOIN tag_stats s ON s.tag_id = t.id
+                WHERE tags_fts MATCH ?
+                ORDER BY s.image_count DESC, t.tag_name
+                LIMIT ?
+            ''', (phrase, limit))
+            return cursor.fetchall(), "fts5"
+        
+        escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        cursor.execute('''
+            SELECT t.tag_name, s.image_count
+            FROM tags t
+            JOIN tag_stats s ON s.tag_id = t.id
+            WHERE t.tag_name LIKE ? ESCAPE '\\'
+            ORDER BY s.image_count DESC, t.tag_name
+            LIMIT ?
+        ''', (f'%{escaped}%', limit))
+        return cursor.fetchall(), "like"
+    
+    def get_cooccurrence_info(self):
+        """共起行列の作成時の情報（世代・支持度・ペア数）。未作成なら空の dict"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT name, value FROM cooccurrence_info')
+        info = dict(cursor.fetchall())
+        for name in ('generation', 'min_support', 'pairs', 'images'):
+            if name in info:
+                info[name] = int(info[name])
+        return info
+    
+    def get_pair_counts(self, tag_names: List[str]) -> Dict[Tuple[str, str], int]:
+        """
+        指定タグ同士の共起画像数を共起行列から取得（キーは名前順のタグ名のペア）
+        含まれないペアの共起画像数は支持度（min_support）未満
+        """
+        tag_ids = [tag_id for tag_id, _ in self.get_tag_info(tag_names).values()]
+        if len(tag_ids) < 2:
+            return {}
+        cursor = self.get_connection().cursor()
+        placeholders = ','.join(['?' for _ in tag_ids])
+        cursor.execute(f'''
+            SELECT ta.tag_name, tb.tag_name, c.pair_count
+            FROM tag_cooccurrence c
+            JOIN tags ta ON ta.id = c.tag_a
+            JOIN tags tb ON tb.id = c.tag_b
+            WHERE c.tag_a IN ({placeholders}) AND c.tag_b IN ({placeholders}) AND ta.tag_name < tb.tag_name
+        ''', tag_ids + tag_ids)
+        return {(tag_a, tag_b): count for tag_a, tag_b, count in cursor.fetchall()}
+    
+    def get_related_tags(self, tag_names: List[str], limit: int = 20):
+        """
+        指定タグのすべてと共起する (タグ名, 共起画像数) を多い順に取得
+        共起画像数は各タグとのペアの最小値（指定タグすべてを含む画像のうちそのタグが付いた数の上限）
+        共起行列に含まれないペアの共起画像数は支持度未満のため、関連タグとして返さない
+        limit=None で共起行列にある関連タグをすべて返す（シャードの結果の合算用）
+        """
+        limit = -1 if limit is None else limit
+        tag_info = self.get_tag_info(tag_names)
+        if not tag_names or len(tag_info) < len(set(tag_names)):
+            return []
+        tag_ids = [tag_id for tag_id, _ in tag_info.values()]
+        cursor = self.get_connection().cursor()
+        placeholders = ','.join(['?' for _ in tag_ids])
+        if len(tag_ids) == 1:
+            # (tag_a, pair_count) インデックスを逆順に読むだけで済む
+            cursor.execute('''
+                SELECT t.tag_name, c.pair_count
+                FROM tag_cooccurrence c
+                JOIN tags t ON t.id = c.tag_b
+                WHERE c.tag_a = ?
+                ORDER BY c.pair_count DESC, t.tag_name
+                LIMIT ?
+            ''', (tag_ids[0], limit))
+        else:
+            # 件数は指定タグすべてを含む画像数の上限（指定タグ同士の共起画像数の最小値）で抑え、順位は抑える前の値で決める
+            pair_counts = self.get_pair_counts(tag_names)
+            pair_count = len(tag_ids) * (len(tag_ids) - 1) // 2
+            if len(pair_counts) < pair_count:
+                upper_bound = self.get_cooccurrence_info().get('min_support', 1) - 1
+            else:
+                upper_bound = min(pair_counts.values())
+            cursor.execute(f'''
+                SELECT t.tag_name, MIN(MIN(c.pair_count), ?) AS related_count
+                FROM tag_cooccurrence c
+                JOIN tags t ON t.id = c.tag_b
+                WHERE c.tag_a IN ({placeholders}) AND c.tag_b NOT IN ({placeholders})
+                GROUP BY c.tag_b
+                HAVING COUNT(*) = ?
+                ORDER BY MIN(c.pair_count) DESC, t.tag_name
+                LIMIT ?
+            ''', [upper_bound] + tag_ids + tag_ids + [len(tag_ids), limit])
+        return cursor.fetchall()
+    
+    def get_popular_tags(self, limit: int = 20):
+        """使用画像数の多いタグを取得"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('''
+            SELECT t.tag_name, s.image_count
+            FROM tag_stats s
+            JOIN tags t ON t.id = s.tag_id
+            ORDER BY s.image_count DESC
+            LIMIT ?
+        ''', (limit,))
+        return cursor.fetchall()
     
     def optimize_database(self):
         """データベースの最適化を実行"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         try:
@@ -97,163 +709,214 @@ class ImageDatabase:
         finally:
             conn.close()
     
-    def add_image_with_tags(self, filepath: str, tags: List[str]):
-        """画像とそのタグをデータベースに追加"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def add_image_with_tags(self, filepath: str, tags: List):
+        """画像とそのタグ（タグ名または (タグ名, 信頼度)）をデータベースに追加"""
+        image_id = self.add_images_with_tags_batch([(filepath, tags)])[0]
+        print(f"Added image {os.path.basename(filepath)} with {len(tags)} tags")
+        return image_id
+    
+    def _get_tag_cache(self, cursor):
+        """tag_name → id のキャッシュを取得（未読み込みなら tags テーブルから構築）"""
+        if self._tag_cache is None:
+            cursor.execute('SELECT tag_name, id FROM tags')
+            self._tag_cache = dict(cursor.fetchall())
+        return self._tag_cache
+    
+    @staticmethod
+    def _select_ids_in(cursor, query: str, keys: List):
+        """IN句を分割して (key, id) の辞書を取得"""
+        found = {}
+        for i in range(0, len(keys), IN_CHUNK):
+            chunk = keys[i:i + IN_CHUNK]
+            placeholders = ','.join(['?' for _ in chunk])
+            cursor.execute(query.format(placeholders=placeholders), chunk)
+            found.update(cursor.fetchall())
+        return found
+    
+    @staticmethod
+    def _normalize_tags(tags: List) -> Dict[str, float]:
+        """タグ名または (タグ名, 信頼度) のリストを {小文字のタグ名: 信頼度} にまとめる（信頼度省略時は1.0）"""
+        normalized = {}
+        for tag in tags:
+            tag_name, confidence = (tag, 1.0) if isinstance(tag, str) else tag
+            tag_name = tag_name.lower().strip()
+            if tag_name:
+                normalized[tag_name] = max(float(confidence), normalized.get(tag_name, 0.0))
+        return normalized
+    
+    def add_images_with_tags_batch(self, items: List[Tuple[str, List]]) -> List[int]:
+        """
+        複数の画像とタグを1トランザクションで追加し、画像IDのリストを返す
+        items: (filepath, tags) のリスト。tags はタグ名または (タグ名, 信頼度) のリスト
+        （戻り値の順序は items と同じ）
+        """
+        if not items:
+            return []
         
-        try:
-            # 画像を追加
-            filename = os.path.basename(filepath)
-            cursor.execute('INSERT OR IGNORE INTO images (filepath, filename) VALUES (?, ?)', 
-                         (filepath, filename))
-            
-            # 画像IDを取得
-            cursor.execute('SELECT id FROM images WHERE filepath = ?', (filepath,))
-            result = cursor.fetchone()
-            if not result:
-                # 新しく挿入された場合のID取得
-                image_id = cursor.lastrowid
-            else:
-                image_id = result[0]
-            
-            # タグを追加（小文字に統一）
-            for tag in tags:
-                tag_lower = tag.lower().strip()
-                if not tag_lower:
-                    continue
+        # タグを小文字に統一し、画像ごとに重複を除去
+        normalized = [(filepath, self._normalize_tags(tags)) for filepath, tags in items]
+        
+        with self._tag_cache_lock:
+            try:
+                with self.transaction() as conn:
+                    cursor = conn.cursor()
+                    tag_cache = self._get_tag_cache(cursor)
                     
-                # タグを追加（存在しない場合）
-                cursor.execute('INSERT OR IGNORE INTO tags (tag_name) VALUES (?)', (tag_lower,))
-                
-                # タグIDを取得
-                cursor.execute('SELECT id FROM tags WHERE tag_name = ?', (tag_lower,))
-                tag_result = cursor.fetchone()
-                if tag_result:
-                    tag_id = tag_result[0]
+                    # 画像を追加してIDを取得
+                    filepaths = list(dict.fromkeys(filepath for filepath, _ in normalized))
+                    cursor.executemany('INSERT OR IGNORE INTO images (filepath, filename) VALUES (?, ?)',
+                                       [(filepath, os.path.basename(filepath)) for filepath in filepaths])
+                    image_ids = self._select_ids_in(
+                        cursor, 'SELECT filepath, id FROM images WHERE filepath IN ({placeholders})', filepaths)
+                    
+                    # キャッシュにない新規タグだけを追加してIDを取得
+                    new_tags = sorted({tag for _, tag_names in normalized for tag in tag_names} - tag_cache.keys())
+                    new_tag_ids = {}
+                    if new_tags:
+                        cursor.executemany('INSERT OR IGNORE INTO tags (tag_name) VALUES (?)',
+                                           [(tag,) for tag in new_tags])
+                        new_tag_ids = self._select_ids_in(
+                            cursor, 'SELECT tag_name, id FROM tags WHERE tag_name IN ({placeholders})', new_tags)
                     
                     # 画像-タグ関連を追加
-                    cursor.execute('INSERT OR IGNORE INTO image_tags (image_id, tag_id) VALUES (?, ?)', 
-                                 (image_id, tag_id))
-            
-            conn.commit()
-            print(f"Added image {filename} with {len(tags)} tags")
-            return image_id
-            
-        except Exception as e:
-            conn.rollback()
-            print(f"Error adding image {filepath}: {e}")
-            raise e
-        finally:
-            conn.close()
+                    relations = []
+                    for filepath, tag_names in normalized:
+                        image_id = image_ids[filepath]
+                        for tag, confidence in tag_names.items():
+                            tag_id = tag_cache.get(tag)
+                            if tag_id is None:
+                                tag_id = new_tag_ids[tag]
+                            relations.append((image_id, tag_id, confidence))
+                    cursor.executemany(
+                        'INSERT OR IGNORE INTO image_tags (image_id, tag_id, confidence) VALUES (?, ?, ?)', relations)
+                    self._bump_generation(cursor)
+                
+                # コミットが成功した場合のみキャッシュに反映
+                tag_cache.update(new_tag_ids)
+                
+            except Exception as e:
+                print(f"Error adding batch of {len(items)} images: {e}")
+                raise e
+        
+        return [image_ids[filepath] for filepath, _ in normalized]
+    
+    def delete_images(self, image_ids: List[int]):
+        """画像とその画像-タグ関連・ファイル確認結果を1トランザクションで削除（集計はトリガーで更新）"""
+        image_ids = list(dict.fromkeys(image_ids))
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            for i in range(0, len(image_ids), IN_CHUNK):
+                chunk = image_ids[i:i + IN_CHUNK]
+                placeholders = ','.join(['?' for _ in chunk])
+                cursor.execute(f'DELETE FROM image_tags WHERE image_id IN ({placeholders})', chunk)
+                cursor.execute(f'DELETE FROM file_status WHERE image_id IN ({placeholders})', chunk)
+                cursor.execute(f'DELETE FROM images WHERE id IN ({placeholders})', chunk)
+            self._bump_generation(cursor)
+        print(f"Deleted {len(image_ids)} images")
+    
+    def record_file_statuses(self, statuses: Dict[str, Optional[Tuple[int, float]]], checked_at: float = None):
+        """
+        画像ファイルの確認結果を file_status に記録（登録時・整合性チェック時）
+        statuses: filepath → (size, mtime)、ファイルがなければ None（データベースにない画像は無視）
+        """
+        checked_at = checked_at or time.time()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            image_ids = self._select_ids_in(
+                cursor, 'SELECT filepath, id FROM images WHERE filepath IN ({placeholders})', list(statuses))
+            cursor.executemany(
+                'INSERT OR REPLACE INTO file_status (image_id, size, mtime, last_checked) VALUES (?, ?, ?, ?)',
+                [(image_ids[filepath], *(status or (None, None)), checked_at)
+                 for filepath, status in statuses.items() if filepath in image_ids])
+    
+    def get_file_statuses(self, filepaths: List[str], since: float = 0) -> Dict[str, Tuple[bool, float]]:
+        """since 以降に確認された画像ファイルの (存在するか, 確認時刻) を取得（記録がなければ含まれない）"""
+        cursor = self.get_connection().cursor()
+        statuses = {}
+        filepaths = list(dict.fromkeys(filepaths))
+        for i in range(0, len(filepaths), IN_CHUNK):
+            chunk = filepaths[i:i + IN_CHUNK]
+            placeholders = ','.join(['?' for _ in chunk])
+            cursor.execute(f'''
+                SELECT i.filepath, s.size IS NOT NULL, s.last_checked
+                FROM images i
+                JOIN file_status s ON s.image_id = i.id
+                WHERE i.filepath IN ({placeholders}) AND s.last_checked >= ?
+            ''', chunk + [since])
+            statuses.update((filepath, (bool(exists), last_checked)) for filepath, exists, last_checked in cursor)
+        return statuses
+    
+    def get_image(self, image_id: int):
+        """画像の (id, filepath, filename) を取得（存在しなければ None）"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT id, filepath, filename FROM images WHERE id = ?', (image_id,))
+        return cursor.fetchone()
+    
+    def get_images(self, limit: int = 10):
+        """画像の (id, filepath, filename) をID順に取得（デバッグ用）"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT id, filepath, filename FROM images ORDER BY id LIMIT ?', (limit,))
+        return cursor.fetchall()
     
     def get_all_image_filenames(self):
         """画像ファイル名を取得（デバッグ用）"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('SELECT filename FROM images')
         results = [row[0] for row in cursor.fetchall()]
-        conn.close()
         return results
     
-    def search_images(self, positive_tags: List[str], negative_tags: List[str] = None, limit: int = 50):
-        """タグで画像を検索（デバッグ機能付き）"""
+    def search_images(self, positive_tags: List[str], negative_tags: List[str] = None, limit: int = 50,
+                      after: Tuple[int, int] = None, mode: str = "any", rank: str = "count"):
+        """
+        タグで画像を検索（デバッグ機能付き）
+        タグは "long_hair>0.8" のように信頼度のしきい値を付けて指定できる
+        after: 前ページ最後の (match_count, id)。指定するとその次の行から limit 件を返す（キーセットページング）
+        mode: "any" はいずれかのポジティブタグを含む画像を一致数順、"all" はすべて含む画像をID降順で返す
+        rank: "confidence" を指定すると一致タグの信頼度の合計順に並べる（4列目が合計値になる）
+        """
         search_start_time = time.time()
         
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"未対応の検索モード: {mode}")
+        if rank not in SEARCH_RANKS:
+            raise ValueError(f"未対応の並び順: {rank}")
+        
         if negative_tags is None:
             negative_tags = []
             
-        # タグを小文字に統一
+        # タグを小文字に統一し、信頼度のしきい値を分離
         tag_normalize_start = time.time()
-        positive_tags = [tag.lower().strip() for tag in positive_tags if tag.strip()]
-        negative_tags = [tag.lower().strip() for tag in negative_tags if tag.strip()]
+        positive_tags = parse_tag_specs(positive_tags)
+        negative_tags = parse_tag_specs(negative_tags)
         tag_normalize_time = time.time() - tag_normalize_start
         
         print(f"Searching for positive tags: {positive_tags}")
         print(f"Excluding negative tags: {negative_tags}")
         print(f"タグ正規化時間: {tag_normalize_time:.4f}秒")
         
-        # データベース接続時間を測定
-        db_connect_start = time.time()
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        db_connect_time = time.time() - db_connect_start
-        print(f"DB接続時間: {db_connect_time:.4f}秒")
-        
         try:
-            # 統計情報取得時間を測定
-            stats_start = time.time()
-            cursor.execute('SELECT COUNT(*) FROM images')
-            total_images = cursor.fetchone()[0]
-            print(f"Total images in database: {total_images}")
-            
-            cursor.execute('SELECT COUNT(*) FROM tags')
-            total_tags = cursor.fetchone()[0]
-            print(f"Total tags in database: {total_tags}")
-            stats_time = time.time() - stats_start
-            print(f"統計情報取得時間: {stats_time:.4f}秒")
-            
-            # タグ存在確認時間を測定
-            tag_check_start = time.time()
-            for tag in positive_tags:
-                cursor.execute('SELECT COUNT(*) FROM tags WHERE tag_name = ?', (tag,))
-                count = cursor.fetchone()[0]
-                print(f"Tag '{tag}' found {count} times")
-            tag_check_time = time.time() - tag_check_start
-            print(f"タグ存在確認時間: {tag_check_time:.4f}秒")
-            
-            # クエリ構築時間を測定
-            query_build_start = time.time()
-            positive_placeholders = ','.join(['?' for _ in positive_tags])
+            # 実行計画の作成時間を測定（tag_stats からカーディナリティを取得）
+            plan_start = time.time()
+            plan = self.planner.plan(positive_tags, negative_tags, mode, rank)
+            plan_time = time.time() - plan_start
+            for entry in plan['positive']:
+                print(f"Tag '{entry['tag']}' used by {entry['estimated_rows']} images")
+            if plan['skipped_negative']:
+                print(f"一致しないため省略したネガティブタグ: {plan['skipped_negative']}")
+            print(f"実行計画: {plan['strategy']} ({plan['reason']})")
+            print(f"実行計画作成時間: {plan_time:.4f}秒")
             
-            query = f'''
-            SELECT i.id, i.filepath, i.filename, COUNT(it.tag_id) as match_count
-            FROM images i
-            JOIN image_tags it ON i.id = it.image_id
-            JOIN tags t ON it.tag_id = t.id
-            WHERE t.tag_name IN ({positive_placeholders})
-            '''
-            
-            params = positive_tags.copy()
-            
-            # ネガティブタグがある場合
-            if negative_tags:
-                negative_placeholders = ','.join(['?' for _ in negative_tags])
-                query += f'''
-                AND NOT EXISTS (
-                    SELECT 1 FROM image_tags it2
-                    JOIN tags t2 ON it2.tag_id = t2.id
-                    WHERE it2.image_id = i.id
-                    AND t2.tag_name IN ({negative_placeholders})
-                )
-                '''
-                params.extend(negative_tags)
-            
-            query += '''
-            GROUP BY i.id, i.filepath, i.filename
-            ORDER BY match_count DESC, i.id DESC
-            LIMIT ?
-            '''
-            params.append(limit)
-            query_build_time = time.time() - query_build_start
-            print(f"クエリ構築時間: {query_build_time:.4f}秒")
-            
-            print(f"Executing query: {query}")
-            print(f"With parameters: {params}")
-            
-            # SQLクエリ実行時間を測定
-            sql_execute_start = time.time()
-            cursor.execute(query, params)
-            results = cursor.fetchall()
-            sql_execute_time = time.time() - sql_execute_start
+            execute_start = time.time()
+            results = self._execute_plan(plan, limit, after)
+            execute_time = time.time() - execute_start
             
             # 全体の検索時間を計算
             total_search_time = time.time() - search_start_time
             
-            print(f"SQLクエリ実行時間: {sql_execute_time:.4f}秒")
+            print(f"検索実行時間: {execute_time:.4f}秒")
             print(f"Search returned {len(results)} results")
             print(f"データベース検索全体時間: {total_search_time:.4f}秒")
-            print(f"DB検索時間内訳 - タグ正規化: {tag_normalize_time:.4f}秒, DB接続: {db_connect_time:.4f}秒, 統計取得: {stats_time:.4f}秒, タグ確認: {tag_check_time:.4f}秒, クエリ構築: {query_build_time:.4f}秒, SQL実行: {sql_execute_time:.4f}秒")
+            print(f"DB検索時間内訳 - タグ正規化: {tag_normalize_time:.4f}秒, 実行計画: {plan_time:.4f}秒, 検索実行: {execute_time:.4f}秒")
             
             for result in results[:3]:  # 最初の3件をログ出力
                 print(f"Result: {result}")
@@ -263,22 +926,301 @@ class ImageDatabase:
         except Exception as e:
             print(f"Search error: {e}")
             raise e
+    
+    def iter_search_images(self, positive_tags: List[str], negative_tags: List[str] = None, limit: int = 50,
+                           after: Tuple[int, int] = None, mode: str = "any", rank: str = "count",
+                           batch_size: int = STREAM_BATCH) -> Iterator[tuple]:
+        """
+        search_images と同じ順序の結果を、カーソルから batch_size 行ずつ読み出すイテレータで返す
+        結果全体をリストにしないため、limit が大きくてもメモリ使用量は batch_size 行分で一定
+        （インメモリエンジンが選ばれた場合は、エンジンが limit 件までの結果をリストで作ってから順に返すため、
+        メモリ使用量は limit に比例する。大きな limit のエクスポートには search_engine="sql" を使う）
+        検証と実行計画の作成はこの呼び出し時に行う（不正な入力は ValueError）
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"未対応の検索モード: {mode}")
+        if rank not in SEARCH_RANKS:
+            raise ValueError(f"未対応の並び順: {rank}")
+        
+        plan = self.planner.plan(parse_tag_specs(positive_tags), parse_tag_specs(negative_tags or []), mode, rank)
+        print(f"実行計画: {plan['strategy']} ({plan['reason']})、ストリーミングで取得")
+        if plan['strategy'] != "sql":
+            return iter(self._execute_plan(plan, limit, after))
+        query, params = self._build_plan_sql(plan, limit, after)
+        return self._iter_rows(query, params, batch_size)
+    
+    def _iter_rows(self, query: str, params: list, batch_size: int) -> Iterator[tuple]:
+        """
+        クエリの結果を batch_size 行ずつ読み出す
+        読み出し中に同じスレッドで別のクエリが実行されても影響しないよう、専用の接続を使い最後に閉じる
+        """
+        conn = self._connect(self.read_only)
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
         finally:
             conn.close()
     
+    def _execute_plan(self, plan: dict, limit: int, after: Tuple[int, int] = None):
+        """実行計画に従って検索を実行"""
+        if plan['strategy'] == "empty":
+            return []
+        
+        if plan['strategy'] == "memory":
+            if self._bitmap_engine is None:
+                from search_engine import BitmapSearchEngine
+                self._bitmap_engine = BitmapSearchEngine(self, snapshot_dir=self.snapshot_dir)
+            positive = [(entry['tag'], entry['min_confidence']) for entry in plan['positive']]
+            negative = [(entry['tag'], entry['min_confidence']) for entry in plan['negative']]
+            if self._uses_early_termination(plan):
+                return self._bitmap_engine.search_all(positive, negative, limit, after)
+            return self._bitmap_engine.search(positive, negative, limit, after,
+                                              rank=plan['rank'], require_all=plan['mode'] == "all")
+        
+        query, params = self._build_plan_sql(plan, limit, after)
+        cursor = self.get_connection().cursor()
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    
+    @staticmethod
+    def _uses_early_termination(plan: dict) -> bool:
+        """"all" モードを一致数順で返す場合は、ID降順の交差で limit 件に達した時点で打ち切れる"""
+        return plan['mode'] == "all" and plan['rank'] == "count"
+    
+    def _build_plan_sql(self, plan: dict, limit: int = None, after: Tuple[int, int] = None):
+        """実行計画に対応するSQLを組み立てる"""
+        if self._uses_early_termination(plan):
+            return self._build_search_all_sql(plan, limit, after)
+        return self._build_search_sql(plan, limit, after)
+    
+    @staticmethod
+    def _sql_negative(plan: dict) -> List[dict]:
+        """NOT EXISTS で判定するネガティブタグ（group_mask のビットで判定するタグを除く）"""
+        return [entry for entry in plan['negative'] if entry['tag'] not in plan['group_negative']]
+    
+    @staticmethod
+    def _group_mask_condition(plan: dict):
+        """人数タグのネガティブを画像行の group_mask で判定する条件（image_tags を引かない）"""
+        if not plan['group_mask']:
+            return '', []
+        return '''
+            AND (i.group_mask & ?) = 0
+            ''', [plan['group_mask']]
+    
+    @staticmethod
+    def _tag_condition(alias: str, entries: List[dict]):
+        """
+        タグ（としきい値）に一致する image_tags 行の条件式とパラメータを作る
+        しきい値なしは tag_id の IN、しきい値付きは (tag_id, confidence) インデックスの範囲条件にする
+        """
+        conditions = []
+        params = []
+        plain_ids = [entry['tag_id'] for entry in entries if entry['min_confidence'] is None]
+        if plain_ids:
+            placeholders = ','.join(['?' for _ in plain_ids])
+            conditions.append(f'{alias}.tag_id IN ({placeholders})')
+            params.extend(plain_ids)
+        for entry in entries:
+            if entry['min_confidence'] is not None:
+                conditions.append(f'({alias}.tag_id = ? AND {alias}.confidence > ?)')
+                params.extend([entry['tag_id'], entry['min_confidence']])
+        return '(' + ' OR '.join(conditions) + ')', params
+    
+    def _build_search_sql(self, plan: dict, limit: int = None, after: Tuple[int, int] = None):
+        """
+        実行計画からSQLを組み立てる（タグ名はプラン作成時にIDへ解決済みのため tags とのJOINは不要）
+        limit=None の場合は ORDER BY / LIMIT を付けない（件数確認用）
+        """
+        positive_condition, params = self._tag_condition('it', plan['positive'])
+        
+        # 信頼度の合計は浮動小数点の誤差でページングの比較がずれないよう小数点以下6桁に丸める
+        # （ROUND(x, 6) は文字列経由で誤差が出るため、整数に丸めてから割る）
+        if plan['rank'] == "confidence":
+            score = 'ROUND(SUM(it.confidence) * 1000000) / 1000000.0'
+        else:
+            score = 'COUNT(it.tag_id)'
+        
+        query = f'''
+            SELECT i.id, i.filepath, i.filename, {score} as match_count
+            FROM image_tags it
+            JOIN images i ON i.id = it.image_id
+            WHERE {positive_condition}
+            '''
+        
+        mask_condition, mask_params = self._group_mask_condition(plan)
+        query += mask_condition
+        params.extend(mask_params)
+        
+        # ネガティブタグがある場合（(image_id, tag_id) のUNIQUEインデックスで判定）
+        negative = self._sql_negative(plan)
+        if negative:
+            negative_condition, negative_params = self._tag_condition('it2', negative)
+            query += f'''
+            AND NOT EXISTS (
+                SELECT 1 FROM image_tags it2
+                WHERE it2.image_id = it.image_id
+                AND {negative_condition}
+            )
+            '''
+            params.extend(negative_params)
+        
+        query += '''
+            GROUP BY i.id, i.filepath, i.filename
+            '''
+        
+        having = []
+        # "all" モード（信頼度順）: すべてのポジティブタグに一致した画像のみ
+        if plan['mode'] == "all":
+            having.append('COUNT(it.tag_id) = ?')
+            params.append(len(plan['positive']))
+        
+        # キーセットページング: ORDER BY と同じ (match_count, id) の順で前ページの続きから取得
+        if after is not None:
+            having.append('(match_count < ? OR (match_count = ? AND i.id < ?))')
+            params.extend([after[0], after[0], after[1]])
+        
+        if having:
+            query += f'''
+            HAVING {' AND '.join(having)}
+            '''
+        
+        if limit is not None:
+            query += '''
+            ORDER BY match_count DESC, i.id DESC
+            LIMIT ?
+            '''
+            params.append(limit)
+        
+        return query, params
+    
+    def _build_search_all_sql(self, plan: dict, limit: int = None, after: Tuple[int, int] = None):
+        """
+        "all" モードのSQL: 最も少ないタグの (tag_id, image_id) インデックスを image_id 降順に走査し、
+        残りのタグを EXISTS で確認する。並び替えが不要なため limit 件に達した時点で走査が止まる
+        """
+        positive = plan['positive']
+        match_count = len(positive)
+        
+        query = '''
+            SELECT i.id, i.filepath, i.filename, ? as match_count
+            FROM image_tags it
+            JOIN images i ON i.id = it.image_id
+            WHERE it.tag_id = ?
+            '''
+        params = [match_count, positive[0]['tag_id']]
+        if positive[0]['min_confidence'] is not None:
+            query += '''
+            AND it.confidence > ?
+            '''
+            params.append(positive[0]['min_confidence'])
+        
+        # 2番目以降のタグは少ない順に確認（早く不一致になる方を先に）
+        for index, entry in enumerate(positive[1:], start=1):
+            condition, condition_params = self._tag_condition(f'it{index}', [entry])
+            query += f'''
+            AND EXISTS (
+                SELECT 1 FROM image_tags it{index}
+                WHERE it{index}.image_id = it.image_id
+                AND {condition}
+            )
+            '''
+            params.extend(condition_params)
+        
+        mask_condition, mask_params = self._group_mask_condition(plan)
+        query += mask_condition
+        params.extend(mask_params)
+        
+        negative = self._sql_negative(plan)
+        if negative:
+            negative_condition, negative_params = self._tag_condition('itn', negative)
+            query += f'''
+            AND NOT EXISTS (
+                SELECT 1 FROM image_tags itn
+                WHERE itn.image_id = it.image_id
+                AND {negative_condition}
+            )
+            '''
+            params.extend(negative_params)
+        
+        # キーセットページング: 全件の match_count が同じなので id だけで続きを判定できる
+        if after is not None:
+            after_count, after_id = after
+            if after_count < match_count:
+                query += '''
+            AND 0
+            '''
+            elif after_count == match_count:
+                query += '''
+            AND it.image_id < ?
+            '''
+                params.append(after_id)
+        
+        if limit is not None:
+            query += '''
+            ORDER BY it.image_id DESC
+            LIMIT ?
+            '''
+            params.append(limit)
+        
+        return query, params
+    
+    def explain_search(self, positive_tags: List[str], negative_tags: List[str] = None, limit: int = 50,
+                       after: Tuple[int, int] = None, mode: str = "any", rank: str = "count"):
+        """検索の実行計画、推定/実際のカーディナリティ、SQLiteの EXPLAIN QUERY PLAN を返す"""
+        positive_tags = parse_tag_specs(positive_tags)
+        negative_tags = parse_tag_specs(negative_tags or [])
+        
+        plan_start = time.time()
+        plan = self.planner.plan(positive_tags, negative_tags, mode, rank)
+        plan_time = time.time() - plan_start
+        
+        explain = {'plan': plan, 'plan_time': plan_time, 'sql': None, 'params': None, 'query_plan': []}
+        actual = {'positive': {}, 'negative': {}, 'candidates': 0}
+        cursor = self.get_connection().cursor()
+        
+        if plan['strategy'] != "empty":
+            query, params = self._build_plan_sql(plan, limit, after)
+            explain['sql'] = ' '.join(query.split())
+            explain['params'] = params
+            cursor.execute('EXPLAIN QUERY PLAN ' + query, params)
+            explain['query_plan'] = [{'id': row[0], 'parent': row[1], 'detail': row[3]} for row in cursor.fetchall()]
+            
+            # 実際のカーディナリティ（image_tags を直接数える、しきい値付きは条件を満たす行のみ）
+            for side in ('positive', 'negative'):
+                for entry in plan[side]:
+                    condition, condition_params = self._tag_condition('image_tags', [entry])
+                    cursor.execute(f'SELECT COUNT(*) FROM image_tags WHERE {condition}', condition_params)
+                    actual[side][entry['tag']] = cursor.fetchone()[0]
+            count_query, count_params = self._build_plan_sql(plan, None, after)
+            cursor.execute(f'SELECT COUNT(*) FROM ({count_query})', count_params)
+            actual['candidates'] = cursor.fetchone()[0]
+        
+        execute_start = time.time()
+        results = self._execute_plan(plan, limit, after)
+        actual['execution_time'] = time.time() - execute_start
+        actual['results'] = len(results)
+        explain['actual'] = actual
+        return explain
+    
     def get_all_tags(self):
         """全タグを取得（デバッグ用）"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT tag_name, COUNT(it.image_id) FROM tags t LEFT JOIN image_tags it ON t.id = it.tag_id GROUP BY t.tag_name ORDER BY COUNT(it.image_id) DESC')
+        cursor = self.get_connection().cursor()
+        cursor.execute('''
+            SELECT t.tag_name, s.image_count
+            FROM tag_stats s
+            JOIN tags t ON t.id = s.tag_id
+            ORDER BY s.image_count DESC
+        ''')
         results = cursor.fetchall()
-        conn.close()
         return results
     
     def get_image_tags(self, image_id: int):
         """特定の画像のタグを取得（デバッグ用）"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('''
             SELECT t.tag_name
             FROM tags t
@@ -286,13 +1228,11 @@ class ImageDatabase:
             WHERE it.image_id = ?
         ''', (image_id,))
         results = [row[0] for row in cursor.fetchall()]
-        conn.close()
         return results
     
     def get_image_tags_with_confidence(self, image_id: int):
         """特定の画像のタグを信頼度付きで取得"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('''
             SELECT t.tag_name, it.confidence
             FROM tags t
@@ -301,5 +1241,59 @@ class ImageDatabase:
             ORDER BY it.confidence DESC
         ''', (image_id,))
         results = [{'tag': row[0], 'confidence': row[1]} for row in cursor.fetchall()]
-        conn.close()
-        return results
\ No newline at end of file
+        return results
+
+    def get_tags_for_images(self, image_ids: List[int]) -> Dict[int, List[dict]]:
+        """
+        複数画像のタグを信頼度付きでまとめて取得（画像ID → 信頼度の高い順のタグ）
+        画像ごとにクエリを発行せず、IN_CHUNK 件ずつ1回のクエリで引く（タグのない画像は空のリスト）
+        """
+        cursor = self.get_connection().cursor()
+        image_ids = list(dict.fromkeys(image_ids))
+        tags = {image_id: [] for image_id in image_ids}
+        for i in range(0, len(image_ids), IN_CHUNK):
+            chunk = image_ids[i:i + IN_CHUNK]
+            placeholders = ','.join(['?' for _ in chunk])
+            cursor.execute(f'''
+                SELECT it.image_id, t.tag_name, it.confidence
+                FROM image_tags it
+                JOIN tags t ON t.id = it.tag_id
+                WHERE it.image_id IN ({placeholders})
+                ORDER BY it.image_id, it.confidence DESC
+            ''', chunk)
+            for image_id, tag_name, confidence in cursor:
+                tags[image_id].append({'tag': tag_name, 'confidence': confidence})
+        return tags
+
+
+def main():
+    """データベース保守コマンド"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="画像検索データベースの保守コマンド")
+    parser.add_argument("--db", default="image_search.db", help="データベースファイルのパス")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild-stats", help="タグ使用数・全体件数の集計テーブルを再構築")
+    export_parser = subparsers.add_parser("export-snapshot", help="インメモリ検索用のインデックススナップショットを書き出す")
+    export_parser.add_argument("--out", default="index_snapshot", help="スナップショットの保存先ディレクトリ")
+    cooccurrence_parser = subparsers.add_parser("build-cooccurrence", help="タグ共起行列を作成")
+    cooccurrence_parser.add_argument("--min-support", type=int, default=None,
+                                     help="保存するペアの最小共起画像数（既定: tag_cooccurrence.DEFAULT_MIN_SUPPORT）")
+    subparsers.add_parser("backfill-group-mask", help="既存の画像の人数タグのビットマスク（images.group_mask）を計算")
+    args = parser.parse_args()
+    
+    db = ImageDatabase(args.db, profile="bulk_ingest")
+    if args.command == "rebuild-stats":
+        db.rebuild_stats()
+        print(db.get_counters())
+    elif args.command == "export-snapshot":
+        from index_snapshot import export_snapshot
+        export_snapshot(db, args.out)
+    elif args.command == "build-cooccurrence":
+        from tag_cooccurrence import DEFAULT_MIN_SUPPORT, build_cooccurrence
+        build_cooccurrence(db, args.min_support or DEFAULT_MIN_SUPPORT)
+    elif args.command == "backfill-group-mask":
+        db.backfill_group_masks()
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@
 import sqlite3
 from collections import defaultdict
 from database import ImageDatabase
+from partition_spec import PartitionSpec, STANDARD_SPECS
 import json
 
 class PartitionStrategy:
@@ -23,9 +24,8 @@ class PartitionStrategy:
         conn = self.db.get_connection()
         cursor = conn.cursor()
         
-        # 基本統計
-        cursor.execute('SELECT COUNT(*) FROM images')
-        total_images = cursor.fetchone()[0]
+        # 基本統計（集計テーブルから）
+        total_images = self.db.get_counters().get('images', 0)
         
         # ソロ画像の分析
         cursor.execute('''
@@ -73,8 +73,6 @@ class PartitionStrategy:
         ''')
         boy_girl_images = cursor.fetchone()[0]
         
-        conn.close()
-        
         print(f"📊 主要パターン分析:")
         print(f"  - 総画像数: {total_images:,}件")
         print(f"  - ソロ画像: {solo_images:,}件 ({solo_images/total_images*100:.1f}%)")
@@ -133,25 +131,39 @@ class PartitionStrategy:
             'strategy3': {'girl_solo': girl_solo, 'boy_solo': boy_solo, 'couple': couple, 'others': remaining}
         }
     
+    def measure_partition_specs(self, specs=None):
+        """
+        分割定義ごとに各シャードへ実際に入る画像数を数える（database_splitter.py と同じ割り当て）
+        specs: 戦略名 → PartitionSpec（既定は STANDARD_SPECS）
+        """
+        if specs is None:
+            specs = {name: PartitionSpec.from_dict(spec) for name, spec in STANDARD_SPECS.items()}
+        
+        print(f"\n📐 分割定義ごとのシャードサイズ:")
+        cursor = self.db.get_connection().cursor()
+        total = max(self.db.get_counters().get('images', 0), 1)
+        sizes = {}
+        for name, spec in specs.items():
+            tags = set().union(*(shard.all | shard.any | shard.none for shard in spec.shards))
+            tag_ids = {tag: tag_id for tag, (tag_id, _) in self.db.get_tag_info(list(tags)).items()}
+            case_sql, params = spec.assignment_sql(tag_ids)
+            cursor.execute(f'SELECT shard, COUNT(*) FROM (SELECT {case_sql} AS shard FROM images i) GROUP BY shard',
+                           params)
+            counts = dict(cursor.fetchall())
+            sizes[name] = {shard.name: counts.get(index, 0) for index, shard in enumerate(spec.shards)}
+            
+            print(f"  {name}:")
+            for shard_name, count in sizes[name].items():
+                print(f"    - {shard_name}: {count:,}件 ({count/total*100:.1f}%)")
+        return sizes
+    
     def analyze_tag_frequency_distribution(self):
         """タグ頻度分布を分析してインデックス戦略を提案"""
         print(f"\n📈 タグ頻度分布分析:")
         print("="*60)
         
-        conn = self.db.get_connection()
-        cursor = conn.cursor()
-        
-        # タグ使用頻度の分布
-        cursor.execute('''
-            SELECT t.tag_name, COUNT(it.image_id) as usage_count
-            FROM tags t
-            LEFT JOIN image_tags it ON t.id = it.tag_id
-            GROUP BY t.tag_name
-            ORDER BY usage_count DESC
-            LIMIT 50
-        ''')
-        
-        top_tags = cursor.fetchall()
+        # タグ使用頻度の分布（集計テーブルから）
+        top_tags = self.db.get_popular_tags(50)
         
         # 頻度別カテゴリ分析
         very_high = [tag for tag, count in top_tags if count > 100000]
@@ -171,8 +183,6 @@ class PartitionStrategy:
         print(f"  - 中頻度 (1千-1万件): {len(medium)}個")
         print(f"  - 低頻度 (1千件未満): {len(low)}個")
         
-        conn.close()
-        
         return {
             'very_high': very_high,
             'high': high,
@@ -225,6 +235,9 @@ def main():
         # 分割戦略提案
         partition_strategies = strategy.propose_partition_strategies(stats)
         
+        # 分割定義ごとの実際のシャードサイズ
+        partition_sizes = strategy.measure_partition_specs()
+        
         # タグ頻度分析
         tag_analysis = strategy.analyze_tag_frequency_distribution()
         
@@ -235,7 +248,10 @@ def main():
         result = {
             'stats': stats,
             'partition_strategies': partition_strategies,
-            'tag_analysis': tag_analysis
+            'tag_analysis': tag_analysis,
+            # database_splitter.py で選択できる分割定義（partition_spec.py の形式）
+            'partition_specs': STANDARD_SPECS,
+            'partition_sizes': partition_sizes
         }
         
         with open('partition_strategy.json', 'w', encoding='utf-8') as f:
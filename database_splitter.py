@@ -7,257 +7,198 @@
 
 import sqlite3
 import os
-import shutil
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 from database import ImageDatabase
+from partition_spec import PartitionSpec
+from sharded_database import MANIFEST_FILE
 from tqdm import tqdm
 
+# database_partition_strategy.py が分割定義（partition_specs）を書き出すファイル
+STRATEGY_FILE = "partition_strategy.json"
+
+# 1回の INSERT ... SELECT でコピーする画像数
+COPY_CHUNK = 50000
+
+
+def _remove_database_files(db_path):
+    """データベースファイルとWALの付随ファイルを削除"""
+    for path in [db_path, f"{db_path}-wal", f"{db_path}-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _build_shard(source_path, assignment_path, shard_index, name, path, position=0, chunk_size=COPY_CHUNK):
+    """
+    1つのシャードを作成（ProcessPoolExecutor のワーカーで実行）
+    元データベースと割り当て表を ATTACH し、画像・関連・タグを INSERT ... SELECT で元のIDのままコピーする
+    インデックス・集計テーブル・FTSはコピー後に ImageDatabase の初期化で作成する
+    """
+    build_start = time.time()
+    _remove_database_files(path)
+
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    # 作成途中のファイルは失敗したら作り直すため、ジャーナルと fsync を省略する
+    cursor.execute('PRAGMA journal_mode = OFF')
+    cursor.execute('PRAGMA synchronous = OFF')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.execute('PRAGMA cache_size = -262144')
+    ImageDatabase._create_tables(cursor)
+    cursor.execute('ATTACH DATABASE ? AS src', (os.path.abspath(source_path),))
+    cursor.execute('ATTACH DATABASE ? AS asg', (os.path.abspath(assignment_path),))
+
+    cursor.execute('CREATE TEMP TABLE shard_images (id INTEGER PRIMARY KEY)')
+    cursor.execute('INSERT INTO temp.shard_images (id) SELECT image_id FROM asg.assignment WHERE shard = ?',
+                   (shard_index,))
+
+    cursor.execute('SELECT COUNT(*) FROM temp.shard_images')
+    image_count = cursor.fetchone()[0]
+    cursor.execute('SELECT COUNT(*) FROM temp.shard_images s JOIN src.image_tags it ON it.image_id = s.id')
+    relation_count = cursor.fetchone()[0]
+
+    # 画像IDの範囲ごとに画像と関連をコピー（進捗は行数/秒で表示）
+    with tqdm(total=image_count + relation_count, unit="rows", unit_scale=True,
+              desc=name, position=position) as progress:
+        last_id = 0
+        while True:
+            cursor.execute('''
+                SELECT MAX(id) FROM (SELECT id FROM temp.shard_images WHERE id > ? ORDER BY id LIMIT ?)
+            ''', (last_id, chunk_size))
+            chunk_end = cursor.fetchone()[0]
+            if chunk_end is None:
+                break
+            cursor.execute('''
+                INSERT INTO images (id, filepath, filename, created_at)
+                SELECT i.id, i.filepath, i.filename, i.created_at
+                FROM temp.shard_images s JOIN src.images i ON i.id = s.id
+                WHERE s.id > ? AND s.id <= ?
+            ''', (last_id, chunk_end))
+            progress.update(cursor.rowcount)
+            cursor.execute('''
+                INSERT INTO image_tags (id, image_id, tag_id, confidence)
+                SELECT it.id, it.image_id, it.tag_id, it.confidence
+                FROM temp.shard_images s JOIN src.image_tags it ON it.image_id = s.id
+                WHERE s.id > ? AND s.id <= ?
+            ''', (last_id, chunk_end))
+            progress.update(cursor.rowcount)
+            last_id = chunk_end
+
+    # シャード内で使われているタグのみ元のIDでコピー
+    cursor.execute('''
+        INSERT INTO tags (id, tag_name)
+        SELECT t.id, t.tag_name FROM src.tags t
+        WHERE t.id IN (SELECT DISTINCT tag_id FROM main.image_tags)
+    ''')
+    tag_count = cursor.rowcount
+    conn.commit()
+    cursor.execute('DETACH DATABASE asg')
+    cursor.execute('DETACH DATABASE src')
+    conn.close()
+
+    # データ投入後にインデックス・集計テーブル・FTSを作成し、トリガーなしでコピーした group_mask を計算
+    index_start = time.time()
+    shard_db = ImageDatabase(path, profile="bulk_ingest")
+    shard_db.backfill_group_masks()
+    shard_db.close_connections()
+
+    return {
+        "name": name,
+        "path": path,
+        "images": image_count,
+        "relations": relation_count,
+        "tags": tag_count,
+        "index_time": time.time() - index_start,
+        "time": time.time() - build_start,
+    }
+
+
+def load_strategy_specs(path=STRATEGY_FILE):
+    """partition_strategy.json の分割定義を読み込む（ファイルがなければ空）"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return {name: PartitionSpec.from_dict(spec) for name, spec in data.get("partition_specs", {}).items()}
+
+
 class DatabaseSplitter:
     def __init__(self, source_db="image_search.db"):
         self.source_db = source_db
         self.db = ImageDatabase(source_db)
     
-    def create_split_databases(self, strategy="solo_multi"):
-        """分割戦略に基づいてデータベースを作成"""
-        print(f"🔄 データベース分割を開始します (戦略: {strategy})")
-        
-        if strategy == "solo_multi":
-            self._split_solo_multi()
-        elif strategy == "detailed":
-            self._split_detailed()
-        else:
-            raise ValueError(f"未対応の戦略: {strategy}")
+    @staticmethod
+    def _resolve_spec(spec):
+        """戦略名（STANDARD_SPECS のキー）または PartitionSpec を PartitionSpec にする"""
+        return spec if isinstance(spec, PartitionSpec) else PartitionSpec.standard(spec)
     
-    def _split_solo_multi(self):
-        """ソロ・複数人での2分割"""
-        print("📊 ソロ・複数人分割を実行中...")
-        
-        # 分割用データベースを作成
-        solo_db_path = "image_search_solo.db"
-        multi_db_path = "image_search_multi.db"
-        
-        # 既存ファイルを削除
-        for db_path in [solo_db_path, multi_db_path]:
-            if os.path.exists(db_path):
-                os.remove(db_path)
-        
-        # 新しいデータベースを初期化
-        solo_db = ImageDatabase(solo_db_path)
-        multi_db = ImageDatabase(multi_db_path)
-        
-        conn = self.db.get_connection()
-        cursor = conn.cursor()
-        
-        # ソロ画像を取得
-        print("🔍 ソロ画像を抽出中...")
-        cursor.execute('''
-            SELECT DISTINCT i.id, i.filepath, i.filename
-            FROM images i
-            JOIN image_tags it ON i.id = it.image_id
-            JOIN tags t ON it.tag_id = t.id
-            WHERE t.tag_name = 'solo'
-        ''')
-        solo_images = cursor.fetchall()
-        
-        # 全画像を取得
-        cursor.execute('SELECT id, filepath, filename FROM images')
-        all_images = cursor.fetchall()
-        
-        # ソロ画像のIDセットを作成
-        solo_image_ids = {img[0] for img in solo_images}
-        
-        # 複数人画像を特定
-        multi_images = [img for img in all_images if img[0] not in solo_image_ids]
-        
-        print(f"📈 分割統計:")
-        print(f"  - ソロ画像: {len(solo_images):,}件")
-        print(f"  - 複数人画像: {len(multi_images):,}件")
-        
-        # ソロ画像とタグをコピー
-        print("💾 ソロデータベースを作成中...")
-        self._copy_images_with_tags(solo_images, solo_db, conn)
-        
-        # 複数人画像とタグをコピー
-        print("💾 複数人データベースを作成中...")
-        self._copy_images_with_tags(multi_images, multi_db, conn)
-        
-        conn.close()
-        
-        print(f"✅ 分割完了!")
-        print(f"  - ソロDB: {solo_db_path}")
-        print(f"  - 複数人DB: {multi_db_path}")
+    def _tag_ids(self, spec):
+        """分割定義に出てくるタグのID"""
+        tags = set().union(*(shard.all | shard.any | shard.none for shard in spec.shards))
+        return {tag: tag_id for tag, (tag_id, _) in self.db.get_tag_info(list(tags)).items()}
     
-    def _split_detailed(self):
-        """詳細分割（女性ソロ、男性ソロ、カップル、その他）"""
-        print("📊 詳細分割を実行中...")
-        
-        # 分割用データベースを作成
-        db_paths = {
-            'girl_solo': "image_search_girl_solo.db",
-            'boy_solo': "image_search_boy_solo.db", 
-            'couple': "image_search_couple.db",
-            'others': "image_search_others.db"
-        }
-        
-        # 既存ファイルを削除
-        for db_path in db_paths.values():
-            if os.path.exists(db_path):
-                os.remove(db_path)
-        
-        # 新しいデータベースを初期化
-        databases = {
-            key: ImageDatabase(path) for key, path in db_paths.items()
-        }
-        
-        conn = self.db.get_connection()
-        cursor = conn.cursor()
-        
-        # 各カテゴリの画像を取得
-        categories = {}
-        
-        # 女性ソロ
-        cursor.execute('''
-            SELECT DISTINCT i.id, i.filepath, i.filename
-            FROM images i
-            JOIN image_tags it1 ON i.id = it1.image_id
-            JOIN tags t1 ON it1.tag_id = t1.id
-            JOIN image_tags it2 ON i.id = it2.image_id
-            JOIN tags t2 ON it2.tag_id = t2.id
-            WHERE t1.tag_name = '1girl' AND t2.tag_name = 'solo'
-        ''')
-        categories['girl_solo'] = cursor.fetchall()
-        
-        # 男性ソロ
-        cursor.execute('''
-            SELECT DISTINCT i.id, i.filepath, i.filename
-            FROM images i
-            JOIN image_tags it1 ON i.id = it1.image_id
-            JOIN tags t1 ON it1.tag_id = t1.id
-            JOIN image_tags it2 ON i.id = it2.image_id
-            JOIN tags t2 ON it2.tag_id = t2.id
-            WHERE t1.tag_name = '1boy' AND t2.tag_name = 'solo'
-        ''')
-        categories['boy_solo'] = cursor.fetchall()
-        
-        # カップル
-        cursor.execute('''
-            SELECT DISTINCT i.id, i.filepath, i.filename
-            FROM images i
-            JOIN image_tags it1 ON i.id = it1.image_id
-            JOIN tags t1 ON it1.tag_id = t1.id
-            JOIN image_tags it2 ON i.id = it2.image_id
-            JOIN tags t2 ON it2.tag_id = t2.id
-            WHERE t1.tag_name = '1boy' AND t2.tag_name = '1girl'
-        ''')
-        categories['couple'] = cursor.fetchall()
-        
-        # 全画像を取得
-        cursor.execute('SELECT id, filepath, filename FROM images')
-        all_images = cursor.fetchall()
-        
-        # 既に分類された画像のIDセット
-        classified_ids = set()
-        for images in categories.values():
-            classified_ids.update(img[0] for img in images)
-        
-        # その他の画像
-        categories['others'] = [img for img in all_images if img[0] not in classified_ids]
-        
-        print(f"📈 詳細分割統計:")
-        for category, images in categories.items():
-            print(f"  - {category}: {len(images):,}件")
-        
-        # 各カテゴリのデータベースを作成
-        for category, images in categories.items():
-            print(f"💾 {category}データベースを作成中...")
-            self._copy_images_with_tags(images, databases[category], conn)
-        
-        conn.close()
-        
-        print(f"✅ 詳細分割完了!")
-        for category, path in db_paths.items():
-            print(f"  - {category}DB: {path}")
+    def _build_assignment(self, spec, assignment_path):
+        """元データベースを1回走査して各画像のシャード番号を割り当て表に書き、シャードごとの件数を返す"""
+        case_sql, params = spec.assignment_sql(self._tag_ids(spec), relation_table="src.image_tags")
+        _remove_database_files(assignment_path)
+        conn = sqlite3.connect(assignment_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA journal_mode = OFF')
+            cursor.execute('PRAGMA synchronous = OFF')
+            cursor.execute('ATTACH DATABASE ? AS src', (os.path.abspath(self.source_db),))
+            cursor.execute('CREATE TABLE assignment (image_id INTEGER PRIMARY KEY, shard INTEGER NOT NULL)')
+            cursor.execute(f'INSERT INTO assignment (image_id, shard) SELECT i.id, {case_sql} FROM src.images i',
+                           params)
+            cursor.execute('CREATE INDEX idx_assignment_shard ON assignment(shard, image_id)')
+            conn.commit()
+            cursor.execute('SELECT shard, COUNT(*) FROM assignment GROUP BY shard')
+            return dict(cursor.fetchall())
+        finally:
+            conn.close()
     
-    def _copy_images_with_tags(self, images, target_db, source_conn):
-        """画像とそのタグを対象データベースにコピー"""
-        source_cursor = source_conn.cursor()
-        
-        for image_id, filepath, filename in tqdm(images, desc="画像をコピー中"):
-            # 画像のタグを取得
-            source_cursor.execute('''
-                SELECT t.tag_name
-                FROM tags t
-                JOIN image_tags it ON t.id = it.tag_id
-                WHERE it.image_id = ?
-            ''', (image_id,))
+    def create_split_databases(self, spec="solo_multi", max_workers=None):
+        """
+        分割定義に基づいてデータベースを作成
+        spec: STANDARD_SPECS の戦略名または PartitionSpec
+        画像の割り当ては元データベースを1回走査して決め、シャードは別プロセスで並列に作成する
+        （max_workers: プロセス数、既定はシャード数）
+        """
+        spec = self._resolve_spec(spec)
+        print(f"🔄 データベース分割を開始します ({len(spec.shards)}シャード)")
+        
+        split_start = time.time()
+        assignment_path = os.path.abspath(self.source_db) + ".partition"
+        try:
+            shard_sizes = self._build_assignment(spec, assignment_path)
+            print(f"🔍 割り当て完了 ({time.time() - split_start:.1f}秒): "
+                  + ", ".join(f"{shard.name}={shard_sizes.get(index, 0):,}件"
+                              for index, shard in enumerate(spec.shards)))
             
-            tags = [row[0] for row in source_cursor.fetchall()]
-            
-            # 対象データベースに追加
-            try:
-                target_db.add_image_with_tags(filepath, tags)
-            except Exception as e:
-                print(f"⚠️  画像追加エラー {filepath}: {e}")
-    
-    def create_router_logic(self):
-        """分割されたデータベースを使用するためのルーターロジックを生成"""
-        router_code = '''
-# database_router.py
-"""
-分割されたデータベースへのルーティングロジック
-"""
-
-from database import ImageDatabase
-
-class DatabaseRouter:
-    def __init__(self):
-        self.solo_db = ImageDatabase("image_search_solo.db")
-        self.multi_db = ImageDatabase("image_search_multi.db")
-    
-    def search_images(self, positive_tags, negative_tags=None, limit=50):
-        """適切なデータベースを選択して検索"""
-        positive_tags_set = set(tag.lower() for tag in positive_tags)
-        
-        # ソロタグが含まれている場合
-        if 'solo' in positive_tags_set:
-            print("🎯 ソロデータベースで検索")
-            return self.solo_db.search_images(positive_tags, negative_tags, limit)
-        
-        # 複数人を示すタグが含まれている場合
-        multi_tags = {'2girls', '3girls', '4girls', '5girls', 'multiple_girls',
-                     '2boys', '3boys', '4boys', '5boys', 'multiple_boys'}
-        
-        if positive_tags_set.intersection(multi_tags):
-            print("🎯 複数人データベースで検索")
-            return self.multi_db.search_images(positive_tags, negative_tags, limit)
-        
-        # 判断できない場合は両方を検索してマージ
-        print("🎯 両方のデータベースで検索")
-        solo_results = self.solo_db.search_images(positive_tags, negative_tags, limit//2)
-        multi_results = self.multi_db.search_images(positive_tags, negative_tags, limit//2)
-        
-        # 結果をマージしてソート
-        all_results = list(solo_results) + list(multi_results)
-        all_results.sort(key=lambda x: x[3], reverse=True)  # match_countでソート
-        
-        return all_results[:limit]
-
-# 使用例
-if __name__ == "__main__":
-    router = DatabaseRouter()
-    
-    # ソロ検索
-    results = router.search_images(['1girl', 'solo'])
-    print(f"ソロ検索結果: {len(results)}件")
+            with ProcessPoolExecutor(max_workers=max_workers or len(spec.shards)) as executor:
+                futures = [
+                    executor.submit(_build_shard, self.source_db, assignment_path, index,
+                                    shard.name, shard.path, index)
+                    for index, shard in enumerate(spec.shards)
+                ]
+                results = [future.result() for future in futures]
+        finally:
+            _remove_database_files(assignment_path)
+        elapsed = time.time() - split_start
+        
+        total_rows = sum(result["images"] + result["relations"] for result in results)
+        print(f"📈 分割統計:")
+        for result in results:
+            print(f"  - {result['name']}: {result['images']:,}件 (関連 {result['relations']:,}件, "
+                  f"タグ {result['tags']:,}件, {result['time']:.1f}秒, "
+                  f"うちインデックス作成 {result['index_time']:.1f}秒) → {result['path']}")
+        print(f"✅ 分割完了! ({elapsed:.1f}秒, {total_rows / max(elapsed, 1e-9):,.0f}行/秒)")
+        return results
     
-    # 複数人検索
-    results = router.search_images(['2girls'])
-    print(f"複数人検索結果: {len(results)}件")
-'''
-        
-        with open('database_router.py', 'w', encoding='utf-8') as f:
-            f.write(router_code)
-        
-        print("📝 database_router.py を作成しました")
+    def create_router_logic(self, spec="solo_multi"):
+        """分割定義を ShardedImageDatabase が読み込むマニフェストとして保存"""
+        self._resolve_spec(spec).save(MANIFEST_FILE)
 
 def main():
     """メイン実行関数"""
@@ -270,21 +211,35 @@ def main():
         print("分割戦略を選択してください:")
         print("1. ソロ・複数人分割 (推奨)")
         print("2. 詳細分割 (女性ソロ、男性ソロ、カップル、その他)")
-        print("3. ルーターロジックのみ生成")
+        print(f"3. {STRATEGY_FILE} の分割定義を使用")
+        print("4. シャードマニフェストのみ生成 (ソロ・複数人)")
         
-        choice = input("選択 (1-3): ").strip()
+        choice = input("選択 (1-4): ").strip()
         
         if choice == "1":
-            splitter.create_split_databases("solo_multi")
-            splitter.create_router_logic()
+            spec = PartitionSpec.standard("solo_multi")
         elif choice == "2":
-            splitter.create_split_databases("detailed")
+            spec = PartitionSpec.standard("detailed")
         elif choice == "3":
+            specs = load_strategy_specs()
+            if not specs:
+                print(f"❌ {STRATEGY_FILE} に分割定義がありません（database_partition_strategy.py を実行してください）")
+                return
+            names = list(specs)
+            for number, name in enumerate(names, 1):
+                print(f"  {number}. {name}: {', '.join(shard.name for shard in specs[name].shards)}")
+            spec = specs[names[int(input(f"選択 (1-{len(names)}): ").strip()) - 1]]
+        elif choice == "4":
             splitter.create_router_logic()
+            print("\n✅ 処理完了!")
+            return
         else:
             print("❌ 無効な選択です")
             return
         
+        splitter.create_split_databases(spec)
+        splitter.create_router_logic(spec)
+        
         print("\n✅ 処理完了!")
         
     except Exception as e:
@@ -293,4 +248,4 @@ def main():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,106 @@
+# file_serving.py
+"""
+画像ファイルの配信方法
+Web側では画像ID → ファイルパスの解決と配信可否の確認だけを行い、ファイルの転送は設定に応じて任せる
+
+    send_file:  Flask の send_file（Range・条件付きGETに対応）。os.sendfile は直接呼ばず、WSGI サーバーの
+                wsgi.file_wrapper に任せる（gunicorn の sync ワーカーなどでは全体の転送が os.sendfile になるが、
+                wsgi.file_wrapper のないサーバーや Range 応答では Python が読み出して送る）
+    x-sendfile: X-Sendfile ヘッダーでファイルの絶対パスを返し、前段のサーバー（Apache mod_xsendfile / lighttpd）が送る
+    x-accel:    X-Accel-Redirect ヘッダーで nginx の internal location を返し、nginx が送る（Range は nginx が処理）
+
+配信できるのはルート（IMAGE_ROOTS）配下のファイルのみ（ルート未指定なら制限なし、x-accel はルートが必須）
+"""
+
+import mimetypes
+import os
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+from flask import current_app, send_file
+
+SERVE_MODES = ("send_file", "x-sendfile", "x-accel")
+
+
+def parse_roots(value: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    IMAGE_ROOTS の値を (ディレクトリ, nginx の internal location) のリストにする
+    形式: "/data/images=/protected/images,/mnt/archive=/protected/archive"（location は x-accel でのみ必要）
+    """
+    roots = []
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        root, _, location = entry.partition("=")
+        roots.append((root.strip(), location.strip() or None))
+    return roots
+
+
+class FileServer:
+    def __init__(self, mode: str = "send_file", roots: List[Tuple[str, Optional[str]]] = None):
+        """
+        mode: SERVE_MODES のいずれか
+        roots: 配信を許可するディレクトリと、x-accel の場合に対応する nginx の internal location
+        """
+        if mode not in SERVE_MODES:
+            raise ValueError(f"未対応の配信方法: {mode}")
+        self.mode = mode
+        self.roots = []
+        for root, location in roots or []:
+            self.add_root(root, location)
+
+    def add_root(self, root: str, location: str = None):
+        """配信を許可するディレクトリを追加"""
+        if self.mode == "x-accel" and not location:
+            raise ValueError(f"x-accel では internal location の指定が必要です: {root}")
+        self.roots.append((os.path.realpath(root), location.rstrip("/") if location else None))
+
+    def resolve(self, filepath: str) -> Tuple[str, Optional[Tuple[str, Optional[str]]]]:
+        """
+        シンボリックリンク・".." を解決した実パスと、それを含むルートを返す
+        ルート外のファイルは PermissionError（ルート未指定で x-accel 以外なら制限しない）
+        """
+        real_path = os.path.realpath(filepath)
+        for root in self.roots:
+            try:
+                inside = os.path.commonpath([real_path, root[0]]) == root[0]
+            except ValueError:
+                # ドライブが異なる（Windows）などで比較できないパスはルート外として扱う
+                inside = False
+            if inside:
+                return real_path, root
+        if self.roots or self.mode == "x-accel":
+            raise PermissionError(f"配信が許可されていないパス: {filepath}")
+        return real_path, None
+
+    def response(self, filepath: str, mimetype: str = None, etag=True, last_modified=None, max_age: int = None):
+        """
+        ファイルを配信するレスポンスを作る（ルート外なら PermissionError）
+        条件付きGET（304）と Range は send_file では werkzeug が、それ以外は前段のサーバーが処理する
+        etag: True ならファイルから生成、文字列ならその値（元ファイルから決まるサムネイルの ETag など）
+        last_modified: Last-Modified に使う時刻（None ならファイルの更新時刻）
+        max_age: 指定すると Cache-Control: public, max-age を付ける
+        """
+        real_path, root = self.resolve(filepath)
+        mimetype = mimetype or mimetypes.guess_type(real_path)[0] or "application/octet-stream"
+
+        if self.mode == "send_file":
+            return send_file(real_path, mimetype=mimetype, conditional=True, etag=etag,
+                             last_modified=last_modified, max_age=max_age)
+
+        # 本文は前段のサーバーが送るため空のレスポンスにヘッダーだけを付ける
+        response = current_app.response_class(mimetype=mimetype)
+        if isinstance(etag, str):
+            response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        if max_age is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+        if self.mode == "x-sendfile":
+            response.headers["X-Sendfile"] = real_path
+        else:
+            relative = os.path.relpath(real_path, root[0]).replace(os.sep, "/")
+            response.headers["X-Accel-Redirect"] = f"{root[1]}/{quote(relative)}"
+        return response
@@ -0,0 +1,112 @@
+# file_status_cache.py
+"""
+画像ファイルの存在確認キャッシュ
+ファイルパスごとに存在するかどうかを確認時刻付きで保持し、有効期間内は stat しない
+存在しないファイルも短い有効期間でキャッシュする（ネガティブキャッシュ）
+
+キャッシュにないファイルは、まず file_status テーブル（check_data_integrity.py と登録時の記録）を
+1回のクエリで引き、それでも分からないものだけをスレッドプールでまとめて確認する
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+
+class FileStatusCache:
+    def __init__(self, ttl: float = 300.0, negative_ttl: float = 30.0, max_entries: int = 100000,
+                 workers: int = 16, source=None):
+        """
+        ttl: 存在するファイルの有効期間（秒）
+        negative_ttl: 存在しないファイルの有効期間（秒、復旧したファイルを早めに拾うため短くする）
+        max_entries: 保持するファイル数の上限（超えた分は最も古く使われたものから破棄）
+        workers: まとめて確認するときのスレッド数
+        source: get_file_statuses(filepaths, since) を持つデータベース（None なら記録を参照しない）
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.workers = workers
+        self.source = source
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self.hits = 0
+        self.recorded_hits = 0
+        self.checks = 0
+
+    def _is_fresh(self, exists: bool, checked_at: float, now: float) -> bool:
+        return now - checked_at <= (self.ttl if exists else self.negative_ttl)
+
+    def _store(self, filepath: str, exists: bool, checked_at: float):
+        """ロックを取得した状態で呼ぶ"""
+        self._entries[filepath] = (checked_at, exists)
+        self._entries.move_to_end(filepath)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, filepath: str, exists: bool, checked_at: float = None):
+        """確認済みの結果を登録（配信時に見つからなかったファイルなど）"""
+        with self._lock:
+            self._store(filepath, exists, checked_at or time.time())
+
+    def _check_files(self, filepaths: List[str]) -> List[bool]:
+        """ファイルの存在をまとめて確認（複数あればスレッドプールで並行に stat する）"""
+        if len(filepaths) == 1:
+            return [os.path.exists(filepaths[0])]
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return list(self._executor.map(os.path.exists, filepaths))
+
+    def check_many(self, filepaths: List[str]) -> Dict[str, bool]:
+        """ファイルパス → 存在するか（キャッシュ → file_status の記録 → stat の順に引く）"""
+        now = time.time()
+        results = {}
+        misses = []
+        with self._lock:
+            for filepath in dict.fromkeys(filepaths):
+                entry = self._entries.get(filepath)
+                if entry is not None and self._is_fresh(entry[1], entry[0], now):
+                    self._entries.move_to_end(filepath)
+                    results[filepath] = entry[1]
+                else:
+                    misses.append(filepath)
+            self.hits += len(results)
+
+        if misses and self.source is not None:
+            recorded = self.source.get_file_statuses(misses, now - max(self.ttl, self.negative_ttl))
+            with self._lock:
+                for filepath, (exists, checked_at) in recorded.items():
+                    if self._is_fresh(exists, checked_at, now):
+                        self._store(filepath, exists, checked_at)
+                        results[filepath] = exists
+                        self.recorded_hits += 1
+            misses = [filepath for filepath in misses if filepath not in results]
+
+        if misses:
+            checked_at = time.time()
+            statuses = self._check_files(misses)
+            with self._lock:
+                for filepath, exists in zip(misses, statuses):
+                    self._store(filepath, exists, checked_at)
+                    results[filepath] = exists
+                self.checks += len(misses)
+        return results
+
+    def exists(self, filepath: str) -> bool:
+        return self.check_many([filepath])[filepath]
+
+    def stats(self):
+        """ヒット数などの統計情報"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'recorded_hits': self.recorded_hits,
+                'checks': self.checks,
+                'size': len(self._entries),
+            }
@@ -1,16 +1,79 @@
 # image_processor.py
 import os
 import glob
-from typing import List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence
 from database import ImageDatabase
+from thumbnails import ThumbnailCache, DEFAULT_THUMBNAIL_SIZE
 
 class ImageProcessor:
-    def __init__(self, tag_method, db: ImageDatabase):
+    def __init__(self, tag_method, db: ImageDatabase, batches_per_commit: int = 16,
+                 thumbnail_cache: ThumbnailCache = None, thumbnail_sizes: Sequence[int] = (DEFAULT_THUMBNAIL_SIZE,),
+                 thumbnail_workers: int = 2):
         """
-        tag_method: 既存のタグ化メソッド（最大4枚の画像パスのリストを受け取り、タグのリストのリストを返す）
+        tag_method: 既存のタグ化メソッド（最大4枚の画像パスのリストを受け取り、(ファイル名, タグ) のリストを返す）
+                    タグは (タグ名, 信頼度) のリスト、またはカンマ区切りの文字列（信頼度1.0として扱う）
+                    thumbnail_cache を指定した場合は (画像パス, PIL.Image) のリストを受け取る
+                    （TensorRTTagger.infer_batch はどちらも受け付ける）
+        batches_per_commit: 何バッチ分の結果を1トランザクションでデータベースに書き込むか
+        thumbnail_cache: 指定すると、タグ化のためにデコードした画像から配信用サムネイルを作成する
+        thumbnail_sizes: 事前に作成するサムネイルのサイズ
+        thumbnail_workers: サムネイルを作成するスレッド数（推論とは別スレッドで実行）
         """
         self.tag_method = tag_method
         self.db = db
+        self.batches_per_commit = batches_per_commit
+        self.thumbnail_cache = thumbnail_cache
+        self.thumbnail_sizes = tuple(thumbnail_sizes)
+        self.thumbnail_workers = thumbnail_workers
+        self._thumbnail_executor = None
+        # 未処理のサムネイル作業の上限（デコード済み画像を溜め込みすぎないよう、超えた分は作らない）
+        self._thumbnail_slots = threading.BoundedSemaphore(thumbnail_workers * 8)
+        # filepath → (縮小処理の Future, 元ファイルの更新時刻)（データベースに保存して画像IDが決まるまで保持）
+        self._pending_thumbnails = {}
+        self.thumbnails_written = 0
+        # 上限に達していたため事前に作らなかったサムネイル（初回アクセス時に serve_thumbnail が作る）
+        self.thumbnails_skipped = 0
+        self._thumbnail_count_lock = threading.Lock()
+    
+    def _submit_thumbnail_task(self, function, *args):
+        """
+        サムネイル作業をスレッドプールに投入（未処理が上限に達していれば投入せず None を返す）
+        推論のループをサムネイル作成で待たせないため、溢れた分は配信時の作成に任せる
+        """
+        if not self._thumbnail_slots.acquire(blocking=False):
+            self.thumbnails_skipped += 1
+            return None
+        future = self._thumbnail_executor.submit(function, *args)
+        future.add_done_callback(lambda _: self._thumbnail_slots.release())
+        return future
+    
+    def _render_thumbnails(self, image):
+        """デコード済みの画像からサイズごとのサムネイルを作る（向きは EXIF に合わせる）"""
+        from PIL import ImageOps
+        image = ImageOps.exif_transpose(image)
+        return {size: self.thumbnail_cache.render(image, size) for size in self.thumbnail_sizes}
+    
+    def _write_thumbnails(self, image_id, render_future, mtime_ns):
+        """縮小済みのサムネイルを画像IDのキーで保存（失敗しても登録は続ける）"""
+        try:
+            for size, thumbnail in render_future.result().items():
+                self.thumbnail_cache.write(image_id, thumbnail, size, mtime_ns)
+            with self._thumbnail_count_lock:
+                self.thumbnails_written += 1
+        except Exception as e:
+            print(f"✗ Error writing thumbnail for image {image_id}: {e}")
+    
+    def _load_batch(self, batch):
+        """タグ化とサムネイル作成で共有するため、バッチの画像を1回だけデコード"""
+        from PIL import Image
+        loaded = []
+        for filepath in batch:
+            image = Image.open(filepath)
+            image.load()
+            loaded.append((filepath, image, os.stat(filepath).st_mtime_ns))
+        return loaded
     
     def process_directory(self, directory_path: str, extensions: List[str] = None):
         """ディレクトリ内の全画像を処理"""
@@ -43,6 +106,9 @@ class ImageProcessor:
         # 4枚ずつバッチ処理
         batch_size = 4
         processed_count = 0
+        pending = []
+        if self.thumbnail_cache is not None:
+            self._thumbnail_executor = ThreadPoolExecutor(max_workers=self.thumbnail_workers)
         
         for i in range(0, len(image_files), batch_size):
             batch = image_files[i:i + batch_size]
@@ -52,23 +118,86 @@ class ImageProcessor:
 
                 # タグ化実行
                 print(f"Processing batch {i//batch_size + 1}/{(len(image_files) + batch_size - 1)//batch_size} ({percent}%)")
-                tags_list = self.tag_method(batch)
+                if self.thumbnail_cache is not None:
+                    loaded = self._load_batch(batch)
+                    tags_list = self.tag_method([(filepath, image) for filepath, image, _ in loaded])
+                    # 推論が終わった画像の縮小は別スレッドで行う（画像IDは保存時に決まる）
+                    for filepath, image, mtime_ns in loaded:
+                        render_future = self._submit_thumbnail_task(self._render_thumbnails, image)
+                        if render_future is not None:
+                            self._pending_thumbnails[filepath] = (render_future, mtime_ns)
+                    loaded = None
+                else:
+                    tags_list = self.tag_method(batch)
 
                 print("tags_list", tags_list)
                 
-                # データベースに保存
-                for filepath, tags in zip(batch, tags_list):
-                    tags = [tag.strip() for tag in tags[1].split(",")]
+                for filepath, (_, tags) in zip(batch, tags_list):
+                    if isinstance(tags, str):
+                        tags = [tag.strip() for tag in tags.split(",")]
                     print("filepath", filepath, "tags", tags)
-                    try:
-                        self.db.add_image_with_tags(filepath, tags)
-                        processed_count += 1
-                        print(f"✓ Processed: {os.path.basename(filepath)} - Tags: {', '.join(tags[:5])}...")
-                    except Exception as e:
-                        print(f"✗ Error processing {filepath}: {e}")
+                    pending.append((filepath, tags))
                         
             except Exception as e:
                 print(f"✗ Error processing batch: {e}")
                 continue
+            
+            # 複数バッチ分をまとめてデータベースに保存
+            if len(pending) >= batch_size * self.batches_per_commit:
+                processed_count += self._flush(pending)
+                pending = []
+        
+        if pending:
+            processed_count += self._flush(pending)
+        
+        if self._thumbnail_executor is not None:
+            # 残りのサムネイルの書き込みを待つ
+            self._thumbnail_executor.shutdown(wait=True)
+            self._thumbnail_executor = None
+            self._pending_thumbnails.clear()
+            print(f"Thumbnails written: {self.thumbnails_written}, skipped (created on first request): "
+                  f"{self.thumbnails_skipped}")
+        
+        print(f"Processing complete! {processed_count}/{len(image_files)} images processed successfully.")
+    
+    def _flush(self, pending):
+        """タグ付け済みの画像を1トランザクションでデータベースに保存し、保存件数を返す"""
+        try:
+            image_ids = self.db.add_images_with_tags_batch(pending)
+        except Exception as e:
+            # 1件の不正なデータでまとめて失われないよう、1件ずつ保存し直して失敗したものだけを除く
+            print(f"✗ Error saving {len(pending)} images: {e} - retrying one by one")
+            saved, image_ids = [], []
+            for item in pending:
+                try:
+                    image_ids.extend(self.db.add_images_with_tags_batch([item]))
+                    saved.append(item)
+                except Exception as item_error:
+                    print(f"✗ Error saving {item[0]}: {item_error}")
+                    self._pending_thumbnails.pop(item[0], None)
+            pending = saved
+        
+        # 画像IDが決まったのでサムネイルを書き込む（縮小が終わっていなければスレッド側で待つ）
+        # 縮小済みのサムネイルは小さいため、書き込みは上限を設けずに投入する
+        for (filepath, _), image_id in zip(pending, image_ids):
+            thumbnail = self._pending_thumbnails.pop(filepath, None)
+            if thumbnail is not None:
+                self._thumbnail_executor.submit(self._write_thumbnails, image_id, *thumbnail)
+        
+        # 読み込んだばかりのファイルのサイズ・更新時刻を記録（Web側の存在確認キャッシュが参照する）
+        statuses = {}
+        for filepath, _ in pending:
+            try:
+                stat = os.stat(filepath)
+                statuses[filepath] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                statuses[filepath] = None
+        try:
+            self.db.record_file_statuses(statuses)
+        except Exception as e:
+            print(f"✗ Error recording file status: {e}")
         
-        print(f"Processing complete! {processed_count}/{len(image_files)} images processed successfully.")
\ No newline at end of file
+        for filepath, tags in pending:
+            tag_names = [tag if isinstance(tag, str) else tag[0] for tag in tags[:5]]
+            print(f"✓ Processed: {os.path.basename(filepath)} - Tags: {', '.join(tag_names)}...")
+        return len(pending)
\ No newline at end of file
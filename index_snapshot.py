@@ -0,0 +1,203 @@
+# index_snapshot.py
+"""
+image_tags のCSR（タグ優先）インデックスとディスク上のスナップショット
+offsets[i]:offsets[i+1] が i 番目のタグの画像ID（昇順）と信頼度の範囲になる
+スナップショットは .npy と JSON で保存し、numpy.memmap で開くため複数のワーカープロセスが
+同じページキャッシュを共有でき、起動時にSQLiteから再構築する必要がない
+
+ディレクトリ構成:
+    <dir>/CURRENT                  最新スナップショットのサブディレクトリ名
+    <dir>/gen-<generation>/
+        header.json                バージョン・データベースの世代・件数
+        offsets.npy                int64 [タグ数 + 1]
+        image_ids.npy              uint32 [関連数]（タグごとに昇順）
+        confidences.npy            float64 [関連数]（SQLite の REAL と同じ倍精度）
+        tag_ids.npy                int64 [タグ数]（昇順）
+        tag_names.json             タグ名 [タグ数]
+        images.npy                 uint32 [画像数]（昇順、画像ID → 行番号の対応）
+"""
+
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# スナップショットの形式が変わったら上げる（異なるバージョンは読み込まない）
+# 2: confidences を float32 から float64 に変更（しきい値の比較を SQLite と一致させるため。
+#    confidences.npy の大きさ・mmap する量は関連数 × 8 バイトと2倍になる）
+SNAPSHOT_VERSION = 2
+CURRENT_FILE = "CURRENT"
+
+
+class IndexSnapshot:
+    # image_tags 読み込み時のフェッチ件数
+    FETCH_CHUNK = 500000
+
+    def __init__(self, generation: int, offsets: np.ndarray, image_ids: np.ndarray, confidences: np.ndarray,
+                 tag_ids: np.ndarray, tag_names: List[str], images: np.ndarray):
+        self.generation = generation
+        self.offsets = offsets
+        self.image_ids = image_ids
+        # SQLと同じ結果を返すため、信頼度は image_tags.confidence（REAL）と同じ倍精度で保持する
+        # （float32 に丸めると 0.8 のような値でしきい値の比較と合計がSQLとずれる）
+        self.confidences = confidences
+        self.tag_ids = tag_ids
+        self.tag_names = tag_names
+        self.images = images
+        self.tag_rows: Dict[str, int] = {name: row for row, name in enumerate(tag_names)}
+
+    @property
+    def relation_count(self) -> int:
+        return len(self.image_ids)
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.tag_rows
+
+    def posting(self, tag: str) -> Tuple[np.ndarray, np.ndarray]:
+        """タグの (画像ID配列, 信頼度配列)。コピーせずにビューを返す"""
+        row = self.tag_rows[tag]
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return self.image_ids[start:end], self.confidences[start:end]
+
+    def image_rows(self, image_ids: np.ndarray) -> np.ndarray:
+        """画像IDを images 配列の行番号に変換（存在しない画像は -1）"""
+        if len(self.images) == 0:
+            return np.full(len(image_ids), -1, dtype=np.int64)
+        rows = np.searchsorted(self.images, image_ids)
+        rows[rows >= len(self.images)] = 0
+        return np.where(self.images[rows] == image_ids, rows, -1)
+
+    @classmethod
+    def from_database(cls, db) -> "IndexSnapshot":
+        """データベースからCSRインデックスを構築（世代と内容が一致するよう1つの読み取りトランザクションで読む）"""
+        conn = db.get_connection()
+        cursor = conn.cursor()
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            cursor.execute('BEGIN')
+        try:
+            generation = db.get_generation()
+
+            cursor.execute('SELECT id, tag_name FROM tags ORDER BY id')
+            tags = cursor.fetchall()
+            tag_ids = np.array([tag_id for tag_id, _ in tags], dtype=np.int64)
+            tag_names = [tag_name for _, tag_name in tags]
+
+            cursor.execute('SELECT id FROM images ORDER BY id')
+            images = np.array([row[0] for row in cursor.fetchall()], dtype=np.uint32)
+
+            # tag_id → image_id の順で読むため idx_it_tagid_imageid がそのまま使われる
+            cursor.execute('''
+                SELECT it.tag_id, it.image_id, it.confidence
+                FROM image_tags it
+                JOIN images i ON i.id = it.image_id
+                ORDER BY it.tag_id, it.image_id
+            ''')
+            chunks = []
+            while True:
+                rows = cursor.fetchmany(cls.FETCH_CHUNK)
+                if not rows:
+                    break
+                chunks.append(np.array(rows, dtype=np.float64))
+        finally:
+            if own_transaction:
+                conn.rollback()
+
+        rows = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.float64)
+        relation_tag_rows = np.searchsorted(tag_ids, rows[:, 0].astype(np.int64))
+        offsets = np.zeros(len(tag_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(relation_tag_rows, minlength=len(tag_ids)), out=offsets[1:])
+
+        return cls(generation, offsets, rows[:, 1].astype(np.uint32), rows[:, 2].copy(),
+                   tag_ids, tag_names, images)
+
+    def save(self, directory: str) -> str:
+        """
+        スナップショットを書き出し、保存先のパスを返す
+        世代ごとのサブディレクトリに書いてから CURRENT を置き換えるため、読み込み中のワーカーに影響しない
+        """
+        name = f"gen-{self.generation:012d}"
+        target = os.path.join(directory, name)
+        staging = target + ".tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        np.save(os.path.join(staging, "offsets.npy"), self.offsets)
+        np.save(os.path.join(staging, "image_ids.npy"), self.image_ids)
+        np.save(os.path.join(staging, "confidences.npy"), self.confidences)
+        np.save(os.path.join(staging, "tag_ids.npy"), self.tag_ids)
+        np.save(os.path.join(staging, "images.npy"), self.images)
+        with open(os.path.join(staging, "tag_names.json"), "w", encoding="utf-8") as f:
+            json.dump(self.tag_names, f, ensure_ascii=False)
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "generation": self.generation,
+            "tags": len(self.tag_ids),
+            "relations": self.relation_count,
+            "images": len(self.images),
+            "created_at": time.time(),
+        }
+        with open(os.path.join(staging, "header.json"), "w", encoding="utf-8") as f:
+            json.dump(header, f)
+
+        current_path = os.path.join(directory, CURRENT_FILE)
+        previous = None
+        if os.path.exists(current_path):
+            with open(current_path, encoding="utf-8") as f:
+                previous = f.read().strip()
+
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(staging, target)
+        current_tmp = current_path + ".tmp"
+        with open(current_tmp, "w", encoding="utf-8") as f:
+            f.write(name)
+        os.replace(current_tmp, current_path)
+
+        # 直前のスナップショットはまだ開いているワーカーが mmap しているため残し、それより古いものだけ削除
+        # （削除済みファイルの mmap が有効なままかどうかは OS に依存する）
+        for entry in os.listdir(directory):
+            if entry.startswith("gen-") and entry not in (name, previous):
+                shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+        return target
+
+    @staticmethod
+    def read_header(directory: str) -> dict:
+        """最新スナップショットのヘッダーを読む（スナップショットがなければ FileNotFoundError）"""
+        with open(os.path.join(directory, CURRENT_FILE), encoding="utf-8") as f:
+            name = f.read().strip()
+        with open(os.path.join(directory, name, "header.json"), encoding="utf-8") as f:
+            header = json.load(f)
+        header["path"] = os.path.join(directory, name)
+        return header
+
+    @classmethod
+    def load(cls, directory: str) -> "IndexSnapshot":
+        """最新スナップショットを memmap で開く（配列はコピーされない）"""
+        header = cls.read_header(directory)
+        if header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"未対応のスナップショットバージョン: {header.get('version')}")
+        path = header["path"]
+
+        def open_array(filename):
+            return np.load(os.path.join(path, filename), mmap_mode="r")
+
+        with open(os.path.join(path, "tag_names.json"), encoding="utf-8") as f:
+            tag_names = json.load(f)
+        return cls(header["generation"], open_array("offsets.npy"), open_array("image_ids.npy"),
+                   open_array("confidences.npy"), open_array("tag_ids.npy"), tag_names,
+                   open_array("images.npy"))
+
+
+def export_snapshot(db, directory: str) -> str:
+    """データベースからスナップショットを作成して保存"""
+    export_start = time.time()
+    os.makedirs(directory, exist_ok=True)
+    snapshot = IndexSnapshot.from_database(db)
+    path = snapshot.save(directory)
+    print(f"インデックススナップショットを保存: {path} "
+          f"(世代{snapshot.generation}, {len(snapshot.tag_ids)}タグ, {snapshot.relation_count}関連, "
+          f"{time.time() - export_start:.4f}秒)")
+    return path
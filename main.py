@@ -1,6 +1,8 @@
 # main.py
+import os
 from image_processor import ImageProcessor
 from database import ImageDatabase
+from thumbnails import ThumbnailCache
 
 def main():
     from trtagger import TensorRTTagger
@@ -8,10 +10,12 @@ def main():
     tagger = TensorRTTagger(model="wd-eva02-large-tagger-v3")
 
     # データベース初期化
-    db = ImageDatabase()
+    db = ImageDatabase(profile="bulk_ingest")
     
-    # 画像プロセッサー初期化
-    processor = ImageProcessor(tagger.infer_batch, db)
+    # 画像プロセッサー初期化（タグ化でデコードした画像から配信用サムネイルも作成、app.py と同じ設定を使う）
+    thumbnail_cache = ThumbnailCache(os.environ.get('THUMBNAIL_DIR', 'thumbnail_cache'),
+                                     os.environ.get('THUMBNAIL_FORMAT', 'webp'))
+    processor = ImageProcessor(tagger.infer_batch, db, thumbnail_cache=thumbnail_cache)
     
     # 画像ディレクトリを処理
     image_directory = "downloaded"  # 実際のパスに変更
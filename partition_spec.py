@@ -0,0 +1,231 @@
+# partition_spec.py
+"""
+データベース分割（パーティション）定義
+シャードを上から順にタグ条件で評価し、最初に一致したシャードに画像を割り当てる
+どれにも一致しない画像は最後の catch_all シャードに入るため、すべての画像がちょうど1つのシャードに入る
+
+形式（shards.json、partition_strategy.json の partition_specs）:
+    {"version": 1, "shards": [
+        {"name": "girl_solo", "path": "image_search_girl_solo.db", "all": ["1girl", "solo"]},
+        {"name": "boy_solo", "path": "image_search_boy_solo.db", "all": ["1boy", "solo"]},
+        {"name": "others", "path": "image_search_others.db", "catch_all": true}
+    ]}
+    all: すべて付いている / any: いずれかが付いている / none: どれも付いていない（省略時は条件なし）
+
+database_splitter.py はこの定義で分割し、ShardedImageDatabase は同じ定義からルーティング規則を導く
+"""
+
+import json
+from typing import Dict, List, Set, Tuple
+
+SPEC_VERSION = 1
+
+# よく使う分割定義（database_partition_strategy.py の提案・database_splitter.py の既定）
+STANDARD_SPECS = {
+    "solo_multi": {"version": SPEC_VERSION, "shards": [
+        {"name": "solo", "path": "image_search_solo.db", "all": ["solo"]},
+        {"name": "multi", "path": "image_search_multi.db", "catch_all": True},
+    ]},
+    "gender_solo": {"version": SPEC_VERSION, "shards": [
+        {"name": "girl_solo", "path": "image_search_girl_solo.db", "all": ["1girl", "solo"]},
+        {"name": "boy_solo", "path": "image_search_boy_solo.db", "all": ["1boy", "solo"]},
+        {"name": "others", "path": "image_search_others.db", "catch_all": True},
+    ]},
+    "detailed": {"version": SPEC_VERSION, "shards": [
+        {"name": "girl_solo", "path": "image_search_girl_solo.db", "all": ["1girl", "solo"]},
+        {"name": "boy_solo", "path": "image_search_boy_solo.db", "all": ["1boy", "solo"]},
+        {"name": "couple", "path": "image_search_couple.db", "all": ["1boy", "1girl"]},
+        {"name": "others", "path": "image_search_others.db", "catch_all": True},
+    ]},
+}
+
+
+class PartitionShard:
+    __slots__ = ("name", "path", "all", "any", "none", "catch_all")
+
+    def __init__(self, name: str, path: str, all: List[str] = None, any: List[str] = None,
+                 none: List[str] = None, catch_all: bool = False):
+        self.name = name
+        self.path = path
+        self.all = set(all or [])
+        self.any = set(any or [])
+        self.none = set(none or [])
+        self.catch_all = catch_all
+
+    def matches(self, tags: Set[str]) -> bool:
+        """タグ集合がこのシャードの条件を満たすか（catch_all は常に True）"""
+        if self.catch_all:
+            return True
+        return (self.all <= tags
+                and (not self.any or not self.any.isdisjoint(tags))
+                and self.none.isdisjoint(tags))
+
+    def implies(self, other: "PartitionShard") -> bool:
+        """このシャードの条件を満たす画像は必ず other の条件も満たすか（十分条件で判定）"""
+        if other.catch_all:
+            return True
+        if self.catch_all:
+            return False
+        return (other.all <= self.all
+                and other.none <= self.none
+                and (not other.any or not other.any.isdisjoint(self.all)
+                     or (bool(self.any) and self.any <= other.any)))
+
+    def contradictory(self) -> bool:
+        """条件自体が矛盾していて一致する画像がないか"""
+        return (not self.all.isdisjoint(self.none)
+                or (bool(self.any) and self.any <= self.none))
+
+    def to_dict(self) -> dict:
+        data = {"name": self.name, "path": self.path}
+        if self.catch_all:
+            data["catch_all"] = True
+        for key in ("all", "any", "none"):
+            tags = getattr(self, key)
+            if tags:
+                data[key] = sorted(tags)
+        return data
+
+
+class PartitionSpec:
+    def __init__(self, shards: List[PartitionShard]):
+        self.shards = shards
+        self.validate()
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PartitionSpec":
+        if data.get("version", SPEC_VERSION) != SPEC_VERSION:
+            raise ValueError(f"未対応の分割定義バージョン: {data.get('version')}")
+        shards = []
+        for entry in data.get("shards", []):
+            unknown = set(entry) - {"name", "path", "all", "any", "none", "catch_all"}
+            if unknown:
+                raise ValueError(f"分割定義の不明なキー: {sorted(unknown)}")
+            shards.append(PartitionShard(entry.get("name"), entry.get("path"), entry.get("all"),
+                                         entry.get("any"), entry.get("none"), bool(entry.get("catch_all"))))
+        return cls(shards)
+
+    @classmethod
+    def standard(cls, name: str) -> "PartitionSpec":
+        if name not in STANDARD_SPECS:
+            raise ValueError(f"未対応の戦略: {name}")
+        return cls.from_dict(STANDARD_SPECS[name])
+
+    @classmethod
+    def load(cls, path: str) -> "PartitionSpec":
+        with open(path, encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self) -> dict:
+        return {"version": SPEC_VERSION, "shards": [shard.to_dict() for shard in self.shards]}
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        print(f"📝 {path} を作成しました")
+
+    def validate(self):
+        """名前・パスの重複、catch_all の位置、到達できないシャードを検査（問題があれば ValueError）"""
+        if not self.shards:
+            raise ValueError("シャードが定義されていません")
+        names = [shard.name for shard in self.shards]
+        paths = [shard.path for shard in self.shards]
+        if not all(names) or len(set(names)) != len(names):
+            raise ValueError(f"シャード名が空または重複しています: {names}")
+        if not all(paths) or len(set(paths)) != len(paths):
+            raise ValueError(f"シャードのパスが空または重複しています: {paths}")
+
+        catch_all = [shard.name for shard in self.shards if shard.catch_all]
+        if catch_all != [self.shards[-1].name]:
+            raise ValueError("catch_all シャードは最後に1つだけ定義してください")
+        last = self.shards[-1]
+        if last.all or last.any or last.none:
+            raise ValueError(f"catch_all シャードにタグ条件は指定できません: {last.name}")
+
+        for index, shard in enumerate(self.shards[:-1]):
+            if not (shard.all or shard.any or shard.none):
+                raise ValueError(f"タグ条件のないシャードは catch_all にしてください: {shard.name}")
+            if shard.contradictory():
+                raise ValueError(f"条件が矛盾していて画像が入らないシャード: {shard.name}")
+            for earlier in self.shards[:index]:
+                if shard.implies(earlier):
+                    raise ValueError(f"シャード {shard.name} の画像はすべて先の {earlier.name} に入るため到達できません")
+
+    def assign(self, tags: Set[str]) -> int:
+        """タグ集合の画像が入るシャードの番号（最初に一致したシャード）"""
+        for index, shard in enumerate(self.shards):
+            if shard.matches(tags):
+                return index
+        return len(self.shards) - 1
+
+    def routing_rules(self) -> List[dict]:
+        """
+        検索のルーティング用に、シャードごとの {name, path, require, exclude} を導く
+        require: シャード内の全画像に付いているタグ / exclude: シャード内のどの画像にも付いていないタグ
+        先のシャードに一致しなかったことから分かるタグも exclude に含める
+        """
+        rules = []
+        for index, shard in enumerate(self.shards):
+            exclude = set(shard.none)
+            for earlier in self.shards[:index]:
+                # 先のシャードに none 条件があると、一致しなかった理由を特定できない
+                if earlier.none:
+                    continue
+                missing = earlier.all - shard.all
+                any_satisfied = not earlier.any or not earlier.any.isdisjoint(shard.all)
+                if not missing and earlier.any:
+                    # all はすべて付いているので、any のタグはどれも付いていない
+                    exclude |= earlier.any
+                elif len(missing) == 1 and any_satisfied:
+                    # 欠けられる all のタグは1つだけなので、それが付いていない
+                    exclude |= missing
+            rules.append({"name": shard.name, "path": shard.path,
+                          "require": sorted(shard.all), "exclude": sorted(exclude - shard.all)})
+        return rules
+
+    def assignment_sql(self, tag_ids: Dict[str, int], image_alias: str = "i",
+                       relation_table: str = "image_tags") -> Tuple[str, list]:
+        """
+        画像のシャード番号を求める CASE 式とパラメータ（画像1件につき EXISTS をインデックスで引くだけ）
+        tag_ids: タグ名 → タグID（存在しないタグはどの画像にも付いていないものとして扱う）
+        """
+        def has(tags):
+            ids = [tag_ids[tag] for tag in sorted(tags) if tag in tag_ids]
+            if not ids:
+                return None, []
+            placeholders = ','.join(['?' for _ in ids])
+            return (f'EXISTS (SELECT 1 FROM {relation_table} it '
+                    f'WHERE it.image_id = {image_alias}.id AND it.tag_id IN ({placeholders}))'), ids
+
+        branches = []
+        params = []
+        for index, shard in enumerate(self.shards[:-1]):
+            conditions = []
+            condition_params = []
+            for tag in sorted(shard.all):
+                sql, ids = has([tag])
+                if sql is None:
+                    conditions = None
+                    break
+                conditions.append(sql)
+                condition_params += ids
+            if conditions is None:
+                continue
+            if shard.any:
+                sql, ids = has(shard.any)
+                if sql is None:
+                    continue
+                conditions.append(sql)
+                condition_params += ids
+            sql, ids = has(shard.none)
+            if sql is not None:
+                conditions.append(f'NOT {sql}')
+                condition_params += ids
+            # 条件が none だけでそのタグがどこにもない場合は、すべての画像が一致する
+            branches.append(f'WHEN {" AND ".join(conditions) or "1"} THEN {index}')
+            params += condition_params
+
+        catch_all = len(self.shards) - 1
+        if not branches:
+            return str(catch_all), []
+        return f'CASE {" ".join(branches)} ELSE {catch_all} END', params
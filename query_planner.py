@@ -0,0 +1,128 @@
+# query_planner.py
+"""
+検索クエリプランナー
+tag_stats のタグごとの画像数（カーディナリティ）から評価順序と評価経路（SQL / インメモリ）を決める
+タグ共起行列（tag_cooccurrence.py）があれば、ポジティブタグのペアの共起画像数で結果件数を推定する
+人数タグ（tags.GROUPS）のネガティブは、images.group_mask が計算済みならビット判定にまとめる
+"""
+
+from typing import Dict, Optional
+
+from tags import GROUP_TAG_BITS
+
+
+class QueryPlanner:
+    # ポジティブタグの推定走査行数がこれ以上ならインメモリ経路を選ぶ（engine="auto" の場合）
+    MEMORY_ROW_THRESHOLD = 100000
+
+    def __init__(self, db, engine: str = "sql", memory_row_threshold: int = None):
+        """
+        db: ImageDatabase インスタンス
+        engine: "sql" / "bitmap" は経路を固定、"auto" はカーディナリティで選択
+        """
+        self.db = db
+        self.engine = engine
+        self.memory_row_threshold = memory_row_threshold or self.MEMORY_ROW_THRESHOLD
+
+    def plan(self, positive_tags: Dict[str, Optional[float]], negative_tags: Dict[str, Optional[float]],
+             mode: str = "any", rank: str = "count") -> dict:
+        """
+        正規化済みのタグから実行計画を作る（JSONにそのまま出せる dict）
+        positive_tags / negative_tags: {タグ名: 信頼度のしきい値（なければ None）}
+        mode: "any"（いずれかのタグを含む・一致数順）または "all"（すべてのタグを含む）
+        rank: "count"（一致数順）または "confidence"（信頼度の合計順）
+        """
+        tag_info = self.db.get_tag_info(list(positive_tags) + list(negative_tags))
+
+        def make_entry(tag, min_confidence):
+            # しきい値付きタグも推定にはタグの使用数（上限値）を使う
+            return {'tag': tag, 'tag_id': tag_info[tag][0], 'min_confidence': min_confidence,
+                    'estimated_rows': tag_info[tag][1]}
+
+        # ポジティブタグは最も少ないタグから評価する
+        positive = sorted(
+            (make_entry(tag, min_confidence) for tag, min_confidence in positive_tags.items()
+             if tag_info.get(tag, (None, 0))[1] > 0),
+            key=lambda item: (item['estimated_rows'], item['tag']))
+        missing_positive = [tag for tag in positive_tags if tag_info.get(tag, (None, 0))[1] == 0]
+
+        # どの画像にも付いていないネガティブタグは除外しても結果が変わらない
+        negative = [make_entry(tag, min_confidence) for tag, min_confidence in negative_tags.items()
+                    if tag_info.get(tag, (None, 0))[1] > 0]
+        skipped_negative = [tag for tag in negative_tags if tag_info.get(tag, (None, 0))[1] == 0]
+        
+        # しきい値なしの人数タグは SQL 経路で NOT EXISTS の代わりに (group_mask & ビット) = 0 で除外する
+        group_negative = []
+        if self.db.group_mask_ready:
+            group_negative = [entry['tag'] for entry in negative
+                              if entry['min_confidence'] is None and entry['tag'] in GROUP_TAG_BITS]
+        group_mask = sum(GROUP_TAG_BITS[tag] for tag in group_negative)
+
+        total_images = self.db.get_counters().get('images', 0)
+        if mode == "all" and rank == "count":
+            # 最小のポスティングリストから交差を取り、limit 件に達した時点で打ち切る
+            estimated_rows = positive[0]['estimated_rows'] if positive else 0
+        else:
+            estimated_rows = sum(entry['estimated_rows'] for entry in positive)
+        if mode == "all":
+            estimated_results = positive[0]['estimated_rows'] if positive else 0
+        else:
+            estimated_results = min(estimated_rows, total_images)
+        estimate_source = "tag_stats"
+        if len(positive) >= 2:
+            pair_estimate = self._estimate_with_pairs(positive, mode)
+            if pair_estimate is not None:
+                estimated_results = min(pair_estimate, estimated_results)
+                estimate_source = "cooccurrence"
+
+        if not positive:
+            strategy, reason = "empty", "一致し得るポジティブタグがない"
+        elif mode == "all" and missing_positive:
+            strategy, reason = "empty", f"どの画像にも付いていないタグがある: {missing_positive}"
+        elif self.engine == "bitmap":
+            strategy, reason = "memory", "インメモリエンジンが指定されている"
+        elif self.engine == "auto" and estimated_rows >= self.memory_row_threshold:
+            strategy, reason = "memory", f"推定走査行数 {estimated_rows} >= {self.memory_row_threshold}"
+        elif self.engine == "auto":
+            strategy, reason = "sql", f"推定走査行数 {estimated_rows} < {self.memory_row_threshold}"
+        else:
+            strategy, reason = "sql", "SQLエンジンが指定されている"
+
+        return {
+            'strategy': strategy,
+            'reason': reason,
+            'mode': mode,
+            'rank': rank,
+            'positive': positive,
+            'negative': negative,
+            'missing_positive': missing_positive,
+            'skipped_negative': skipped_negative,
+            'group_negative': group_negative,
+            'group_mask': group_mask,
+            'estimated_rows': estimated_rows,
+            'estimated_results': estimated_results,
+            'estimate_source': estimate_source,
+        }
+
+    def _estimate_with_pairs(self, positive: list, mode: str) -> Optional[int]:
+        """
+        共起行列のペア単位の件数から結果件数を推定（共起行列がなければ None）
+        all: ペアの共起画像数の最小値（すべてを含む画像数の上限）
+        any: 和集合の包除原理の2次までの近似（最大のタグの画像数を下限とする）
+        """
+        info = self.db.get_cooccurrence_info()
+        if not info:
+            return None
+        pair_counts = self.db.get_pair_counts([entry['tag'] for entry in positive])
+        # 共起行列にないペアは支持度未満
+        missing_pair_count = info['min_support'] - 1
+
+        counts = []
+        for i, first in enumerate(positive):
+            for second in positive[i + 1:]:
+                key = tuple(sorted((first['tag'], second['tag'])))
+                counts.append(pair_counts.get(key, missing_pair_count if mode == "all" else 0))
+        if mode == "all":
+            return min(counts)
+        singles = [entry['estimated_rows'] for entry in positive]
+        return max(sum(singles) - sum(counts), max(singles))
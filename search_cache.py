@@ -0,0 +1,80 @@
+# search_cache.py
+"""
+検索結果キャッシュ
+正規化したクエリ（ポジティブ/ネガティブタグ集合と件数）をキーにした LRU キャッシュ
+データベースの世代（generation）が進むと全エントリを無効化する
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class SearchResultCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0):
+        """
+        max_entries: 保持するクエリ数の上限（超えた分は最も古く使われたものから破棄）
+        ttl: エントリの有効期間（秒）
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(positive_tags, negative_tags, limit, **options):
+        """タグの順序・重複に依存しないキーを作る"""
+        return (
+            tuple(sorted(set(positive_tags))),
+            tuple(sorted(set(negative_tags))),
+            limit,
+            tuple(sorted(options.items())),
+        )
+
+    def _sync_generation(self, generation):
+        """世代が変わっていれば全エントリを破棄"""
+        if generation != self._generation:
+            self._entries.clear()
+            self._generation = generation
+
+    def get(self, key, generation):
+        """キャッシュされた結果を返す（なければ None）"""
+        with self._lock:
+            self._sync_generation(generation)
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, results = entry
+                if time.time() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return results
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, results):
+        """検索結果を保存"""
+        with self._lock:
+            # 検索中に世代が進んだ場合、古い世代の結果は保存しない
+            if self._generation is not None and generation < self._generation:
+                return
+            self._sync_generation(generation)
+            self._entries[key] = (time.time(), tuple(results))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """ヒット率などの統計情報"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self._entries),
+                'generation': self._generation,
+            }
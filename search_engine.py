@@ -0,0 +1,244 @@
+# search_engine.py
+"""
+インメモリのポスティングリスト検索エンジン
+image_tags のCSRインデックス（タグごとのソート済み画像ID配列と信頼度配列、index_snapshot.py）を保持し、
+ImageDatabase.search_images と同じ (id, filepath, filename, match_count) を返す
+"""
+
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from index_snapshot import IndexSnapshot
+
+
+class BitmapSearchEngine:
+    # IN句1回あたりのプレースホルダ数（SQLiteの変数上限対策）
+    IN_CHUNK = 900
+
+    def __init__(self, db, refresh_interval: float = 5.0, snapshot_dir: str = None):
+        """
+        db: ImageDatabase インスタンス
+        refresh_interval: データベース更新を確認する間隔（秒）
+        snapshot_dir: export-snapshot で書き出したスナップショットのディレクトリ
+                      （データベースと同じ世代なら memmap で開き、SQLiteからの構築を省略する）
+        """
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.snapshot_dir = snapshot_dir
+        self.index: Optional[IndexSnapshot] = None
+        self._lock = threading.Lock()
+        self._loaded_token = None
+        self._last_check = 0.0
+
+    def _current_token(self):
+        """データベースの更新を検出するためのトークン（世代カウンタ）"""
+        return self.db.get_generation()
+
+    def _load_snapshot(self, token) -> Optional[IndexSnapshot]:
+        """データベースと同じ世代のスナップショットがあれば開く"""
+        if not self.snapshot_dir:
+            return None
+        try:
+            index = IndexSnapshot.load(self.snapshot_dir)
+        except (OSError, ValueError) as e:
+            print(f"スナップショットを読み込めません ({self.snapshot_dir}): {e}")
+            return None
+        if index.generation != token:
+            print(f"スナップショットの世代({index.generation})がデータベース({token})と異なるため使用しません")
+            return None
+        return index
+
+    def load(self):
+        """スナップショットを開くか、image_tags からCSRインデックスを構築"""
+        load_start = time.time()
+        token = self._current_token()
+        index = self._load_snapshot(token)
+        source = "スナップショット"
+        if index is None:
+            index = IndexSnapshot.from_database(self.db)
+            source = "SQLite"
+
+        with self._lock:
+            self.index = index
+            self._loaded_token = index.generation
+            self._last_check = time.time()
+
+        print(f"ポスティングリスト構築完了（{source}）: {len(index.tag_ids)}タグ, {index.relation_count}関連 "
+              f"({time.time() - load_start:.4f}秒)")
+
+    def ensure_fresh(self):
+        """未構築またはデータベースが更新されていれば再構築"""
+        if self._loaded_token is None:
+            self.load()
+            return
+
+        now = time.time()
+        if now - self._last_check < self.refresh_interval:
+            return
+        self._last_check = now
+
+        token = self._current_token()
+        if token != self._loaded_token:
+            print("データベースの更新を検出したためポスティングリストを再構築します")
+            self.load()
+
+    def _posting(self, tag: str, min_confidence: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """タグの (画像ID配列, 信頼度配列)。しきい値があれば信頼度がそれより大きい要素だけに絞る"""
+        ids, confidences = self.index.posting(tag)
+        if min_confidence is not None:
+            keep = confidences > min_confidence
+            ids = ids[keep]
+            confidences = confidences[keep]
+        return ids, confidences
+
+    def _excluded_ids(self, negative_tags: List[Tuple[str, Optional[float]]]) -> Optional[np.ndarray]:
+        """ネガティブタグ（としきい値）に一致する画像IDの和集合（なければ None）"""
+        negative_lists = [self._posting(tag, min_confidence)[0]
+                          for tag, min_confidence in negative_tags if tag in self.index]
+        if not negative_lists:
+            return None
+        return np.unique(np.concatenate(negative_lists).astype(np.int64))
+
+    def search(self, positive_tags: List[Tuple[str, Optional[float]]],
+               negative_tags: List[Tuple[str, Optional[float]]], limit: int,
+               after: Tuple[int, int] = None, rank: str = "count", require_all: bool = False) -> List[Tuple]:
+        """
+        正規化済みの (タグ, 信頼度のしきい値) で検索（SQL版と同じ並び順・同じタプル形式）
+        after: 前ページ最後の (match_count, id)。その次の行から返す
+        rank: "confidence" の場合は一致タグの信頼度の合計を match_count の代わりに使う
+        require_all: すべてのポジティブタグに一致した画像のみ返す
+        """
+        self.ensure_fresh()
+
+        positive_tags = dict(positive_tags)
+        if limit <= 0 or (require_all and any(tag not in self.index for tag in positive_tags)):
+            return []
+        positive_lists = [self._posting(tag, min_confidence)
+                          for tag, min_confidence in positive_tags.items() if tag in self.index]
+        if not positive_lists:
+            return []
+
+        # ポジティブタグ: 和集合を取りつつ一致数（と信頼度の合計）を数える
+        all_ids = np.concatenate([ids for ids, _ in positive_lists]).astype(np.int64)
+        ids, inverse, counts = np.unique(all_ids, return_inverse=True, return_counts=True)
+        if rank == "confidence":
+            # SQL版と同じく小数点以下6桁に丸める（ROUND と同じ四捨五入）
+            all_confidences = np.concatenate([confidences for _, confidences in positive_lists])
+            scores = np.floor(np.bincount(inverse, weights=all_confidences) * 1000000 + 0.5) / 1000000.0
+        else:
+            scores = counts
+
+        keep = np.ones(len(ids), dtype=bool)
+        if require_all:
+            keep &= counts == len(positive_tags)
+
+        # ネガティブタグ: 和集合を1回の ANDNOT で除外
+        excluded = self._excluded_ids(negative_tags)
+        if excluded is not None:
+            keep &= ~np.isin(ids, excluded, assume_unique=True)
+
+        # キーセットページング: (match_count, id) が前ページ最後の行より小さいものだけ残す
+        if after is not None:
+            after_score, after_id = after
+            keep &= (scores < after_score) | ((scores == after_score) & (ids < after_id))
+
+        ids = ids[keep]
+        scores = scores[keep]
+        if len(ids) == 0:
+            return []
+
+        if rank == "confidence":
+            # 信頼度の合計 DESC, id DESC
+            top = np.lexsort((-ids, -scores))[:limit]
+        else:
+            # match_count DESC, id DESC を1つのキーにまとめて top-k を取り出す
+            key = scores * (int(ids.max()) + 1) + ids
+            if len(key) > limit:
+                top = np.argpartition(-key, limit - 1)[:limit]
+            else:
+                top = np.arange(len(key))
+            top = top[np.argsort(-key[top])]
+
+        return self._fetch_rows(ids[top], scores[top])
+
+    @staticmethod
+    def _contains(sorted_ids: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """ソート済み配列に values の各要素が含まれるか（二分探索）"""
+        if len(sorted_ids) == 0:
+            return np.zeros(len(values), dtype=bool)
+        index = np.searchsorted(sorted_ids, values)
+        index[index >= len(sorted_ids)] = 0
+        return sorted_ids[index] == values
+
+    def search_all(self, positive_tags: List[Tuple[str, Optional[float]]],
+                   negative_tags: List[Tuple[str, Optional[float]]], limit: int,
+                   after: Tuple[int, int] = None) -> List[Tuple]:
+        """
+        すべてのポジティブタグを含む画像をID降順で検索（"all" モード）
+        最小のポスティングリストを末尾からチャンク単位で走査し、limit 件そろった時点で打ち切る
+        """
+        self.ensure_fresh()
+
+        positive_tags = dict(positive_tags)
+        if not positive_tags or limit <= 0 or any(tag not in self.index for tag in positive_tags):
+            return []
+        match_count = len(positive_tags)
+        positive_lists = sorted((self._posting(tag, min_confidence)[0]
+                                 for tag, min_confidence in positive_tags.items()), key=len)
+        excluded = self._excluded_ids(negative_tags)
+
+        driver, others = positive_lists[0], positive_lists[1:]
+        end = len(driver)
+        if after is not None:
+            after_count, after_id = after
+            if after_count < match_count:
+                return []
+            if after_count == match_count:
+                end = int(np.searchsorted(driver, after_id))
+
+        found = []
+        remaining = limit
+        chunk_size = max(limit * 4, 1024)
+        while end > 0 and remaining > 0:
+            start = max(0, end - chunk_size)
+            candidates = driver[start:end][::-1]
+            end = start
+            # 要素数の少ないリストから確認して候補を早く絞る
+            for other in others:
+                candidates = candidates[self._contains(other, candidates)]
+                if len(candidates) == 0:
+                    break
+            if excluded is not None and len(candidates):
+                candidates = candidates[~self._contains(excluded, candidates)]
+            found.append(candidates[:remaining])
+            remaining -= len(found[-1])
+
+        if not found:
+            return []
+        ids = np.concatenate(found)
+        return self._fetch_rows(ids, np.full(len(ids), match_count, dtype=np.int64))
+
+    def _fetch_rows(self, ids: np.ndarray, counts: np.ndarray) -> List[Tuple]:
+        """画像IDからファイル情報を取得して結果タプルを組み立てる"""
+        if len(ids) == 0:
+            return []
+
+        id_list = [int(image_id) for image_id in ids]
+        counts = counts.tolist()
+        cursor = self.db.get_connection().cursor()
+        files = {}
+        for i in range(0, len(id_list), self.IN_CHUNK):
+            chunk = id_list[i:i + self.IN_CHUNK]
+            placeholders = ','.join(['?' for _ in chunk])
+            cursor.execute(f'SELECT id, filepath, filename FROM images WHERE id IN ({placeholders})', chunk)
+            files.update((row[0], (row[1], row[2])) for row in cursor.fetchall())
+
+        results = []
+        for image_id, count in zip(id_list, counts):
+            if image_id in files:
+                filepath, filename = files[image_id]
+                results.append((image_id, filepath, filename, count))
+        return results
@@ -0,0 +1,370 @@
+# sharded_database.py
+"""
+分割（シャード）されたデータベースを1つの ImageDatabase として扱うラッパー
+検索は各シャードにスレッドプールで並列に投げ、(match_count, id) の降順で k-way マージする
+シャードは元データベースの画像IDを保持している前提（database_splitter.py が作成する）
+
+シャード構成はマニフェスト（shards.json）に分割定義（partition_spec.py の形式）で指定し、
+分割に使った条件からシャードごとのルーティング規則（require / exclude）を導く
+"""
+
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from database import ImageDatabase, SEARCH_MODES, SEARCH_RANKS, STREAM_BATCH, parse_tag_specs
+from partition_spec import PartitionSpec
+
+MANIFEST_FILE = "shards.json"
+
+
+class _Shard:
+    __slots__ = ("name", "db", "require", "exclude", "tag_counts", "image_count", "generation")
+
+    def __init__(self, name: str, db: ImageDatabase, require: List[str], exclude: List[str]):
+        self.name = name
+        self.db = db
+        self.require = set(require)
+        self.exclude = set(exclude)
+        # タグの有無の要約（tag_stats の写し、世代が変わったら読み直す）
+        self.tag_counts: Dict[str, int] = {}
+        self.image_count = 0
+        self.generation = None
+
+
+class ShardedImageDatabase:
+    def __init__(self, shards: List[dict], search_engine: str = "sql", profile: str = "serving",
+                 read_only: bool = True, max_workers: int = None):
+        """
+        shards: {"name", "path", "require", "exclude"} のリスト（PartitionSpec.routing_rules の形式）
+        max_workers: 並列に検索するスレッド数（既定はシャード数）
+        """
+        if not shards:
+            raise ValueError("シャードが指定されていません")
+        self.shards = [
+            _Shard(spec.get("name") or os.path.basename(spec["path"]),
+                   ImageDatabase(spec["path"], search_engine=search_engine, profile=profile, read_only=read_only),
+                   spec.get("require", []), spec.get("exclude", []))
+            for spec in shards
+        ]
+        self.search_engine = search_engine
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or len(self.shards),
+                                            thread_name_prefix="shard-search")
+        self._summary_lock = threading.Lock()
+        # 全シャードのタグ名の和集合の大きさ（要約と一緒に、世代が変わったら数え直す）
+        self._tag_count = 0
+        self._local = threading.local()
+
+    @classmethod
+    def from_manifest(cls, manifest_path: str = MANIFEST_FILE, **kwargs) -> "ShardedImageDatabase":
+        """マニフェスト（分割定義）からシャード構成を読み込む（相対パスはマニフェストの場所が基準）"""
+        spec = PartitionSpec.load(manifest_path)
+        base_dir = os.path.dirname(os.path.abspath(manifest_path))
+        shards = [dict(rule, path=os.path.join(base_dir, rule["path"])) for rule in spec.routing_rules()]
+        return cls(shards, **kwargs)
+
+    @property
+    def tag_fts_available(self) -> bool:
+        return all(shard.db.tag_fts_available for shard in self.shards)
+
+    def close_connections(self):
+        for shard in self.shards:
+            shard.db.close_connections()
+
+    # ---- 集計 ----
+
+    def get_generation(self) -> int:
+        """各シャードの世代の合計（いずれかのシャードが更新されると増える）"""
+        return sum(shard.db.get_generation() for shard in self.shards)
+
+    def get_counters(self):
+        """
+        画像数・関連数・世代はシャードの合計（画像はちょうど1つのシャードにある）
+        タグは複数のシャードにあるため、タグ数はタグ名の和集合の大きさにする
+        """
+        counters = {}
+        for shard in self.shards:
+            for name, value in shard.db.get_counters().items():
+                if name != 'tags':
+                    counters[name] = counters.get(name, 0) + value
+        self._refresh_summaries()
+        counters['tags'] = self._tag_count
+        return counters
+
+    def get_tag_counts(self, tag_names: List[str]):
+        counts = {}
+        for shard in self.shards:
+            for tag, count in shard.db.get_tag_counts(tag_names).items():
+                counts[tag] = counts.get(tag, 0) + count
+        return counts
+
+    def get_all_tags(self):
+        counts = {}
+        for shard in self.shards:
+            for tag, count in shard.db.get_all_tags():
+                counts[tag] = counts.get(tag, 0) + count
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def get_tag_changes(self, since: Tuple[int, ...] = None):
+        """
+        各シャードで since 以降に使用数が変わったタグを、全シャードの合計使用数で返す
+        since: 前回の戻り値のシャードごとの世代（None で全タグ）
+        """
+        counts = {}
+        generations = []
+        for index, shard in enumerate(self.shards):
+            rows, generation, _ = shard.db.get_tag_changes(None if since is None else since[index])
+            for tag, count in rows:
+                counts[tag] = counts.get(tag, 0) + count
+            generations.append(generation)
+        if since is not None:
+            # 変わったのは一部のシャードの使用数だけなので、合計は全シャードから取り直す
+            counts = self.get_tag_counts(sorted(counts))
+        return list(counts.items()), tuple(generations), self.get_counters()['tags']
+
+    def get_popular_tags(self, limit: int = 20):
+        return self.get_all_tags()[:limit]
+
+    def search_tags_substring(self, query: str, limit: int = 20):
+        """
+        各シャードの部分一致候補を合算して使用数順に返す
+        シャードごとの上位だけを合算すると各シャードで圏外のタグが落ちるため、一致するタグはすべて取得する
+        """
+        counts = {}
+        source = None
+        for shard in self.shards:
+            rows, source = shard.db.search_tags_substring(query, None)
+            for tag, count in rows:
+                counts[tag] = counts.get(tag, 0) + count
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit], source
+
+    def get_related_tags(self, tag_names: List[str], limit: int = 20):
+        """
+        各シャードの関連タグの共起画像数を合算して多い順に返す（シャードは画像を重複して持たない）
+        上位だけを合算すると順位が変わるため、各シャードの共起行列にある（支持度以上の）タグをすべて取得する
+        """
+        counts = {}
+        for shard in self.shards:
+            for tag, count in shard.db.get_related_tags(tag_names, None):
+                counts[tag] = counts.get(tag, 0) + count
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    # ---- 画像 ----
+
+    def _find_image_shard(self, image_id: int) -> Optional[_Shard]:
+        for shard in self.shards:
+            if shard.db.get_image(image_id) is not None:
+                return shard
+        return None
+
+    def get_image(self, image_id: int):
+        for shard in self.shards:
+            image = shard.db.get_image(image_id)
+            if image is not None:
+                return image
+        return None
+
+    def get_images(self, limit: int = 10):
+        images = heapq.merge(*(shard.db.get_images(limit) for shard in self.shards))
+        return list(islice(images, limit))
+
+    def get_file_statuses(self, filepaths: List[str], since: float = 0):
+        """各シャードのファイル確認結果をまとめる（画像はちょうど1つのシャードにある）"""
+        statuses = {}
+        for shard in self.shards:
+            statuses.update(shard.db.get_file_statuses(filepaths, since))
+        return statuses
+
+    def get_image_tags(self, image_id: int):
+        shard = self._find_image_shard(image_id)
+        return shard.db.get_image_tags(image_id) if shard else []
+
+    def get_image_tags_with_confidence(self, image_id: int):
+        shard = self._find_image_shard(image_id)
+        return shard.db.get_image_tags_with_confidence(image_id) if shard else []
+
+    def get_tags_for_images(self, image_ids: List[int]):
+        """各シャードからまとめて取得し、タグが見つかったシャードの結果を使う（画像はちょうど1つのシャードにある）"""
+        tags = {image_id: [] for image_id in image_ids}
+        for shard in self.shards:
+            for image_id, image_tags in shard.db.get_tags_for_images(image_ids).items():
+                if image_tags:
+                    tags[image_id] = image_tags
+        return tags
+
+    # ---- 検索 ----
+
+    def _refresh_summaries(self):
+        """
+        世代が変わったシャードのタグ要約を読み直す
+        古い要約で除外すると結果が欠けたままキャッシュされるため、世代は検索ごとに確認する
+        """
+        with self._summary_lock:
+            changed = False
+            for shard in self.shards:
+                generation = shard.db.get_generation()
+                if generation != shard.generation:
+                    shard.tag_counts = dict(shard.db.get_all_tags())
+                    shard.image_count = shard.db.get_counters().get('images', 0)
+                    shard.generation = generation
+                    changed = True
+            if changed:
+                self._tag_count = len(set().union(*(shard.tag_counts for shard in self.shards)))
+
+    @staticmethod
+    def _prune_reason(shard: _Shard, positive: Dict[str, Optional[float]],
+                      negative: Dict[str, Optional[float]], mode: str) -> Optional[str]:
+        """シャードに一致する画像があり得なければ理由を返す（検索不要）"""
+        if shard.image_count == 0:
+            return "画像がない"
+
+        # ルーティング規則と要約から、このシャードに存在し得ないポジティブタグ
+        absent = [tag for tag in positive if tag in shard.exclude or shard.tag_counts.get(tag, 0) == 0]
+        if mode == "all" and absent:
+            return f"存在しないタグ: {absent}"
+        if len(absent) == len(positive):
+            return "一致し得るポジティブタグがない"
+
+        # 全画像に付いているネガティブタグ（しきい値なし）があれば全件除外される
+        for tag, min_confidence in negative.items():
+            if min_confidence is not None:
+                continue
+            if tag in shard.require or shard.tag_counts.get(tag, 0) >= shard.image_count:
+                return f"全画像に付いているネガティブタグ: {tag}"
+        return None
+
+    def _route(self, positive_tags: List[str], negative_tags: List[str], mode: str):
+        """検索対象のシャードと、除外したシャードとその理由を返す"""
+        self._refresh_summaries()
+        positive = parse_tag_specs(positive_tags)
+        negative = parse_tag_specs(negative_tags)
+        targets, pruned = [], {}
+        for shard in self.shards:
+            reason = self._prune_reason(shard, positive, negative, mode) if positive else "ポジティブタグがない"
+            if reason is None:
+                targets.append(shard)
+            else:
+                pruned[shard.name] = reason
+        return targets, pruned
+
+    def search_images(self, positive_tags: List[str], negative_tags: List[str] = None, limit: int = 50,
+                      after: Tuple[int, int] = None, mode: str = "any", rank: str = "count"):
+        """
+        全シャードを並列に検索して ImageDatabase.search_images と同じ順序の結果を返す
+        各シャードから limit 件ずつ取得すれば、マージ後の上位 limit 件は必ず含まれる
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"未対応の検索モード: {mode}")
+        if rank not in SEARCH_RANKS:
+            raise ValueError(f"未対応の並び順: {rank}")
+        negative_tags = negative_tags or []
+        search_start = time.time()
+
+        targets, pruned = self._route(positive_tags, negative_tags, mode)
+        route_time = time.time() - search_start
+
+        def search_shard(shard):
+            shard_start = time.time()
+            rows = shard.db.search_images(positive_tags, negative_tags, limit, after, mode, rank)
+            return rows, time.time() - shard_start
+
+        fan_out_start = time.time()
+        futures = [(shard, self._executor.submit(search_shard, shard)) for shard in targets]
+        shard_results = []
+        shard_info = []
+        for shard, future in futures:
+            rows, elapsed = future.result()
+            shard_results.append(rows)
+            shard_info.append({'shard': shard.name, 'time': elapsed, 'results': len(rows)})
+        fan_out_time = time.time() - fan_out_start
+
+        # (match_count, id) の降順で k-way マージ（手作業で作ったシャードに備えて重複は除く）
+        merge_start = time.time()
+        merged = heapq.merge(*shard_results, key=lambda row: (row[3], row[0]), reverse=True)
+        results = []
+        seen = set()
+        for row in merged:
+            if row[0] in seen:
+                continue
+            seen.add(row[0])
+            results.append(row)
+            if len(results) >= limit:
+                break
+        merge_time = time.time() - merge_start
+
+        self._local.last_search = {
+            'shards': shard_info + [{'shard': name, 'pruned': reason} for name, reason in pruned.items()],
+            'route_time': route_time,
+            'fan_out_time': fan_out_time,
+            'merge_time': merge_time,
+            'total_time': time.time() - search_start,
+        }
+        print(f"シャード検索: {len(targets)}/{len(self.shards)}シャード, {len(results)}件 "
+              f"(並列検索: {fan_out_time:.4f}秒, マージ: {merge_time:.4f}秒)")
+        return results
+
+    def iter_search_images(self, positive_tags: List[str], negative_tags: List[str] = None, limit: int = 50,
+                           after: Tuple[int, int] = None, mode: str = "any", rank: str = "count",
+                           batch_size: int = STREAM_BATCH) -> Iterator[tuple]:
+        """
+        各シャードの iter_search_images を (match_count, id) の降順で逐次マージするジェネレータ
+        シャードごとに batch_size 行ずつ読み出すため、limit が大きくてもメモリ使用量は一定
+        （SQL で読み出すシャードの場合。インメモリエンジンのシャードは limit 件までのリストを作る）
+        途中で close() されると各シャードのカーソルと専用の接続も閉じる
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"未対応の検索モード: {mode}")
+        if rank not in SEARCH_RANKS:
+            raise ValueError(f"未対応の並び順: {rank}")
+        negative_tags = negative_tags or []
+        route_start = time.time()
+        targets, pruned = self._route(positive_tags, negative_tags, mode)
+        streams = [shard.db.iter_search_images(positive_tags, negative_tags, limit, after, mode, rank, batch_size)
+                   for shard in targets]
+        self._local.last_search = {
+            'shards': [{'shard': shard.name, 'streamed': True} for shard in targets]
+                      + [{'shard': name, 'pruned': reason} for name, reason in pruned.items()],
+            'route_time': time.time() - route_start,
+        }
+        return self._merge_limited(streams, limit)
+
+    def _merge_limited(self, streams, limit: int) -> Iterator[tuple]:
+        """マージした結果を limit 件まで返し、読み切った場合も途中で閉じられた場合も各シャードのストリームを閉じる"""
+        try:
+            yield from islice(self._merge_streams(streams), limit)
+        finally:
+            for stream in streams:
+                close = getattr(stream, 'close', None)
+                if close is not None:
+                    close()
+
+    @staticmethod
+    def _merge_streams(streams) -> Iterator[tuple]:
+        """(match_count, id) の降順でマージ（重複は同じキーで隣り合うため、直前の行とだけ比べて除く）"""
+        previous = None
+        for row in heapq.merge(*streams, key=lambda row: (row[3], row[0]), reverse=True):
+            if previous is not None and row[0] == previous[0] and row[3] == previous[3]:
+                continue
+            previous = row
+            yield row
+
+    def last_search_info(self) -> Optional[dict]:
+        """このスレッドで最後に実行した検索のシャードごとの時間と除外理由"""
+        return getattr(self._local, 'last_search', None)
+
+    def explain_search(self, positive_tags: List[str], negative_tags: List[str] = None, limit: int = 50,
+                       after: Tuple[int, int] = None, mode: str = "any", rank: str = "count"):
+        """シャードの選択結果と、検索対象シャードごとの実行計画を返す"""
+        negative_tags = negative_tags or []
+        targets, pruned = self._route(positive_tags, negative_tags, mode)
+        return {
+            'pruned': pruned,
+            'shards': {shard.name: shard.db.explain_search(positive_tags, negative_tags, limit, after, mode, rank)
+                       for shard in targets},
+        }
+
@@ -0,0 +1,157 @@
+# tag_cooccurrence.py
+"""
+タグ共起行列（疎行列）
+image_tags を画像ID順に1回走査し、画像ごとのタグのペアを NumPy でまとめて数える
+共起画像数（支持度）が min_support 以上のペアだけを tag_cooccurrence テーブルに保存する
+関連タグの提案（/api/tags/related）と、クエリプランナー・analyze_database.py のペア単位の件数推定に使う
+
+tag_cooccurrence には (tag_a, tag_b) と (tag_b, tag_a) の両方向を保存し、1つのタグの相手を
+主キーの範囲検索だけで引けるようにする
+"""
+
+import time
+from typing import Tuple
+
+import numpy as np
+
+# 既定の支持度（これ未満のペアは保存しない）
+DEFAULT_MIN_SUPPORT = 5
+
+
+class TagCooccurrence:
+    # image_tags 読み込み時のフェッチ件数（1チャンクのペア数はおよそ 件数 × 画像あたりタグ数 / 2）
+    FETCH_CHUNK = 200000
+
+    def __init__(self, generation: int, min_support: int, tag_a: np.ndarray, tag_b: np.ndarray,
+                 pair_counts: np.ndarray, image_count: int):
+        """tag_a < tag_b のペアと共起画像数（タグIDの配列）"""
+        self.generation = generation
+        self.min_support = min_support
+        self.tag_a = tag_a
+        self.tag_b = tag_b
+        self.pair_counts = pair_counts
+        self.image_count = image_count
+
+    @property
+    def pair_count(self) -> int:
+        return len(self.pair_counts)
+
+    @staticmethod
+    def _pair_codes(image_ids: np.ndarray, tag_rows: np.ndarray, tag_count: int) -> np.ndarray:
+        """
+        画像ID順に並んだ (画像ID, タグ行番号) から、同じ画像内のタグの全ペアを
+        小さい行番号 * tag_count + 大きい行番号 の符号にして返す
+        """
+        n = len(image_ids)
+        if n == 0:
+            return np.empty(0, dtype=np.int64)
+        starts = np.flatnonzero(np.r_[True, image_ids[1:] != image_ids[:-1]])
+        ends = np.r_[starts[1:], n]
+        # 各要素について、同じ画像内で後ろにある要素の数だけペアを作る
+        later = np.repeat(ends, ends - starts) - np.arange(n) - 1
+        left = np.repeat(np.arange(n), later)
+        first = np.cumsum(later) - later
+        right = left + 1 + (np.arange(len(left)) - np.repeat(first, later))
+        a = tag_rows[left]
+        b = tag_rows[right]
+        return np.minimum(a, b) * tag_count + np.maximum(a, b)
+
+    @staticmethod
+    def _merge(codes: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """同じ符号の件数を合算（疎行列の COO → 重複加算）"""
+        codes, inverse = np.unique(codes, return_inverse=True)
+        return codes, np.bincount(inverse, weights=counts, minlength=len(codes)).astype(np.int64)
+
+    @classmethod
+    def from_database(cls, db, min_support: int = DEFAULT_MIN_SUPPORT) -> "TagCooccurrence":
+        """image_tags を1回走査して共起行列を作る（世代と内容が一致するよう1つの読み取りトランザクションで読む）"""
+        if min_support < 1:
+            raise ValueError(f"min_support は1以上を指定してください: {min_support}")
+        conn = db.get_connection()
+        cursor = conn.cursor()
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            cursor.execute('BEGIN')
+        try:
+            generation = db.get_generation()
+            image_count = db.get_counters().get('images', 0)
+
+            # 使用数が支持度未満のタグはどのペアも支持度に届かないため最初から除く
+            cursor.execute('SELECT tag_id FROM tag_stats WHERE image_count >= ? ORDER BY tag_id', (min_support,))
+            tag_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+            tag_count = max(len(tag_ids), 1)
+
+            pending_codes, pending_counts = [], []
+            pending_size = 0
+            codes = np.empty(0, dtype=np.int64)
+            counts = np.empty(0, dtype=np.int64)
+            carry = np.empty((0, 2), dtype=np.int64)
+
+            # (image_id, tag_id) の一意インデックスで画像ID順に読む
+            cursor.execute('SELECT image_id, tag_id FROM image_tags ORDER BY image_id')
+            while True:
+                rows = cursor.fetchmany(cls.FETCH_CHUNK)
+                if rows:
+                    chunk = np.concatenate([carry, np.array(rows, dtype=np.int64)])
+                    # 最後の画像は次のチャンクに続く可能性があるため持ち越す
+                    last = np.searchsorted(chunk[:, 0], chunk[-1, 0])
+                    chunk, carry = chunk[:last], chunk[last:]
+                else:
+                    chunk, carry = carry, np.empty((0, 2), dtype=np.int64)
+
+                if len(chunk) and len(tag_ids):
+                    rows_in_chunk = np.searchsorted(tag_ids, chunk[:, 1])
+                    rows_in_chunk[rows_in_chunk >= len(tag_ids)] = 0
+                    keep = tag_ids[rows_in_chunk] == chunk[:, 1]
+                    chunk_codes = cls._pair_codes(chunk[keep, 0], rows_in_chunk[keep], tag_count)
+                    unique_codes, unique_counts = np.unique(chunk_codes, return_counts=True)
+                    pending_codes.append(unique_codes)
+                    pending_counts.append(unique_counts)
+                    pending_size += len(unique_codes)
+
+                # 保留分が累積分より大きくなったらまとめて合算する（合算の回数を対数オーダーに抑える）
+                if pending_codes and (not rows or pending_size > len(codes)):
+                    codes, counts = cls._merge(np.concatenate([codes] + pending_codes),
+                                               np.concatenate([counts] + pending_counts))
+                    pending_codes, pending_counts = [], []
+                    pending_size = 0
+                if not rows:
+                    break
+        finally:
+            if own_transaction:
+                conn.rollback()
+
+        keep = counts >= min_support
+        codes, counts = codes[keep], counts[keep]
+        return cls(generation, min_support, tag_ids[codes // tag_count] if len(tag_ids) else codes,
+                   tag_ids[codes % tag_count] if len(tag_ids) else codes, counts, image_count)
+
+    def save(self, db):
+        """tag_cooccurrence テーブルを置き換える（両方向を保存）"""
+        tag_a = self.tag_a.tolist()
+        tag_b = self.tag_b.tolist()
+        pair_counts = self.pair_counts.tolist()
+        with db.transaction() as conn:
+            conn.execute('DELETE FROM tag_cooccurrence')
+            conn.executemany('INSERT INTO tag_cooccurrence (tag_a, tag_b, pair_count) VALUES (?, ?, ?)',
+                             zip(tag_a, tag_b, pair_counts))
+            conn.executemany('INSERT INTO tag_cooccurrence (tag_a, tag_b, pair_count) VALUES (?, ?, ?)',
+                             zip(tag_b, tag_a, pair_counts))
+            conn.executemany('INSERT OR REPLACE INTO cooccurrence_info (name, value) VALUES (?, ?)', [
+                ('generation', self.generation),
+                ('min_support', self.min_support),
+                ('pairs', self.pair_count),
+                ('images', self.image_count),
+                ('built_at', time.time()),
+            ])
+
+
+def build_cooccurrence(db, min_support: int = DEFAULT_MIN_SUPPORT) -> TagCooccurrence:
+    """共起行列を作成してデータベースに保存"""
+    build_start = time.time()
+    cooccurrence = TagCooccurrence.from_database(db, min_support)
+    count_time = time.time() - build_start
+    cooccurrence.save(db)
+    print(f"タグ共起行列を保存: {cooccurrence.pair_count}ペア (支持度{min_support}以上, 世代{cooccurrence.generation}, "
+          f"集計 {count_time:.4f}秒, 合計 {time.time() - build_start:.4f}秒)")
+    return cooccurrence
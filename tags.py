@@ -24,6 +24,13 @@ GROUPS = {
     },
 }
 
+# GROUPS のタグごとのビット（images.group_mask に画像の人数タグをまとめて保持する）
+# ビットの割り当てを変えた場合は python database.py backfill-group-mask で再計算する
+GROUP_TAG_BITS = {
+    tag: 1 << bit
+    for bit, tag in enumerate(sorted(tag for tag_map in GROUPS.values() for tag in tag_map))
+}
+
 def _overlap(r1, r2):
     """範囲が重なっていれば True"""
     a1, b1 = r1
@@ -58,5 +65,6 @@ def build_query(pos_tags: str) -> str:
     neg_final = [f"{t}" for t in neg if t not in pos]
     return ", ".join(sorted(pos)),  ", ".join(sorted(neg_final))
 
-print(build_query("2girls, 1boy, hands"))
-# -> 1boy 2girls -1girl -2boys -multiple_boys -solo
+if __name__ == "__main__":
+    print(build_query("2girls, 1boy, hands"))
+    # -> 1boy 2girls -1girl -2boys -multiple_boys -solo
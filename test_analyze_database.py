@@ -0,0 +1,39 @@
+# test_analyze_database.py
+"""人数タグの組み合わせ集計が、画像ごとのタグを直接数えた結果と一致することの確認"""
+
+import sqlite3
+from collections import Counter
+
+import pytest
+
+from analyze_database import DatabaseAnalyzer
+from conftest import build_database
+
+
+def brute_force_combinations(db_path, group_tags):
+    """人数タグの組み合わせ（タグ名順のタプル）→ 画像数（人数タグのない画像は数えない）"""
+    conn = sqlite3.connect(db_path)
+    tags = {}
+    for image_id, tag_name in conn.execute(
+            'SELECT it.image_id, t.tag_name FROM image_tags it JOIN tags t ON t.id = it.tag_id'):
+        if tag_name in group_tags:
+            tags.setdefault(image_id, set()).add(tag_name)
+    conn.close()
+    return dict(Counter(tuple(sorted(image_tags)) for image_tags in tags.values()))
+
+
+@pytest.fixture(scope="module")
+def db_path(tmp_path_factory):
+    return build_database(str(tmp_path_factory.mktemp("analyze") / "image_search.db"), image_count=300, seed=3)
+
+
+@pytest.mark.parametrize("group_mask_ready, parallel", [(True, False), (False, False), (False, True)])
+def test_combinations_match_brute_force(db_path, group_mask_ready, parallel):
+    analyzer = DatabaseAnalyzer(db_path)
+    # group_mask が未計算のデータベースでは image_tags からマスクを作る
+    analyzer.db.group_mask_ready = group_mask_ready
+    results = analyzer.analyze_tag_combinations(parallel=parallel, workers=2)
+    expected = brute_force_combinations(db_path, analyzer.get_all_group_tags())
+    assert expected and results['tag_combination_counter'] == expected
+    assert results['total_images'] == 300
+    assert sum(results['combination_stats'].values()) == 300
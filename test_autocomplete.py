@@ -0,0 +1,52 @@
+# test_autocomplete.py
+"""タグ補完インデックスの差分更新が作り直した場合と同じ候補を返すことの確認"""
+
+import random
+
+from autocomplete import TagAutocomplete
+from database import ImageDatabase
+
+TAG_NAMES = ["blue_sky", "blue_eyes", "blue_hair", "black_hair", "blonde_hair", "bow", "smile", "short_hair",
+             "sky", "skirt", "shirt", "solo"]
+QUERIES = ["b", "bl", "blu", "blue_", "s", "sh", "sk", "sky", "x", "hair"]
+
+
+def candidates(autocomplete):
+    return {query: (autocomplete.prefix_matches(query, 5), autocomplete.substring_matches(query, 5))
+            for query in QUERIES}
+
+
+def test_refresh_matches_rebuild(tmp_path):
+    db = ImageDatabase(str(tmp_path / "image_search.db"))
+    rng = random.Random(0)
+    db.add_images_with_tags_batch([(f"/img/{i}.jpg", rng.sample(TAG_NAMES[:6], 2)) for i in range(30)])
+
+    autocomplete = TagAutocomplete(db, top_k=3, refresh_interval=0)
+    autocomplete.build()
+    for step in range(5):
+        # 既存タグの使用数の増減と新規タグの追加
+        db.add_images_with_tags_batch([(f"/img/{step}/{i}.jpg", rng.sample(TAG_NAMES, 3)) for i in range(10)])
+        cursor = db.get_connection().cursor()
+        cursor.execute("SELECT id FROM images")
+        db.delete_images(rng.sample([row[0] for row in cursor.fetchall()], 5))
+
+        autocomplete.refresh()
+        rebuilt = TagAutocomplete(db, top_k=3)
+        rebuilt.build()
+        assert autocomplete.counts == rebuilt.counts
+        assert candidates(autocomplete) == candidates(rebuilt)
+    db.close_connections()
+
+
+def test_tag_changes_since_generation(tmp_path):
+    db = ImageDatabase(str(tmp_path / "image_search.db"))
+    db.add_images_with_tags_batch([("/img/0.jpg", ["sky", "smile"]), ("/img/1.jpg", ["sky"])])
+    _, generation, tag_count = db.get_tag_changes()
+    assert tag_count == 2
+
+    db.add_images_with_tags_batch([("/img/2.jpg", ["smile", "bow"])])
+    rows, next_generation, tag_count = db.get_tag_changes(generation)
+    assert sorted(rows) == [("bow", 1), ("smile", 2)]
+    assert (next_generation, tag_count) == (generation + 1, 3)
+    assert db.get_tag_changes(next_generation)[0] == []
+    db.close_connections()
@@ -0,0 +1,57 @@
+# test_check_data_integrity.py
+"""ファイル確認（ディレクトリ単位の並列確認・前回の記録を使う増分チェック）の確認"""
+
+import os
+import time
+
+from check_data_integrity import SCANDIR_MIN_FILES, check_data_integrity, check_files
+from database import ImageDatabase
+
+
+def make_files(directory, count):
+    directory.mkdir()
+    paths = []
+    for i in range(count):
+        path = directory / f"{i}.jpg"
+        path.write_bytes(b"x" * (i + 1))
+        paths.append(str(path))
+    return paths
+
+
+def test_check_files_with_and_without_scandir(tmp_path):
+    # 一覧で確認するディレクトリと、個別に stat するディレクトリ
+    many = make_files(tmp_path / "many", SCANDIR_MIN_FILES + 2)
+    few = make_files(tmp_path / "few", 2)
+    rows = list(enumerate(many + few + [str(tmp_path / "many" / "gone.jpg"), str(tmp_path / "nodir" / "a.jpg")]))
+    results = check_files(rows, workers=4)
+    for image_id, filepath in rows:
+        if os.path.exists(filepath):
+            assert results[image_id] == (os.path.getsize(filepath), os.stat(filepath).st_mtime)
+        else:
+            assert results[image_id] is None
+
+
+def test_incremental_check_reuses_recorded_status(tmp_path):
+    paths = make_files(tmp_path / "images", 5)
+    db_path = str(tmp_path / "image_search.db")
+    db = ImageDatabase(db_path)
+    db.add_images_with_tags_batch([(path, ["sky"]) for path in paths])
+    db.close_connections()
+
+    report = check_data_integrity(db_path, workers=2)
+    assert report['stats']['files_checked'] == 5 and 'missing_files' not in report['issues']
+
+    os.remove(paths[0])
+    checked_at = time.time()
+    # 前回の確認より前の時刻を指定すると再確認せず、削除にはまだ気付かない
+    report = check_data_integrity(db_path, since=checked_at - 3600, workers=2)
+    assert report['stats']['files_skipped'] == 5 and 'missing_files' not in report['issues']
+
+    report = check_data_integrity(db_path, since=checked_at + 1, workers=2)
+    assert report['stats']['files_checked'] == 5
+    assert [item['filepath'] for item in report['issues']['missing_files']] == [paths[0]]
+
+    # 存在しないと記録されたファイルは、再確認しなくても存在しないものとして報告する
+    report = check_data_integrity(db_path, since=checked_at - 3600, workers=2)
+    assert report['stats']['files_skipped'] == 5
+    assert [item['filepath'] for item in report['issues']['missing_files']] == [paths[0]]
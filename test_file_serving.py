@@ -0,0 +1,77 @@
+# test_file_serving.py
+"""配信可否の判定（ルート外は 403）と配信方法ごとのレスポンスの確認"""
+
+import os
+
+import pytest
+
+from database import ImageDatabase
+from file_serving import FileServer, parse_roots
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "images"
+    (root / "sub dir").mkdir(parents=True)
+    (root / "sub dir" / "a b.jpg").write_bytes(b"jpeg")
+    (tmp_path / "secret.txt").write_text("secret")
+    os.symlink(tmp_path / "secret.txt", root / "link.jpg")
+    return tmp_path
+
+
+def test_parse_roots():
+    assert parse_roots(" /data/images=/protected/images/ , /mnt/a ,") == [
+        ("/data/images", "/protected/images/"), ("/mnt/a", None)]
+
+
+def test_resolve_allows_only_files_under_roots(tree):
+    server = FileServer("send_file", [(str(tree / "images"), None)])
+    real_path, root = server.resolve(str(tree / "images" / "sub dir" / "a b.jpg"))
+    assert real_path == os.path.realpath(tree / "images" / "sub dir" / "a b.jpg")
+    for path in [tree / "secret.txt", tree / "images" / ".." / "secret.txt", tree / "images" / "link.jpg",
+                 tree / "images-other" / "a.jpg"]:
+        with pytest.raises(PermissionError):
+            server.resolve(str(path))
+
+    # ルート未指定なら制限しない（x-accel は location が必要なため常にルートが必要）
+    assert FileServer("send_file").resolve(str(tree / "secret.txt"))[1] is None
+    with pytest.raises(PermissionError):
+        FileServer("x-accel").resolve(str(tree / "secret.txt"))
+
+
+def test_incomparable_paths_are_outside_roots(tree, monkeypatch):
+    """ドライブが異なるなど commonpath が比較できないパスは 500 ではなく PermissionError にする"""
+    server = FileServer("send_file", [(str(tree / "images"), None)])
+
+    def commonpath(paths):
+        raise ValueError("Paths don't have the same drive")
+    monkeypatch.setattr("file_serving.os.path.commonpath", commonpath)
+    with pytest.raises(PermissionError):
+        server.resolve(str(tree / "images" / "sub dir" / "a b.jpg"))
+
+
+def test_header_modes(tree, app_module):
+    path = str(tree / "images" / "sub dir" / "a b.jpg")
+    with app_module.app.test_request_context():
+        response = FileServer("x-accel", [(str(tree / "images"), "/protected/images/")]).response(
+            path, etag="abc", max_age=60)
+        assert response.headers["X-Accel-Redirect"] == "/protected/images/sub%20dir/a%20b.jpg"
+        assert response.headers["ETag"] == '"abc"'
+        assert response.headers["Cache-Control"] == "public, max-age=60"
+        assert response.get_data() == b""
+
+        response = FileServer("x-sendfile").response(path)
+        assert response.headers["X-Sendfile"] == os.path.realpath(path)
+        assert response.mimetype == "image/jpeg"
+
+
+def test_image_outside_roots_is_forbidden(client, app_module, tmp_path):
+    outside = tmp_path / "outside.jpg"
+    outside.write_bytes(b"jpeg")
+    db = ImageDatabase(app_module.db.db_path)
+    db.add_images_with_tags_batch([(str(outside), ["outside_root"])])
+    image_id = db.search_images(["outside_root"])[0][0]
+    db.close_connections()
+
+    assert client.get(f'/api/image/{image_id}').status_code == 403
+    assert client.get('/api/image/1').status_code == 200
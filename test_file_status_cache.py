@@ -0,0 +1,63 @@
+# test_file_status_cache.py
+"""ファイルの存在確認キャッシュの有効期間（存在する/しないファイル）と記録の参照の確認"""
+
+import pytest
+
+from database import ImageDatabase
+from file_status_cache import FileStatusCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("file_status_cache.time.time", lambda: now[0])
+    return now
+
+
+def test_positive_and_negative_ttl(tmp_path, clock):
+    present, missing = tmp_path / "present.jpg", tmp_path / "missing.jpg"
+    present.write_bytes(b"x")
+    cache = FileStatusCache(ttl=100, negative_ttl=10)
+    assert cache.check_many([str(present), str(missing)]) == {str(present): True, str(missing): False}
+    assert cache.checks == 2
+
+    # 有効期間内は stat しないため、ファイルの変化には気付かない
+    present.unlink()
+    missing.write_bytes(b"x")
+    clock[0] += 5
+    assert cache.check_many([str(present), str(missing)]) == {str(present): True, str(missing): False}
+    assert (cache.hits, cache.checks) == (2, 2)
+
+    # 存在しないファイルの有効期間が先に切れ、復旧したファイルを拾う
+    clock[0] += 10
+    assert cache.check_many([str(present), str(missing)]) == {str(present): True, str(missing): True}
+    assert cache.checks == 3
+
+    clock[0] += 100
+    assert cache.exists(str(present)) is False
+    assert cache.checks == 4
+
+
+def test_max_entries(tmp_path, clock):
+    cache = FileStatusCache(max_entries=2)
+    cache.check_many([str(tmp_path / f"{i}.jpg") for i in range(3)])
+    assert cache.stats()['size'] == 2
+    cache.exists(str(tmp_path / "0.jpg"))
+    assert cache.checks == 4
+
+
+def test_recorded_status_is_used_within_ttl(tmp_path, clock):
+    path = str(tmp_path / "a.jpg")
+    db = ImageDatabase(str(tmp_path / "image_search.db"))
+    db.add_images_with_tags_batch([(path, ["sky"])])
+    # ファイルはないが、記録では存在している（有効期間内の記録は stat より優先する）
+    db.record_file_statuses({path: (1, 1.0)}, checked_at=clock[0] - 50)
+    cache = FileStatusCache(ttl=100, negative_ttl=10, source=db)
+    assert cache.exists(path) is True
+    assert (cache.recorded_hits, cache.checks) == (1, 0)
+
+    # 記録が有効期間を過ぎていれば stat する
+    cache = FileStatusCache(ttl=30, negative_ttl=10, source=db)
+    assert cache.exists(path) is False
+    assert (cache.recorded_hits, cache.checks) == (0, 1)
+    db.close_connections()
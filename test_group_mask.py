@@ -0,0 +1,51 @@
+# test_group_mask.py
+"""人数タグの除外を group_mask で判定した場合と NOT EXISTS で判定した場合で結果が同じことの確認"""
+
+import sqlite3
+
+from conftest import build_database, random_queries
+from database import ImageDatabase
+
+
+def search_all(db, queries):
+    return [db.search_images(positive, negative, 5000, mode=mode, rank=rank)
+            for positive, negative, mode, rank in queries]
+
+
+def test_group_mask_matches_not_exists(tmp_path):
+    """group_mask が未計算のデータベース（NOT EXISTS で除外）と計算済みのデータベースで結果が同じ"""
+    queries = list(random_queries(100, seed=3))
+    path = build_database(str(tmp_path / "legacy.db"), image_count=300, seed=5)
+    ready = ImageDatabase(path)
+    assert ready.group_mask_ready
+    expected = search_all(ready, queries)
+    ready.close_connections()
+
+    conn = sqlite3.connect(path)
+    conn.execute("DELETE FROM db_settings WHERE name = 'group_mask_ready'")
+    conn.execute("UPDATE images SET group_mask = 0")
+    conn.commit()
+    conn.close()
+    legacy = ImageDatabase(path)
+    assert not legacy.group_mask_ready
+    assert search_all(legacy, queries) == expected
+
+    legacy.backfill_group_masks()
+    assert legacy.group_mask_ready
+    assert search_all(legacy, queries) == expected
+    legacy.close_connections()
+
+
+def test_group_mask_follows_tag_changes(tmp_path):
+    """登録・削除のトリガーで images.group_mask が付いている人数タグのビットの OR になる"""
+    db = ImageDatabase(str(tmp_path / "image_search.db"))
+    db.add_images_with_tags_batch([("/img/0.jpg", ["1girl", "solo", "sky"]), ("/img/1.jpg", ["sky"])])
+    cursor = db.get_connection().cursor()
+    cursor.execute("SELECT filename, group_mask FROM images ORDER BY id")
+    masks = dict(cursor.fetchall())
+    assert masks["1.jpg"] == 0 and masks["0.jpg"] != 0
+
+    db.add_images_with_tags_batch([("/img/1.jpg", ["1girl", "solo"])])
+    cursor.execute("SELECT group_mask FROM images WHERE filename = '1.jpg'")
+    assert cursor.fetchone()[0] == masks["0.jpg"]
+    db.close_connections()
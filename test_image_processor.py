@@ -0,0 +1,55 @@
+# test_image_processor.py
+"""登録処理（まとめて保存するトランザクションの失敗時の扱い・サムネイルの事前作成）の確認"""
+
+import os
+import threading
+
+from PIL import Image
+
+from database import ImageDatabase
+from image_processor import ImageProcessor
+from thumbnails import ThumbnailCache
+
+
+def test_flush_falls_back_to_single_items(tmp_path):
+    db = ImageDatabase(str(tmp_path / "image_search.db"))
+    processor = ImageProcessor(tag_method=None, db=db)
+    pending = [
+        (str(tmp_path / "a.jpg"), [("tag_a", 0.9)]),
+        (str(tmp_path / "bad.jpg"), [("tag_b", "not a number")]),
+        (str(tmp_path / "c.jpg"), ["tag_c"]),
+    ]
+
+    assert processor._flush(pending) == 2
+    assert sorted(db.get_all_image_filenames()) == ["a.jpg", "c.jpg"]
+    db.close_connections()
+
+
+def test_thumbnail_backlog_does_not_block_inference(tmp_path, monkeypatch):
+    """サムネイル作成が追いつかなくても推論のループは待たず、溢れた分は事前作成しない"""
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    for i in range(40):
+        Image.new("RGB", (32, 32), (i, 0, 0)).save(image_dir / f"{i:02d}.jpg")
+    released = threading.Event()
+    calls = []
+
+    def tag_method(batch):
+        calls.append(len(batch))
+        # 全バッチの推論が終わるまでサムネイル作成を止めておく（投入側が待つとここまで来ない）
+        if sum(calls) == 40:
+            released.set()
+        return [(os.path.basename(filepath), [("sky", 0.9)]) for filepath, _ in batch]
+
+    cache = ThumbnailCache(str(tmp_path / "thumbnails"))
+    render = cache.render
+    monkeypatch.setattr(cache, "render", lambda image, size: released.wait(5) and render(image, size))
+    db = ImageDatabase(str(tmp_path / "image_search.db"))
+    processor = ImageProcessor(tag_method, db, batches_per_commit=2, thumbnail_cache=cache, thumbnail_workers=1)
+    processor.process_directory(str(image_dir), extensions=[".jpg"])
+
+    assert released.is_set() and sum(calls) == 40
+    assert len(db.get_all_image_filenames()) == 40
+    assert processor.thumbnails_skipped > 0
+    assert processor.thumbnails_written + processor.thumbnails_skipped == 40
+    db.close_connections()
@@ -0,0 +1,37 @@
+# test_image_tags.py
+"""複数画像のタグをまとめて取得する get_tags_for_images（並び順・分割クエリ）と /api/images/tags の確認"""
+
+import pytest
+
+import database
+from database import ImageDatabase
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 900])
+def test_tags_for_images_match_single_lookups(search_db_path, monkeypatch, chunk):
+    monkeypatch.setattr(database, "IN_CHUNK", chunk)
+    db = ImageDatabase(search_db_path)
+    # 重複・存在しないIDを含み、チャンクの境界をまたぐ
+    image_ids = [5, 3, 5, 999999] + list(range(40, 60)) + [1]
+    tags = db.get_tags_for_images(image_ids)
+    assert list(tags) == list(dict.fromkeys(image_ids))
+    assert tags[999999] == []
+    for image_id in image_ids[4:]:
+        confidences = [item['confidence'] for item in tags[image_id]]
+        assert confidences == sorted(confidences, reverse=True)
+        single = db.get_image_tags_with_confidence(image_id)
+        assert sorted(tags[image_id], key=lambda item: item['tag']) == sorted(single, key=lambda item: item['tag'])
+    db.close_connections()
+
+
+def test_api_images_tags(client):
+    data = client.get('/api/images/tags?ids=2,1,2,999999').get_json()
+    assert sorted(data['tags']) == ['1', '2', '999999']
+    assert {item['tag'] for item in data['tags']['2']} == {'sky', 'cloud'}
+    assert [item['tag'] for item in data['tags']['1']] == ['sky']
+    assert data['tags']['999999'] == []
+
+
+@pytest.mark.parametrize("ids", ["", "1,x", ",".join(str(i) for i in range(501))])
+def test_api_images_tags_rejects_invalid_ids(client, ids):
+    assert client.get(f'/api/images/tags?ids={ids}').status_code == 400
@@ -0,0 +1,35 @@
+# test_pagination.py
+"""キーセットページングと /api/search の limit の検証"""
+
+import pytest
+
+from conftest import paginate, random_queries
+
+
+@pytest.mark.parametrize("engine", ["sql", "bitmap", "auto"])
+def test_pagination_covers_full_result(engines, engine):
+    for positive, negative, mode, rank in random_queries(40, seed=1):
+        expected = engines["sql"].search_images(positive, negative, 5000, mode=mode, rank=rank)
+        for page_size in (1, 7, 50):
+            assert paginate(engines[engine], positive, negative, mode, rank, page_size) == expected, \
+                (positive, negative, mode, rank, page_size)
+
+
+def test_api_cursor_pages(client):
+    ids, cursor = [], None
+    while True:
+        response = client.post('/api/search', json={'positive_tags': ['sky'], 'limit': 5, 'cursor': cursor})
+        assert response.status_code == 200
+        data = response.get_json()
+        ids.extend(item['id'] for item in data['results'])
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+    assert len(ids) == len(set(ids)) == 12
+
+
+@pytest.mark.parametrize("limit", [0, -1, "many", None, 100001])
+def test_api_rejects_invalid_limit(client, limit):
+    response = client.post('/api/search', json={'positive_tags': ['sky'], 'limit': limit})
+    assert response.status_code == 400
+    assert 'limit' in response.get_json()['error'].lower()
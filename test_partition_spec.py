@@ -0,0 +1,114 @@
+# test_partition_spec.py
+"""分割定義の検証（重なり・catch_all）と画像の割り当て"""
+
+import sqlite3
+
+import pytest
+
+from partition_spec import STANDARD_SPECS, PartitionSpec
+
+
+def spec(*shards):
+    return PartitionSpec.from_dict({"version": 1, "shards": list(shards)})
+
+
+CATCH_ALL = {"name": "others", "path": "others.db", "catch_all": True}
+
+
+@pytest.mark.parametrize("name", sorted(STANDARD_SPECS))
+def test_standard_specs_are_valid(name):
+    assert PartitionSpec.standard(name).shards[-1].catch_all
+
+
+def test_assign_uses_first_matching_shard():
+    partition = PartitionSpec.standard("detailed")
+    assert partition.assign({"1girl", "solo"}) == 0
+    assert partition.assign({"1boy", "solo"}) == 1
+    assert partition.assign({"1boy", "1girl", "solo"}) == 0
+    assert partition.assign({"1boy", "1girl"}) == 2
+    assert partition.assign({"2girls"}) == 3
+
+
+@pytest.mark.parametrize("shards, message", [
+    # 後のシャードの条件が先のシャードの条件を含む（重なりで到達できない）
+    ([{"name": "solo", "path": "a.db", "all": ["solo"]},
+      {"name": "girl_solo", "path": "b.db", "all": ["1girl", "solo"]}, CATCH_ALL], "到達できません"),
+    ([{"name": "girls", "path": "a.db", "any": ["1girl", "2girls"]},
+      {"name": "one_girl", "path": "b.db", "all": ["1girl"]}, CATCH_ALL], "到達できません"),
+    ([{"name": "a", "path": "a.db", "all": ["solo"], "none": ["1boy"]},
+      {"name": "b", "path": "b.db", "all": ["solo"], "none": ["1boy", "2boys"]}, CATCH_ALL], "到達できません"),
+    # catch_all がない・最後でない・複数・条件付き
+    ([{"name": "solo", "path": "a.db", "all": ["solo"]}], "catch_all"),
+    ([CATCH_ALL, {"name": "solo", "path": "a.db", "all": ["solo"]}], "catch_all"),
+    ([dict(CATCH_ALL, name="x", path="x.db"), CATCH_ALL], "catch_all"),
+    ([dict(CATCH_ALL, all=["solo"])], "catch_all"),
+    # 条件のないシャード・矛盾した条件
+    ([{"name": "a", "path": "a.db"}, CATCH_ALL], "catch_all"),
+    ([{"name": "a", "path": "a.db", "all": ["solo"], "none": ["solo"]}, CATCH_ALL], "矛盾"),
+    # 名前・パスの重複
+    ([{"name": "others", "path": "a.db", "all": ["solo"]}, CATCH_ALL], "重複"),
+    ([{"name": "a", "path": "others.db", "all": ["solo"]}, CATCH_ALL], "重複"),
+])
+def test_invalid_specs(shards, message):
+    with pytest.raises(ValueError, match=message):
+        spec(*shards)
+
+
+def test_disjoint_shards_are_allowed():
+    partition = spec({"name": "girl_solo", "path": "a.db", "all": ["1girl", "solo"]},
+                     {"name": "solo", "path": "b.db", "all": ["solo"]}, CATCH_ALL)
+    assert [shard.name for shard in partition.shards] == ["girl_solo", "solo", "others"]
+
+
+def test_unknown_key_and_version():
+    with pytest.raises(ValueError, match="不明なキー"):
+        spec({"name": "a", "path": "a.db", "tags": ["solo"]}, CATCH_ALL)
+    with pytest.raises(ValueError, match="バージョン"):
+        PartitionSpec.from_dict({"version": 99, "shards": [CATCH_ALL]})
+
+
+def test_routing_rules_from_earlier_shards():
+    rules = {rule["name"]: rule for rule in PartitionSpec.standard("detailed").routing_rules()}
+    assert rules["girl_solo"]["require"] == ["1girl", "solo"]
+    # 1boy, solo の画像は girl_solo に一致しなかったので 1girl が付いていない
+    assert rules["boy_solo"]["exclude"] == ["1girl"]
+    # 1boy, 1girl の画像は girl_solo・boy_solo に一致しなかったので solo が付いていない
+    assert rules["couple"]["exclude"] == ["solo"]
+
+
+def test_round_trip(tmp_path):
+    partition = PartitionSpec.standard("gender_solo")
+    path = str(tmp_path / "shards.json")
+    partition.save(path)
+    assert PartitionSpec.load(path).to_dict() == partition.to_dict()
+
+
+def assign_with_sql(partition, images, tag_ids):
+    """assignment_sql の CASE 式で各画像のシャード番号を求める"""
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE images (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE image_tags (image_id INTEGER, tag_id INTEGER)")
+    for image_id, tags in enumerate(images):
+        conn.execute("INSERT INTO images (id) VALUES (?)", (image_id,))
+        conn.executemany("INSERT INTO image_tags VALUES (?, ?)", [(image_id, tag_ids[tag]) for tag in tags])
+    case_sql, params = partition.assignment_sql(tag_ids)
+    rows = conn.execute(f"SELECT {case_sql} FROM images i ORDER BY i.id", params).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+
+@pytest.mark.parametrize("name", sorted(STANDARD_SPECS))
+def test_assignment_sql_matches_assign(name):
+    partition = PartitionSpec.standard(name)
+    images = [set(), {"solo"}, {"1girl", "solo"}, {"1boy", "solo"}, {"1boy", "1girl"}, {"2girls"},
+              {"multiple_girls", "2boys"}, {"1girl", "1boy", "solo", "nsfw"}]
+    tag_ids = {tag: index for index, tag in enumerate(sorted(set().union(*images)))}
+    assert assign_with_sql(partition, images, tag_ids) == [partition.assign(tags) for tags in images]
+
+
+def test_assignment_sql_with_absent_none_tags():
+    """none だけのシャードで、そのタグがデータベースにない場合はすべての画像が一致する"""
+    partition = spec({"name": "safe", "path": "a.db", "none": ["nsfw", "gore"]}, CATCH_ALL)
+    images = [{"solo"}, set(), {"1girl"}]
+    assert assign_with_sql(partition, images, {"solo": 1, "1girl": 2}) == [0, 0, 0]
+    assert assign_with_sql(partition, images + [{"nsfw"}], {"solo": 1, "1girl": 2, "nsfw": 3}) == [0, 0, 0, 1]
@@ -0,0 +1,21 @@
+# test_search.py
+"""検索エンジン（sql / bitmap / auto）が同じ結果を返すことの確認"""
+
+import pytest
+
+from conftest import random_queries
+
+
+@pytest.mark.parametrize("engine", ["bitmap", "auto"])
+def test_engines_match_sql(engines, engine):
+    for positive, negative, mode, rank in random_queries(200):
+        expected = engines["sql"].search_images(positive, negative, 5000, mode=mode, rank=rank)
+        assert engines[engine].search_images(positive, negative, 5000, mode=mode, rank=rank) == expected, \
+            (positive, negative, mode, rank)
+
+
+def test_invalid_mode_and_rank(engines):
+    with pytest.raises(ValueError):
+        engines["sql"].search_images(["tag1"], mode="some")
+    with pytest.raises(ValueError):
+        engines["bitmap"].search_images(["tag1"], rank="random")
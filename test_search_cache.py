@@ -0,0 +1,58 @@
+# test_search_cache.py
+"""検索結果キャッシュが世代の変化・有効期間・上限で正しくエントリを破棄することの確認"""
+
+from database import ImageDatabase
+from search_cache import SearchResultCache
+
+
+def test_key_ignores_tag_order_and_duplicates():
+    assert (SearchResultCache.make_key(["b", "a", "a"], ["c"], 50, mode="any")
+            == SearchResultCache.make_key(["a", "b"], ["c"], 50, mode="any"))
+    assert (SearchResultCache.make_key(["a"], [], 50, mode="any")
+            != SearchResultCache.make_key(["a"], [], 50, mode="all"))
+
+
+def test_generation_change_drops_entries():
+    cache = SearchResultCache()
+    key = SearchResultCache.make_key(["sky"], [], 50)
+    cache.put(key, 1, [(1, "a.jpg", "/a.jpg", 1)])
+    assert cache.get(key, 1) == ((1, "a.jpg", "/a.jpg", 1),)
+
+    assert cache.get(key, 2) is None
+    # 世代が戻っても破棄済みのエントリは返らない
+    assert cache.get(key, 1) is None
+
+
+def test_stale_put_is_ignored():
+    cache = SearchResultCache()
+    key = SearchResultCache.make_key(["sky"], [], 50)
+    cache.get(key, 3)
+    # 検索中に世代が進んだ場合の古い結果は保存しない
+    cache.put(key, 2, [(1, "a.jpg", "/a.jpg", 1)])
+    assert cache.get(key, 3) is None
+
+
+def test_ttl_and_max_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("search_cache.time.time", lambda: now[0])
+    cache = SearchResultCache(max_entries=2, ttl=10)
+    for name in ("a", "b", "c"):
+        cache.put(SearchResultCache.make_key([name], [], 50), 1, [name])
+    assert cache.get(SearchResultCache.make_key(["a"], [], 50), 1) is None
+    assert cache.get(SearchResultCache.make_key(["c"], [], 50), 1) == ("c",)
+
+    now[0] += 11
+    assert cache.get(SearchResultCache.make_key(["c"], [], 50), 1) is None
+
+
+def test_database_writes_invalidate_cached_results(tmp_path):
+    db = ImageDatabase(str(tmp_path / "image_search.db"))
+    db.add_images_with_tags_batch([("/img/0.jpg", ["sky"])])
+    cache = SearchResultCache()
+    key = SearchResultCache.make_key(["sky"], [], 50)
+    cache.put(key, db.get_generation(), db.search_images(["sky"]))
+    assert cache.get(key, db.get_generation()) is not None
+
+    db.add_images_with_tags_batch([("/img/1.jpg", ["sky"])])
+    assert cache.get(key, db.get_generation()) is None
+    db.close_connections()
@@ -0,0 +1,71 @@
+# test_search_engine.py
+"""インメモリエンジン（bitmap）が SQL と同じ結果を返すことと、スナップショットの保存の確認"""
+
+import os
+import random
+
+import pytest
+
+from database import ImageDatabase
+from index_snapshot import IndexSnapshot, export_snapshot
+
+# float32 では正確に表せない値を含む信頼度（0.8 などは float32 に丸めるとしきい値の比較がずれる）
+CONFIDENCES = (0.1, 0.3, 0.35, 0.7, 0.8, 0.81, 0.85, 0.9, 0.95, 1.0)
+TAG_NAMES = [f"tag{i}" for i in range(12)]
+
+
+@pytest.fixture(scope="module")
+def db_path(tmp_path_factory):
+    """しきい値ちょうどの信頼度を多く含むデータベース"""
+    path = str(tmp_path_factory.mktemp("engine") / "engine.db")
+    rng = random.Random(1)
+    items = []
+    for i in range(400):
+        tags = rng.sample(TAG_NAMES, rng.randint(1, 6))
+        items.append((f"/img/{i}.jpg", [(tag, rng.choice(CONFIDENCES)) for tag in tags]))
+    db = ImageDatabase(path)
+    db.add_images_with_tags_batch(items)
+    db.close_connections()
+    return path
+
+
+def random_queries(count, seed=2):
+    """しきい値・除外・検索モード・並び順を組み合わせたクエリ"""
+    rng = random.Random(seed)
+    thresholds = ("", ">0.8", ">0.35", ">0.9", ">0.81")
+    for _ in range(count):
+        positive = [tag + rng.choice(thresholds) for tag in rng.sample(TAG_NAMES, rng.randint(1, 3))]
+        negative = [tag + rng.choice(thresholds) for tag in rng.sample(TAG_NAMES, rng.randint(0, 2))]
+        yield positive, negative, rng.choice(("any", "all")), rng.choice(("count", "confidence"))
+
+
+def test_bitmap_matches_sql_on_non_float32_confidences(db_path):
+    sql_db = ImageDatabase(db_path, search_engine="sql")
+    bitmap_db = ImageDatabase(db_path, search_engine="bitmap")
+    for positive, negative, mode, rank in random_queries(300):
+        expected = sql_db.search_images(positive, negative, 1000, mode=mode, rank=rank)
+        assert bitmap_db.search_images(positive, negative, 1000, mode=mode, rank=rank) == expected, \
+            (positive, negative, mode, rank)
+
+
+def test_snapshot_keeps_confidences_exact(db_path, tmp_path):
+    export_snapshot(ImageDatabase(db_path), str(tmp_path / "snapshot"))
+    sql_db = ImageDatabase(db_path, search_engine="sql")
+    snapshot_db = ImageDatabase(db_path, search_engine="bitmap", snapshot_dir=str(tmp_path / "snapshot"))
+    for positive, negative, mode, rank in random_queries(100, seed=3):
+        expected = sql_db.search_images(positive, negative, 1000, mode=mode, rank=rank)
+        assert snapshot_db.search_images(positive, negative, 1000, mode=mode, rank=rank) == expected, \
+            (positive, negative, mode, rank)
+
+
+def test_snapshot_keeps_previous_generation(db_path, tmp_path):
+    """書き出し直後も、直前の世代を開いているワーカーが使えるよう1つ前の世代を残す"""
+    directory = str(tmp_path / "snapshot")
+    db = ImageDatabase(db_path)
+    snapshot = IndexSnapshot.from_database(db)
+    paths = []
+    for generation in range(3):
+        snapshot.generation = generation
+        paths.append(snapshot.save(directory))
+    assert [os.path.exists(path) for path in paths] == [False, True, True]
+    assert IndexSnapshot.read_header(directory)["generation"] == 2
@@ -0,0 +1,77 @@
+# test_search_modes.py
+"""各エンジンの検索結果を、画像ごとのタグから直接求めた結果と比べる"""
+
+import sqlite3
+
+import pytest
+
+from conftest import GENERAL_TAG_NAMES, GROUP_TAG_NAMES, random_queries
+from database import parse_tag_specs
+
+
+@pytest.fixture(scope="module")
+def tagged(search_db_path):
+    """画像ID → {タグ名: 信頼度}"""
+    conn = sqlite3.connect(search_db_path)
+    tags = {}
+    for image_id, tag_name, confidence in conn.execute(
+            'SELECT it.image_id, t.tag_name, it.confidence FROM image_tags it JOIN tags t ON t.id = it.tag_id'):
+        tags.setdefault(image_id, {})[tag_name] = confidence
+    conn.close()
+    return tags
+
+
+def brute_force(tagged, positive, negative, mode="any", rank="count"):
+    """全画像を走査して (match_count, id) の降順に並べる（rank="confidence" では一致タグの信頼度の合計）"""
+    positive, negative = parse_tag_specs(positive), parse_tag_specs(negative)
+
+    def matches(tags, tag, min_confidence):
+        return tag in tags and (min_confidence is None or tags[tag] > min_confidence)
+
+    rows = []
+    for image_id, tags in tagged.items():
+        if any(matches(tags, tag, min_confidence) for tag, min_confidence in negative.items()):
+            continue
+        matched = [tag for tag, min_confidence in positive.items() if matches(tags, tag, min_confidence)]
+        if not matched or (mode == "all" and len(matched) < len(positive)):
+            continue
+        if rank == "confidence":
+            rows.append((round(sum(tags[tag] for tag in matched) * 1000000) / 1000000, image_id))
+        else:
+            rows.append((len(matched), image_id))
+    return sorted(rows, reverse=True)
+
+
+@pytest.mark.parametrize("engine", ["sql", "bitmap", "auto"])
+def test_all_mode_requires_every_tag(engines, tagged, engine):
+    for positive, negative, _, _ in random_queries(60, seed=4):
+        positive = [spec.partition(">")[0] for spec in positive]
+        negative = [spec.partition(">")[0] for spec in negative]
+        rows = engines[engine].search_images(positive, negative, 5000, mode="all")
+        assert [(row[3], row[0]) for row in rows] == brute_force(tagged, positive, negative, "all"), \
+            (positive, negative)
+
+
+def test_all_mode_with_unknown_tag(engines):
+    assert engines["sql"].search_images([GENERAL_TAG_NAMES[0], "no_such_tag"], [], 50, mode="all") == []
+    assert engines["sql"].search_images([GROUP_TAG_NAMES[0], "no_such_tag"], [], 50) != []
+
+
+@pytest.mark.parametrize("engine", ["sql", "bitmap", "auto"])
+def test_thresholds_and_rank_match_brute_force(engines, tagged, engine):
+    for positive, negative, mode, rank in random_queries(100, seed=5):
+        rows = engines[engine].search_images(positive, negative, 5000, mode=mode, rank=rank)
+        expected = brute_force(tagged, positive, negative, mode, rank)
+        assert [row[0] for row in rows] == [image_id for _, image_id in expected], (positive, negative, mode, rank)
+        assert [row[3] for row in rows] == pytest.approx([score for score, _ in expected])
+
+
+def test_threshold_is_exclusive(tagged, engines):
+    """しきい値ちょうどの信頼度は一致しない（confidence > しきい値）"""
+    image_id, tags = next(iter(tagged.items()))
+    tag, confidence = next(iter(tags.items()))
+    above = {row[0] for row in engines["sql"].search_images([f"{tag}>{confidence - 0.0001}"], [], 5000)}
+    exact = {row[0] for row in engines["sql"].search_images([f"{tag}>{confidence}"], [], 5000)}
+    assert image_id in above and image_id not in exact
+    # 同じタグを複数指定した場合は厳しい方のしきい値を使う
+    assert {row[0] for row in engines["sql"].search_images([tag, f"{tag}>{confidence}"], [], 5000)} == exact
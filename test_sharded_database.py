@@ -0,0 +1,77 @@
+# test_sharded_database.py
+"""分割データベースが元のデータベースと同じ検索結果・ページング・集計・タグ候補を返すことの確認"""
+
+import os
+
+import pytest
+
+from conftest import GENERAL_TAG_NAMES, build_database, paginate, random_queries
+from database import ImageDatabase
+from database_splitter import DatabaseSplitter
+from partition_spec import PartitionSpec
+from sharded_database import ShardedImageDatabase
+from tag_cooccurrence import build_cooccurrence
+
+
+@pytest.fixture(scope="module")
+def databases(tmp_path_factory):
+    """元のデータベースと、detailed 定義で分割したシャード（共起行列はすべてのペアを保存）"""
+    directory = tmp_path_factory.mktemp("shards")
+    source = build_database(str(directory / "source.db"), seed=7)
+    spec = PartitionSpec.standard("detailed")
+    for shard in spec.shards:
+        shard.path = str(directory / os.path.basename(shard.path))
+    DatabaseSplitter(source).create_split_databases(spec, max_workers=1)
+    for path in [source] + [shard.path for shard in spec.shards]:
+        db = ImageDatabase(path)
+        build_cooccurrence(db, min_support=1)
+        db.close_connections()
+    manifest = str(directory / "shards.json")
+    spec.save(manifest)
+    return ImageDatabase(source), ShardedImageDatabase.from_manifest(manifest, max_workers=1)
+
+
+def test_search_matches_source(databases):
+    source, sharded = databases
+    for positive, negative, mode, rank in random_queries(200, seed=8):
+        expected = source.search_images(positive, negative, 5000, mode=mode, rank=rank)
+        assert sharded.search_images(positive, negative, 5000, mode=mode, rank=rank) == expected, \
+            (positive, negative, mode, rank)
+
+
+def test_pagination_matches_source(databases):
+    source, sharded = databases
+    for positive, negative, mode, rank in random_queries(30, seed=9):
+        expected = source.search_images(positive, negative, 5000, mode=mode, rank=rank)
+        for page_size in (1, 13):
+            assert paginate(sharded, positive, negative, mode, rank, page_size) == expected, \
+                (positive, negative, mode, rank, page_size)
+
+
+def test_counters_match_source(databases):
+    source, sharded = databases
+    counters = sharded.get_counters()
+    for name in ("images", "tags", "relations"):
+        assert counters[name] == source.get_counters()[name], name
+    assert sorted(sharded.get_all_tags()) == sorted(source.get_all_tags())
+
+
+def test_tag_candidates_are_summed_before_cut(databases):
+    """シャードごとの上位だけを合算すると、各シャードで圏外のタグが落ちて順位が変わる"""
+    source, sharded = databases
+    for limit in (1, 3, 5):
+        assert sharded.search_tags_substring("tag", limit)[0] == source.search_tags_substring("tag", limit)[0]
+        for tag in GENERAL_TAG_NAMES[:6]:
+            assert sharded.get_related_tags([tag], limit) == source.get_related_tags([tag], limit), (tag, limit)
+
+
+def test_tag_count_follows_shard_updates(tmp_path):
+    """タグ数の和集合は、いずれかのシャードの世代が変わったときに数え直す"""
+    first, second = ImageDatabase(str(tmp_path / "a.db")), ImageDatabase(str(tmp_path / "b.db"))
+    first.add_images_with_tags_batch([("/img/1.jpg", ["sky", "sun"])])
+    second.add_images_with_tags_batch([("/img/2.jpg", ["sky"])])
+    sharded = ShardedImageDatabase([{"path": str(tmp_path / "a.db")}, {"path": str(tmp_path / "b.db")}])
+    assert sharded.get_counters()["tags"] == 2
+
+    second.add_images_with_tags_batch([("/img/3.jpg", ["sun", "moon"])])
+    assert sharded.get_counters()["tags"] == 3
@@ -0,0 +1,76 @@
+# test_streaming.py
+"""逐次読み出し（iter_search_images）が search_images と同じ結果を返し、途中で閉じると各シャードのストリームも閉じることの確認"""
+
+import json
+import os
+
+import pytest
+
+from conftest import build_database, random_queries
+from database import ImageDatabase
+from database_splitter import DatabaseSplitter
+from partition_spec import PartitionSpec
+from sharded_database import ShardedImageDatabase
+
+
+@pytest.fixture(scope="module")
+def sharded(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("stream_shards")
+    source = build_database(str(directory / "source.db"), seed=11)
+    spec = PartitionSpec.standard("detailed")
+    for shard in spec.shards:
+        shard.path = str(directory / os.path.basename(shard.path))
+    DatabaseSplitter(source).create_split_databases(spec, max_workers=1)
+    manifest = str(directory / "shards.json")
+    spec.save(manifest)
+    return ImageDatabase(source), ShardedImageDatabase.from_manifest(manifest, max_workers=1)
+
+
+@pytest.mark.parametrize("engine", ["sql", "bitmap"])
+def test_iter_search_matches_search(engines, engine):
+    db = engines[engine]
+    for positive, negative, mode, rank in random_queries(50, seed=12):
+        after = None
+        for _ in range(2):
+            expected = db.search_images(positive, negative, 40, after, mode, rank)
+            assert list(db.iter_search_images(positive, negative, 40, after, mode, rank, batch_size=16)) == expected
+            if not expected:
+                break
+            after = (expected[-1][3], expected[-1][0])
+
+
+def test_sharded_iter_search_matches_source(sharded):
+    source, db = sharded
+    for positive, negative, mode, rank in random_queries(50, seed=13):
+        expected = source.search_images(positive, negative, 300, mode=mode, rank=rank)
+        assert list(db.iter_search_images(positive, negative, 300, mode=mode, rank=rank, batch_size=16)) == expected
+
+
+def test_closing_sharded_stream_closes_shard_streams(sharded, monkeypatch):
+    """クライアントの切断などで途中で close() されたとき、各シャードのカーソル（ジェネレータ）も閉じる"""
+    _, db = sharded
+    opened = []
+    for shard in db.shards:
+        def iter_search_images(*args, _original=shard.db.iter_search_images, **kwargs):
+            stream = _original(*args, **kwargs)
+            opened.append(stream)
+            return stream
+        monkeypatch.setattr(shard.db, "iter_search_images", iter_search_images)
+
+    rows = db.iter_search_images(["tag1"], limit=1000, batch_size=4)
+    assert next(rows) is not None
+    assert len(opened) > 1 and any(stream.gi_frame is not None for stream in opened)
+    rows.close()
+    # 閉じたジェネレータは gi_frame が None になる（finally で専用の接続も閉じている）
+    assert all(stream.gi_frame is None for stream in opened)
+
+
+def test_ndjson_stream(client):
+    response = client.post('/api/search', json={'positive_tags': ['sky'], 'limit': 5},
+                           headers={'Accept': 'application/x-ndjson'})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    response.close()
+    ids = [item['id'] for item in lines[:-1]]
+    assert len(ids) == 5 and ids == sorted(ids, reverse=True)
+    assert 'performance' in lines[-1] and lines[-1]['next_cursor']
@@ -0,0 +1,48 @@
+# test_tag_cooccurrence.py
+"""タグ共起行列のペア数を、画像ごとのタグの全ペアを直接数えた結果と比べる"""
+
+import sqlite3
+from collections import Counter
+from itertools import combinations
+
+import pytest
+
+from database import ImageDatabase
+from tag_cooccurrence import TagCooccurrence, build_cooccurrence
+
+
+def brute_force_pairs(db_path, min_support):
+    """(小さいタグID, 大きいタグID) → 共起画像数（支持度以上のみ）"""
+    conn = sqlite3.connect(db_path)
+    tags = {}
+    for image_id, tag_id in conn.execute('SELECT image_id, tag_id FROM image_tags'):
+        tags.setdefault(image_id, []).append(tag_id)
+    conn.close()
+    pairs = Counter(pair for tag_ids in tags.values() for pair in combinations(sorted(tag_ids), 2))
+    return {pair: count for pair, count in pairs.items() if count >= min_support}
+
+
+@pytest.mark.parametrize("min_support, fetch_chunk", [(1, 7), (1, 200000), (5, 13), (40, 1)])
+def test_pair_counts_match_brute_force(search_db_path, monkeypatch, min_support, fetch_chunk):
+    # チャンクの境界で画像が分かれる場合の持ち越しも確認する
+    monkeypatch.setattr(TagCooccurrence, "FETCH_CHUNK", fetch_chunk)
+    cooccurrence = TagCooccurrence.from_database(ImageDatabase(search_db_path), min_support)
+    pairs = dict(zip(zip(cooccurrence.tag_a.tolist(), cooccurrence.tag_b.tolist()),
+                     cooccurrence.pair_counts.tolist()))
+    assert pairs == brute_force_pairs(search_db_path, min_support)
+
+
+def test_related_tags_from_saved_pairs(tmp_path):
+    db = ImageDatabase(str(tmp_path / "image_search.db"))
+    db.add_images_with_tags_batch([
+        ("/img/0.jpg", ["sky", "cloud", "sun"]),
+        ("/img/1.jpg", ["sky", "cloud"]),
+        ("/img/2.jpg", ["sky", "sun"]),
+        ("/img/3.jpg", ["sky", "cloud", "moon"]),
+    ])
+    build_cooccurrence(db, min_support=2)
+    assert db.get_related_tags(["sky"]) == [("cloud", 3), ("sun", 2)]
+    assert db.get_related_tags(["cloud"]) == [("sky", 3)]
+    assert db.get_related_tags(["sky", "cloud"]) == []
+    assert db.get_pair_counts(["sky", "sun", "moon"]) == {("sky", "sun"): 2}
+    db.close_connections()
@@ -0,0 +1,59 @@
+# test_thumbnails.py
+"""サムネイル配信のサイズ検証・ETag / Last-Modified による 304 の確認"""
+
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from thumbnails import THUMBNAIL_SIZES, validate_thumbnail_size
+
+
+@pytest.mark.parametrize("size", ["abc", "", "1e3", None, "64", 1024])
+def test_invalid_sizes_share_one_message(size):
+    with pytest.raises(ValueError) as error:
+        validate_thumbnail_size(size)
+    assert str(error.value) == "未対応のサムネイルサイズです（128, 256, 512 のいずれかを指定）"
+
+
+def test_valid_sizes():
+    assert [validate_thumbnail_size(str(size)) for size in THUMBNAIL_SIZES] == list(THUMBNAIL_SIZES)
+
+
+@pytest.mark.parametrize("size", ["abc", "64"])
+def test_thumbnail_rejects_invalid_size(client, size):
+    response = client.get(f'/api/image/1/thumb?size={size}')
+    assert response.status_code == 400
+    assert "128, 256, 512" in response.get_json()['error']
+
+
+def test_thumbnail_etag_and_304(client):
+    response = client.get('/api/image/1/thumb?size=128')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+    assert max(Image.open(io.BytesIO(response.get_data())).size) <= 128
+    response.close()
+
+    assert client.get('/api/image/1/thumb?size=128', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/api/image/1/thumb?size=128',
+                      headers={'If-Modified-Since': last_modified}).status_code == 304
+    # サイズごとに ETag が異なる
+    response = client.get('/api/image/1/thumb?size=256', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    response.close()
+
+
+def test_thumbnail_etag_changes_with_source(client, app_module):
+    filepath = app_module.db.get_image(2)[1]
+    etag = client.get('/api/image/2/thumb').headers['ETag']
+    stat = os.stat(filepath)
+    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    response = client.get('/api/image/2/thumb', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    response.close()
+
+
+def test_thumbnail_of_unknown_image(client):
+    assert client.get('/api/image/999999/thumb').status_code == 404
@@ -0,0 +1,125 @@
+# thumbnails.py
+"""
+サムネイル生成とディスクキャッシュ
+一覧表示用の縮小画像を初回アクセス時に作成し、画像ID・サイズ・元ファイルの更新時刻をキーに保存する
+元ファイルが更新されると更新時刻が変わるため、古いサムネイルは自動的に使われなくなる（作り直し時に削除）
+
+キャッシュのディレクトリ構成: <cache_dir>/<画像IDの下位8ビット>/<画像ID>-<サイズ>-<更新時刻ns>.<拡張子>
+"""
+
+import glob
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+
+# 生成を許可するサムネイルの長辺（任意のサイズを受け付けるとキャッシュが際限なく増える）
+THUMBNAIL_SIZES = (128, 256, 512)
+# 一覧表示（200px のタイル）用の既定サイズ
+DEFAULT_THUMBNAIL_SIZE = 256
+
+# 保存形式: 形式名 → (PIL の形式, MIMEタイプ, 拡張子)
+THUMBNAIL_FORMATS = {
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+
+
+def thumbnail_etag(image_id: int, size: int, mtime_ns: int) -> str:
+    """サムネイルの ETag（元ファイルの更新時刻が変わると変わる）"""
+    return f"{image_id}-{size}-{mtime_ns:x}"
+
+
+def validate_thumbnail_size(size) -> int:
+    """サムネイルサイズを検証（数値でない値・THUMBNAIL_SIZES 以外は同じメッセージの ValueError）"""
+    try:
+        value = int(size)
+    except (TypeError, ValueError):
+        value = None
+    if value not in THUMBNAIL_SIZES:
+        raise ValueError(f"未対応のサムネイルサイズです（{', '.join(map(str, THUMBNAIL_SIZES))} のいずれかを指定）")
+    return value
+
+
+class ThumbnailCache:
+    def __init__(self, cache_dir: str = "thumbnail_cache", image_format: str = "webp", quality: int = 80):
+        """
+        cache_dir: サムネイルを保存するディレクトリ
+        image_format: "webp" または "jpeg"
+        quality: 保存時の品質（0-100）
+        """
+        if image_format not in THUMBNAIL_FORMATS:
+            raise ValueError(f"未対応のサムネイル形式: {image_format}")
+        # send_file は相対パスをアプリのディレクトリ基準で解決するため絶対パスで保持する
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.image_format = image_format
+        self.quality = quality
+        self.pil_format, self.mimetype, self.extension = THUMBNAIL_FORMATS[image_format]
+
+    def path_for(self, image_id: int, size: int, mtime_ns: int) -> str:
+        """サムネイルの保存先（1ディレクトリのファイル数を抑えるため画像IDで256個に分ける）"""
+        return os.path.join(self.cache_dir, f"{image_id & 0xff:02x}",
+                            f"{image_id}-{size}-{mtime_ns:x}.{self.extension}")
+
+    @staticmethod
+    def load_source(source_path: str, size: int) -> Image.Image:
+        """
+        元画像を読み込む。JPEG は draft() で size 以上になる範囲の縮小デコード（1/2〜1/8）を行い、
+        フル解像度のデコードを避ける
+        """
+        with Image.open(source_path) as image:
+            if image.format == "JPEG":
+                image.draft("RGB", (size, size))
+            image.load()
+            return ImageOps.exif_transpose(image)
+
+    def render(self, image: Image.Image, size: int) -> Image.Image:
+        """長辺を size 以下に縮小し、保存形式で扱えるモードに変換（元の画像は変更しない）"""
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        has_alpha = thumbnail.mode in ("RGBA", "LA", "PA") or "transparency" in thumbnail.info
+        if has_alpha and self.pil_format == "WEBP":
+            return thumbnail.convert("RGBA")
+        if has_alpha:
+            # JPEG は透過を扱えないため白背景に合成する
+            background = Image.new("RGB", thumbnail.size, (255, 255, 255))
+            background.paste(thumbnail.convert("RGBA"), mask=thumbnail.convert("RGBA").getchannel("A"))
+            return background
+        return thumbnail.convert("RGB")
+
+    def save(self, image_id: int, image: Image.Image, size: int, mtime_ns: int) -> str:
+        """デコード済みの画像からサムネイルを作成して保存し、保存先を返す"""
+        return self.write(image_id, self.render(image, size), size, mtime_ns)
+
+    def write(self, image_id: int, thumbnail: Image.Image, size: int, mtime_ns: int) -> str:
+        """render() 済みのサムネイルを保存し、保存先を返す（登録時の事前生成は画像IDが決まってから書き込む）"""
+        path = self.path_for(image_id, size, mtime_ns)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # 同時に作成されても壊れたファイルを配信しないよう、一時ファイルに書いてから置き換える
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                thumbnail.save(f, self.pil_format, quality=self.quality)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        # 元ファイルの更新前の古いサムネイルを削除
+        for stale in glob.glob(os.path.join(directory, f"{image_id}-{size}-*.{self.extension}")):
+            if stale != path:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+        return path
+
+    def get(self, image_id: int, source_path: str, size: int, mtime_ns: int) -> str:
+        """サムネイルの保存先を返す（なければ元画像から作成）"""
+        path = self.path_for(image_id, size, mtime_ns)
+        if not os.path.exists(path):
+            path = self.save(image_id, self.load_source(source_path, size), size, mtime_ns)
+        return path
@@ -124,12 +124,12 @@ class TensorRTTagger:
         return results
 
     def postprocess(self, probs, threshold, character_threshold):
+        # (タグ, 確率) のリストを返す（確率はそのまま信頼度としてデータベースに保存される）
         result = list(zip(self.tags, probs))
         general = [item for item in result[self.general_index:self.character_index] if item[1] > threshold]
         character = [item for item in result[self.character_index:] if item[1] > character_threshold]
         all_tags = character + general
-        res = ", ".join(item[0] for item in all_tags)
-        return res
+        return [(tag, float(score)) for tag, score in all_tags]
     
     def convert(self, onnx_path, trt_path):
         if os.path.exists(os.path.join(trt_path)):